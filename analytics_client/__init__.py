@@ -0,0 +1,10 @@
+"""Python client for the analytics server.
+
+    from analytics_client import AnalyticsClient
+
+    client = AnalyticsClient('http://analytics-server:5000', token_provider=get_service_token)
+    client.track('payment_initiated', user_id=42, metadata={'amount': 120})
+"""
+from .client import AnalyticsClient
+
+__all__ = ['AnalyticsClient']
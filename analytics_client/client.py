@@ -0,0 +1,264 @@
+"""Buffered client for the analytics server's batch ingest endpoint"""
+import atexit
+import base64
+import gzip
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from datetime import date, datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger('analytics_client')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def token_expiry(token):
+    """The ``exp`` claim of a JWT (read without verifying it), or None"""
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class AnalyticsClient:
+    """Collects events in memory and sends them to ``POST /api/analytics/events`` in batches.
+
+    A batch is sent when ``batch_size`` events are buffered or ``flush_interval``
+    seconds after the oldest unsent event, from a background thread. Bodies
+    above ``compress_min_bytes`` are gzip compressed. Failed sends are retried
+    with exponential backoff and full jitter; every event carries an
+    ``event_uuid``, so a retried batch is never stored twice.
+
+    Authentication uses either a fixed ``token`` or a ``token_provider``
+    callable returning a fresh JWT. The provider is called again shortly
+    before the current token expires and after a 401.
+
+    Events the server refuses for good (per item in the response's
+    ``errors``, or the whole batch on a 4xx) are not retried: they are
+    logged, counted in ``rejected`` and passed to ``on_rejected(event, error)``
+    if given, which runs on the flush thread.
+
+    Buffered events are flushed when the interpreter exits.
+    """
+
+    def __init__(self, base_url, token=None, token_provider=None, batch_size=1000, flush_interval=2.0,
+                 max_buffer_size=100000, max_retries=5, backoff_base=0.5, backoff_max=30.0,
+                 timeout=10.0, compress_min_bytes=1024, pool_size=4, on_rejected=None):
+        if token is None and token_provider is None:
+            raise ValueError('token or token_provider is required')
+        self.url = base_url.rstrip('/') + '/api/analytics/events'
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.compress_min_bytes = compress_min_bytes
+        self.on_rejected = on_rejected
+        self.dropped = 0
+        self.rejected = 0
+
+        self._token = token
+        self._token_provider = token_provider
+        self._token_lock = threading.Lock()
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._buffer = []
+        self._oldest = None
+        self._in_flight = 0
+        self._closed = False
+        self._changed = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='analytics-client-flush', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # --- Producer API -------------------------------------------------------
+
+    def track(self, event_type, user_id=None, session_id=None, page_path=None, metadata=None, event_uuid=None):
+        """Buffer one event; returns its event_uuid. Never blocks on the network."""
+        event = {
+            'event_uuid': str(event_uuid or uuid.uuid4()),
+            'event_type': event_type,
+            'user_id': user_id,
+            'session_id': session_id,
+            'page_path': page_path,
+            'metadata': metadata or {},
+        }
+        with self._changed:
+            if self._closed:
+                raise RuntimeError('AnalyticsClient is closed')
+            if len(self._buffer) >= self.max_buffer_size:
+                # The server is unreachable for long enough that memory is at risk; shed new events
+                self.dropped += 1
+                return event['event_uuid']
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(event)
+            # Wake the flusher to start the flush_interval timer or send a full batch
+            if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                self._changed.notify_all()
+        return event['event_uuid']
+
+    def flush(self, timeout=None):
+        """Send everything buffered so far; returns False if ``timeout`` expired first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            self._oldest = float('-inf') if self._buffer else self._oldest
+            self._changed.notify_all()
+            while self._buffer or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def close(self, timeout=10.0):
+        """Flush and stop the background thread"""
+        with self._changed:
+            if self._closed:
+                return
+        self.flush(timeout)
+        with self._changed:
+            self._closed = True
+            self._changed.notify_all()
+        self._thread.join(timeout)
+        self._session.close()
+        atexit.unregister(self.close)
+
+    # --- Background flushing ------------------------------------------------
+
+    def _due(self):
+        if not self._buffer:
+            return False
+        return len(self._buffer) >= self.batch_size or time.monotonic() - self._oldest >= self.flush_interval
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._due() and not self._closed:
+                    wait = None if not self._buffer else self._oldest + self.flush_interval - time.monotonic()
+                    self._changed.wait(wait)
+                if self._closed and not self._buffer:
+                    return
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                if self._buffer and self._oldest != float('-inf'):
+                    self._oldest = time.monotonic()
+                self._in_flight = len(batch)
+
+            try:
+                self._send(batch)
+            except Exception:
+                log.exception('Dropping %d analytics events after an unexpected error', len(batch))
+            finally:
+                with self._changed:
+                    self._in_flight = 0
+                    self._changed.notify_all()
+
+    # --- HTTP ---------------------------------------------------------------
+
+    def _current_token(self, force_refresh=False):
+        with self._token_lock:
+            if self._token_provider is not None:
+                expiry = token_expiry(self._token) if self._token else None
+                stale = self._token is None or (expiry is not None and expiry - time.time() < 30)
+                if force_refresh or stale:
+                    self._token = self._token_provider()
+            return self._token
+
+    def _encode(self, batch):
+        body = json.dumps({'events': batch}, default=_json_default, separators=(',', ':')).encode()
+        headers = {'Content-Type': 'application/json'}
+        if len(body) >= self.compress_min_bytes:
+            body = gzip.compress(body, compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
+
+    def _backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _reject(self, batch, errors):
+        """Report ``(index, error)`` pairs of events the server refused"""
+        self.rejected += len(errors)
+        log.error('Analytics server rejected %d of %d events, first: %s', len(errors), len(batch), errors[0][1])
+        if self.on_rejected is None:
+            return
+        for index, error in errors:
+            try:
+                self.on_rejected(batch[index], error)
+            except Exception:
+                log.exception('on_rejected callback failed')
+
+    @staticmethod
+    def _item_errors(response):
+        try:
+            errors = response.json().get('errors') or []
+            return [(int(error['index']), str(error['error'])) for error in errors]
+        except (ValueError, AttributeError, KeyError, TypeError):
+            return []
+
+    def _send(self, batch):
+        body, headers = self._encode(batch)
+        refreshed = False
+        attempt = 0
+        while True:
+            headers['Authorization'] = f'Bearer {self._current_token()}'
+            retry_after = None
+            try:
+                response = self._session.post(self.url, data=body, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                problem = str(e)
+            else:
+                if response.status_code < 300:
+                    # Invalid items are skipped by the server; retrying them cannot help
+                    errors = self._item_errors(response)
+                    if errors:
+                        self._reject(batch, errors)
+                    return
+                if response.status_code == 401 and self._token_provider is not None and not refreshed:
+                    self._current_token(force_refresh=True)
+                    refreshed = True
+                    continue
+                if response.status_code not in RETRY_STATUSES:
+                    errors = self._item_errors(response)
+                    if not errors:
+                        problem = f'HTTP {response.status_code}: {response.text[:200]}'
+                        errors = [(index, problem) for index in range(len(batch))]
+                    self._reject(batch, errors)
+                    return
+                problem = f'HTTP {response.status_code}'
+                try:
+                    retry_after = float(response.headers['Retry-After'])
+                except (KeyError, ValueError):
+                    pass
+
+            if attempt >= self.max_retries:
+                log.error('Giving up on %d analytics events after %d attempts: %s', len(batch), attempt + 1, problem)
+                return
+            delay = self._backoff(attempt, retry_after)
+            log.warning('Sending analytics events failed (%s), retrying in %.1fs', problem, delay)
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The repository directory is the package: import it as analytics_client from its parent
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
@@ -0,0 +1,118 @@
+import gzip
+import json
+
+import pytest
+import requests
+
+from analytics_client import AnalyticsClient
+
+
+class StubResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self._body = body or {}
+        self.text = json.dumps(self._body)
+
+    def json(self):
+        return self._body
+
+
+class StubSession:
+    """Records posted batches and answers with the queued outcomes, then 201"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.batches = []
+        self.encodings = []
+
+    def post(self, url, data, headers, timeout):
+        self.encodings.append(headers.get('Content-Encoding'))
+        if headers.get('Content-Encoding') == 'gzip':
+            data = gzip.decompress(data)
+        self.batches.append(json.loads(data)['events'])
+        outcome = self.outcomes.pop(0) if self.outcomes else StubResponse(201)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def make_client():
+    clients = []
+
+    def make_client(*outcomes, **options):
+        client = AnalyticsClient('http://analytics', token='token', flush_interval=60, backoff_base=0, **options)
+        client._session = StubSession(*outcomes)
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        client.close()
+
+
+def test_events_are_sent_in_batches(make_client):
+    client = make_client(batch_size=3)
+    sent = [client.track('view', user_id=index) for index in range(7)]
+    assert client.flush(timeout=5)
+
+    batches = client._session.batches
+    assert [len(batch) for batch in batches] == [3, 3, 1]
+    assert [event['event_uuid'] for batch in batches for event in batch] == sent
+
+
+def test_large_batches_are_compressed(make_client):
+    client = make_client(compress_min_bytes=0)
+    client.track('view')
+    assert client.flush(timeout=5)
+    assert client._session.encodings == ['gzip']
+    assert client._session.batches[0][0]['event_type'] == 'view'
+
+
+@pytest.mark.parametrize('failure', [StubResponse(503), requests.ConnectionError('refused')])
+def test_failed_sends_are_retried_with_the_same_batch(make_client, failure):
+    client = make_client(failure, failure)
+    client.track('view')
+    assert client.flush(timeout=5)
+
+    first, *retries = client._session.batches
+    assert retries == [first, first]
+    assert client.rejected == 0
+
+
+def test_retries_stop_after_max_retries(make_client):
+    client = make_client(*[StubResponse(500)] * 5, max_retries=2)
+    client.track('view')
+    assert client.flush(timeout=5)
+    assert len(client._session.batches) == 3
+
+
+def test_rejected_items_are_reported_and_not_retried(make_client):
+    rejected = []
+    client = make_client(
+        StubResponse(201, {'errors': [{'index': 1, 'error': 'event_type is required'}]}),
+        on_rejected=lambda event, error: rejected.append((event['user_id'], error))
+    )
+    client.track('view', user_id=1)
+    client.track('', user_id=2)
+    assert client.flush(timeout=5)
+
+    assert rejected == [(2, 'event_type is required')]
+    assert client.rejected == 1
+    assert len(client._session.batches) == 1
+
+
+def test_a_refused_batch_rejects_every_event(make_client):
+    rejected = []
+    client = make_client(StubResponse(400, {'error': 'Invalid payload'}), on_rejected=lambda event, error: rejected.append(error))
+    client.track('view')
+    client.track('view')
+    assert client.flush(timeout=5)
+
+    assert client.rejected == 2
+    assert len(rejected) == 2 and rejected[0].startswith('HTTP 400')
+    assert len(client._session.batches) == 1
@@ -0,0 +1,204 @@
+"""Group-by aggregation over events, pushed down into SQL.
+
+``group_by`` takes any combination of event_type, page_path, user_id,
+session_id, a time bucket (``time:hour``, ``time:day``, ``time:week``,
+``time:month``) and top-level metadata keys (``metadata.<key>``).
+``metrics`` takes ``count``, ``count_distinct:user_id``,
+``count_distinct:session_id`` and ``sum:<key>`` / ``avg:<key>`` over numeric
+metadata values (other values are ignored, as SQL ignores NULLs).
+
+On a single shard the grouping, aggregates, names of the dictionary encoded
+dimensions, ordering and limit are all one SELECT. With several shards
+every shard runs that SELECT without ORDER BY/LIMIT, computing averages as
+sum and count, and the partial groups are combined here. Users never span
+shards, so distinct users simply add up; distinct sessions do too as long
+as a session belongs to one user.
+
+Archived (Parquet) events are not included.
+"""
+import re
+from collections import namedtuple
+
+from sqlalchemy import Float, Numeric, asc, case, cast, desc, distinct, func, literal_column, select
+
+from models import AnalyticsEvent, EventType, PagePath
+
+TIME_BUCKETS = ('hour', 'day', 'week', 'month')
+DISTINCT_COLUMNS = {'user_id': AnalyticsEvent.user_id, 'session_id': AnalyticsEvent.session_id}
+METADATA_KEY = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+MAX_GROUP_BY = 5
+MAX_METRICS = 10
+MAX_AGGREGATE_LIMIT = 10000
+
+Dimension = namedtuple('Dimension', ['name', 'expression', 'join'])
+Metric = namedtuple('Metric', ['name', 'kind', 'argument'])
+
+
+def _metadata_key(key):
+    if not METADATA_KEY.match(key):
+        raise ValueError(f'Invalid metadata key: {key!r}')
+    return key
+
+
+def _numeric(key):
+    """A metadata value as a number, NULL when it is missing or not a JSON number"""
+    value = AnalyticsEvent.event_metadata.op('->')(key)
+    return case((func.json_typeof(value) == 'number', cast(AnalyticsEvent.event_metadata.op('->>')(key), Numeric)))
+
+
+def parse_group_by(raw):
+    """Parse ``group_by`` into Dimensions; raises ValueError"""
+    names = list(dict.fromkeys(name.strip() for name in (raw or '').split(',') if name.strip()))
+    if len(names) > MAX_GROUP_BY:
+        raise ValueError(f'At most {MAX_GROUP_BY} group_by dimensions are supported')
+
+    dimensions = []
+    for name in names:
+        if name == 'event_type':
+            dimensions.append(Dimension(name, EventType.value, 'event_type'))
+        elif name == 'page_path':
+            dimensions.append(Dimension(name, PagePath.value, 'page_path'))
+        elif name in ('user_id', 'session_id'):
+            dimensions.append(Dimension(name, getattr(AnalyticsEvent, name), None))
+        elif name.startswith('time:') and name[5:] in TIME_BUCKETS:
+            dimensions.append(Dimension(name, func.date_trunc(name[5:], AnalyticsEvent.timestamp), None))
+        elif name.startswith('metadata.'):
+            key = _metadata_key(name[9:])
+            dimensions.append(Dimension(name, AnalyticsEvent.event_metadata.op('->>')(key), None))
+        else:
+            raise ValueError(f'Unknown group_by dimension: {name}')
+    return dimensions
+
+
+def parse_metrics(raw):
+    """Parse ``metrics`` (default ``count``) into Metrics; raises ValueError"""
+    specs = list(dict.fromkeys(spec.strip() for spec in (raw or 'count').split(',') if spec.strip()))
+    if len(specs) > MAX_METRICS:
+        raise ValueError(f'At most {MAX_METRICS} metrics are supported')
+
+    metrics = []
+    for spec in specs:
+        kind, _, argument = spec.partition(':')
+        if kind == 'count' and not argument:
+            metrics.append(Metric('count', 'count', None))
+        elif kind == 'count_distinct' and argument in DISTINCT_COLUMNS:
+            metrics.append(Metric(f'count_distinct_{argument}', kind, argument))
+        elif kind in ('sum', 'avg') and argument:
+            metrics.append(Metric(f'{kind}_{_metadata_key(argument)}', kind, argument))
+        else:
+            raise ValueError(f'Unknown metric: {spec}')
+    return metrics
+
+
+def parse_order_by(raw, dimensions, metrics):
+    """``(name, descending)``; defaults to the first metric, largest first"""
+    names = [dimension.name for dimension in dimensions] + [metric.name for metric in metrics]
+    if not raw:
+        return metrics[0].name, True
+    name, descending = (raw[1:], True) if raw.startswith('-') else (raw, False)
+    if name not in names:
+        raise ValueError(f"order_by must be one of {', '.join(names)} (prefix - for descending)")
+    return name, descending
+
+
+def _metric_columns(metric, partial):
+    if metric.kind == 'count':
+        return [func.count().label(metric.name)]
+    if metric.kind == 'count_distinct':
+        return [func.count(distinct(DISTINCT_COLUMNS[metric.argument])).label(metric.name)]
+    value = _numeric(metric.argument)
+    if metric.kind == 'sum':
+        return [cast(func.sum(value), Float).label(metric.name)]
+    if partial:
+        # Shards cannot average their averages; the combined average is total sum / total count
+        return [cast(func.sum(value), Float).label(f'{metric.name}__sum'), func.count(value).label(f'{metric.name}__n')]
+    return [cast(func.avg(value), Float).label(metric.name)]
+
+
+def aggregate_statement(query, dimensions, metrics, order=None, limit=None, partial=False):
+    """Grouped aggregate SELECT over the events matched by a filtered event query"""
+    columns = [dimension.expression.label(dimension.name) for dimension in dimensions]
+    for metric in metrics:
+        columns += _metric_columns(metric, partial)
+    # Only the filters of the event query are kept; the joins below hang off analytics_events
+    statement = select(*columns).select_from(AnalyticsEvent)
+    if query.whereclause is not None:
+        statement = statement.where(query.whereclause)
+
+    joins = {dimension.join for dimension in dimensions}
+    if 'event_type' in joins:
+        statement = statement.join(EventType, EventType.id == AnalyticsEvent.event_type_id)
+    if 'page_path' in joins:
+        statement = statement.outerjoin(PagePath, PagePath.id == AnalyticsEvent.page_path_id)
+    if dimensions:
+        statement = statement.group_by(*(literal_column(str(position)) for position in range(1, len(dimensions) + 1)))
+
+    if order is not None:
+        name, descending = order
+        direction = desc if descending else asc
+        # Ties are broken by the dimensions so pages are stable
+        statement = statement.order_by(
+            direction(literal_column(f'"{name}"')).nulls_last(),
+            *(literal_column(str(position)) for position in range(1, len(dimensions) + 1))
+        )
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def merge_partials(partials, dimensions, metrics, order, limit):
+    """Combine per-shard partial groups into final rows"""
+    keys = [dimension.name for dimension in dimensions]
+    groups = {}
+    for rows in partials:
+        for row in rows:
+            row = dict(row._mapping)
+            key = tuple(row[name] for name in keys)
+            group = groups.get(key)
+            if group is None:
+                groups[key] = row
+                continue
+            for name, value in row.items():
+                if name not in keys and value is not None:
+                    group[name] = value if group[name] is None else group[name] + value
+
+    results = []
+    for group in groups.values():
+        for metric in metrics:
+            if metric.kind == 'avg':
+                total, count = group.pop(f'{metric.name}__sum'), group.pop(f'{metric.name}__n')
+                group[metric.name] = total / count if count else None
+        results.append(group)
+
+    return order_rows(results, dimensions, order, limit)
+
+
+def _nulls_last(value):
+    return (True,) if value is None else (False, value)
+
+
+def order_rows(rows, dimensions, order, limit):
+    """Sort and cut rows computed outside SQL the way aggregate_statement orders them"""
+    names = [dimension.name for dimension in dimensions]
+    rows = sorted(rows, key=lambda row: [_nulls_last(row[name]) for name in names])
+    name, descending = order
+    present = [row for row in rows if row[name] is not None]
+    missing = [row for row in rows if row[name] is None]
+    present.sort(key=lambda row: row[name], reverse=descending)
+    return (present + missing)[:limit]
+
+
+def aggregate(shard_set, shards, base_query, dimensions, metrics, order, limit):
+    """Aggregate rows as dictionaries; ``base_query(session)`` builds the filtered event query"""
+    if len(shards) == 1:
+        rows = shard_set.broadcast(
+            lambda session: session.execute(aggregate_statement(base_query(session), dimensions, metrics, order, limit)).all(),
+            shards
+        )[shards[0]]
+        return [dict(row._mapping) for row in rows]
+
+    partials = shard_set.broadcast(
+        lambda session: session.execute(aggregate_statement(base_query(session), dimensions, metrics, partial=True)).all(),
+        shards
+    )
+    return merge_partials(partials.values(), dimensions, metrics, order, limit)
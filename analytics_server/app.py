@@ -1,7 +1,6 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, Response, request, jsonify, g
 from flask_cors import CORS
-from flasgger import Swagger
-from datetime import datetime
+from datetime import datetime, timedelta
 from models import db
 import os
 import time
@@ -41,31 +40,95 @@ swagger_template = {
         {
             "name": "Analytics Events",
             "description": "Endpoints for managing analytics events"
+        },
+        {
+            "name": "Debug",
+            "description": "Diagnostics for operators"
         }
     ]
 }
 
-swagger = Swagger(app, config=swagger_config, template=swagger_template)
+# The spec is only built when /apispec.json is first requested; SWAGGER_ENABLED=false skips flasgger entirely
+if os.getenv('SWAGGER_ENABLED', 'true').lower() == 'true':
+    from flasgger import Swagger
+    swagger = Swagger(app, config=swagger_config, template=swagger_template)
 
 DATABASE_URL = os.getenv('DATABASE_URL', 'postgresql://analytics_user:analytics_pass@db:5432/analytics_db')
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Fail fast instead of hanging on an unreachable database host
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'connect_args': {'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', '5'))}
+}
 
 
 db.init_app(app)
 
 
-from models import AnalyticsEvent
-from auth_middleware import verify_token
+from sqlalchemy import delete as delete_statement
+
+from models import AnalyticsEvent, UserActivity
+from auth_middleware import STREAM_TOKEN_SECONDS, issue_stream_token, verify_stream_token, verify_token
+from serialization import parse_fields, project, rows_to_dicts, json_response
+from http_cache import RequestDecompression, compressed, conditional, conditional_on, events_version
+from ingest import build_event_row
+from payloads import PayloadError, decode_batch, decode_event
+from dimensions import event_types, event_type_filter
+from archive import cold_store
+from event_queue import INGEST_TRANSPORT, queue_enabled, publish_rows
+from ingest_worker import start_local_consumer
+from stream import event_ring, publish_events, sse_messages
+from detectors import RATE_ALERTS_PUBLISH, rate_detector
+from replicas import read_only
+from shards import shard_set, merge_newest_first
+from slow_queries import SLOW_QUERY_MS, slow_query_log
+from health import check_broker, check_database
+from event_counts import COUNT_MODES, DEFAULT_COUNT_MODE, EVENTS_COUNT_CAP, capped_count, count_events, rollup_applies
+from aggregates import MAX_AGGREGATE_LIMIT, aggregate, parse_group_by, parse_metrics, parse_order_by
+from retention import MAX_COHORTS, RETENTION_INTERVALS, period_start, retention_matrix
+from rate_limits import rate_limited
+from profiles import forget_events, update_profiles
+from spool import SPOOL_ENABLED, SpoolFull, spool, store_events
+from profiling import init_profiling
+from hot_window import HOT_WINDOW_ENABLED, hot_window
+from daily_summaries import DAILY_SUMMARIES_ENABLED, MAX_DAILY_RANGE, daily_summaries, parse_day
 from logger import get_logger, create_logging_middleware, log_response
 
 #CORS za frontend
 CORS(app, origins=['http://localhost:3000', 'http://localhost:3001'])
 
+# Clients may send gzip (or zstd) compressed request bodies
+app.wsgi_app = RequestDecompression(app.wsgi_app)
+
+# Without a broker the queue consumer runs inside the web process
+if queue_enabled() and INGEST_TRANSPORT == 'local':
+    start_local_consumer(app, db)
+
+# Events spooled to disk during a database outage are replayed from here
+if SPOOL_ENABLED:
+    spool.start_replayer(app, db)
+
+# Daily KPI snapshots; an advisory lock lets one process at a time refresh them
+if DAILY_SUMMARIES_ENABLED:
+    daily_summaries.start_scheduler(app)
+# Replays can land in days whose snapshot is already complete
+spool.add_listener(daily_summaries.observe_rows)
+
+# Recent events are kept in memory when this process performs every write
+if HOT_WINDOW_ENABLED and not queue_enabled():
+    hot_window.start(app)
+    spool.add_listener(hot_window.observe_rows)
+
 # Initialize logger
 logger = get_logger('analytics-server')
 logging_middleware = create_logging_middleware(logger)
 
+if RATE_ALERTS_PUBLISH:
+    # Alerts are raised from the tracking endpoints, so a request context exists
+    rate_detector.add_listener(
+        lambda alert: logger.warn(request.url, g.correlation_id, 'Event rate threshold exceeded', alert)
+    )
+
 # Add logging middleware
 @app.before_request
 def before_request():
@@ -86,6 +149,59 @@ def after_request(response):
         )
     return response
 
+# Per-request SQL counts and sampled profiles (PROFILING_ENABLED)
+init_profiling(app)
+
+def parse_date(value):
+    return datetime.fromisoformat(value) if value else None
+
+def filter_events(session, user_id=None, event_type=None, start_date=None, end_date=None):
+    """Event query on ``session`` with the shared query-string filters applied"""
+    query = session.query(AnalyticsEvent)
+    if user_id:
+        query = query.filter(AnalyticsEvent.user_id == user_id)
+    if event_type:
+        query = query.filter(event_type_filter(session, event_type))
+    if start_date:
+        query = query.filter(AnalyticsEvent.timestamp >= parse_date(start_date))
+    if end_date:
+        query = query.filter(AnalyticsEvent.timestamp <= parse_date(end_date))
+    return query
+
+def delete_matching(session, query):
+    """Delete the events of ``query`` and take them out of the user profiles; returns their timestamps"""
+    statement = delete_statement(AnalyticsEvent)
+    if query.whereclause is not None:
+        statement = statement.where(query.whereclause)
+    deleted = session.execute(
+        statement.returning(AnalyticsEvent.user_id, AnalyticsEvent.event_type_id, AnalyticsEvent.timestamp),
+        execution_options={'synchronize_session': False}
+    ).all()
+    forget_events(session, [(user_id, type_id) for user_id, type_id, _ in deleted])
+    return [timestamp for _, _, timestamp in deleted]
+
+def apply_event_update(session, event, data):
+    """Copy the updatable fields present in ``data`` onto an event and move it between user profiles"""
+    if data.get('user_id') is not None and shard_set.shard_for(data['user_id']) != shard_set.shard_for_event_id(event.id):
+        raise ValueError('user_id cannot be changed to a user stored on another shard')
+    
+    counted_as = (event.user_id, event.event_type_id)
+    if 'event_type' in data:
+        event.event_type = data['event_type']
+    if 'user_id' in data:
+        event.user_id = data['user_id']
+    if 'session_id' in data:
+        event.session_id = data['session_id']
+    if 'page_path' in data:
+        event.page_path = data['page_path']
+    if 'metadata' in data:
+        event.event_metadata = data['metadata']
+    
+    if (event.user_id, event.event_type_id) != counted_as:
+        # Sessions and last page stay with the old profile, as for a delete
+        forget_events(session, [counted_as])
+        update_profiles(session, [{'user_id': event.user_id, 'event_type': event.event_type}], [event.timestamp])
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint
@@ -108,8 +224,69 @@ def health_check():
     """
     return jsonify({'status': 'healthy', 'timestamp': datetime.utcnow().isoformat()}), 200
 
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness probe: the process is up and serving requests (no dependencies are checked)
+    ---
+    tags:
+      - Health
+    responses:
+      200:
+        description: Process is alive
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              example: alive
+    """
+    return jsonify({'status': 'alive'}), 200
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: database (every shard) reachable with the schema in place, broker reachable if needed
+    ---
+    tags:
+      - Health
+    responses:
+      200:
+        description: Ready to take traffic
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              example: ready
+            checks:
+              type: object
+              properties:
+                database:
+                  type: string
+                  example: ok
+                broker:
+                  type: string
+                  example: ok
+      503:
+        description: Not ready; checks holds the failing dependency's error
+    """
+    database_ok, problems = check_database()
+    broker_ok, broker_error = check_broker()
+    
+    # Logs fall back to the console, so the broker is only required when ingest goes through it
+    broker_required = queue_enabled() and INGEST_TRANSPORT == 'rabbitmq'
+    ready = database_ok and (broker_ok or not broker_required)
+    
+    return jsonify({
+        'status': 'ready' if ready else 'not_ready',
+        'checks': {
+            'database': problems.get('database') or problems.get('schema') or 'ok',
+            'broker': 'ok' if broker_ok else broker_error
+        }
+    }), 200 if ready else 503
+
 @app.route('/api/analytics/event', methods=['POST'])
 @verify_token
+@rate_limited
 def track_event():
     """Track an analytics event
     ---
@@ -124,8 +301,14 @@ def track_event():
           required:
             - event_type
           properties:
+            event_uuid:
+              type: string
+              format: uuid
+              description: Optional client generated id; resubmitting it is acknowledged without a new row
+              example: "3f1c2a9e-6a8b-4b8e-9a53-0c2f7e1d4b11"
             event_type:
               type: string
+              maxLength: 100
               description: Type of the event
               example: page_view
             user_id:
@@ -134,10 +317,12 @@ def track_event():
               example: 123
             session_id:
               type: string
+              maxLength: 255
               description: Session identifier
               example: "abc123def456"
             page_path:
               type: string
+              maxLength: 500
               description: Path of the page
               example: "/dashboard"
             metadata:
@@ -160,14 +345,39 @@ def track_event():
               type: string
               format: date-time
               example: "2024-01-01T12:00:00"
+            deduplicated:
+              type: boolean
+              example: false
+      200:
+        description: Duplicate event_uuid - the already stored event is returned
+      202:
+        description: >
+          Event queued for the ingest worker (INGEST_MODE=queue), or spooled to disk while the
+          database is unavailable (spooled is true); no event_id is assigned yet
       400:
-        description: Bad request - missing required fields
+        description: Bad request - missing event_type, a field of the wrong type or longer than its column
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              example: "Object missing required field `event_type`"
+      429:
+        description: Too many requests - a per-user, per-IP or global rate limit was hit; retry after the Retry-After seconds
         schema:
           type: object
           properties:
             error:
               type: string
-              example: "event_type is required"
+              example: "Rate limit exceeded"
+            limit:
+              type: string
+              example: user
+            retry_after:
+              type: integer
+              example: 1
+      503:
+        description: The database is unavailable and the local event spool is full
       500:
         description: Internal server error
         schema:
@@ -177,42 +387,66 @@ def track_event():
               type: string
     """
     try:
-        data = request.get_json()
-        
-        # Validate required fields
-        if not data or 'event_type' not in data:
-            return jsonify({'error': 'event_type is required'}), 400
+        # Typed decoding validates field types and column lengths before anything is stored
+        try:
+            event = decode_event(request.get_data(cache=False))
+        except PayloadError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Create analytics event
         # Use user_id from JWT token if not provided in request
-        user_id = data.get('user_id') or (hasattr(request, 'user') and request.user.get('userId'))
-        event = AnalyticsEvent(
-            event_type=data['event_type'],
-            user_id=user_id,
-            session_id=data.get('session_id'),
-            page_path=data.get('page_path'),
-            event_metadata=data.get('metadata', {}),
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
-        )
+        default_user_id = hasattr(request, 'user') and request.user.get('userId') or None
+        row = build_event_row(event, default_user_id, request.remote_addr, request.headers.get('User-Agent'))
         
-        db.session.add(event)
-        db.session.commit()
+        if queue_enabled():
+            row, = publish_rows([row])
+            publish_events([row])
+            rate_detector.observe_rows([row])
+            return jsonify({
+                'success': True,
+                'queued': True,
+                'event_uuid': row['event_uuid'],
+                'timestamp': row['timestamp'].isoformat()
+            }), 202
         
-        logger.info(request.url, g.correlation_id, 'Event tracked successfully', {'event_id': event.id})
+        results, spooled = store_events([row])
+        if spooled:
+            row, = spooled
+            publish_events([row])
+            rate_detector.observe_rows([row])
+            return jsonify({
+                'success': True,
+                'spooled': True,
+                'event_uuid': row['event_uuid'],
+                'timestamp': row['timestamp'].isoformat()
+            }), 202
+        
+        result, = results
+        publish_events([row], [result])
+        rate_detector.observe_rows([row], [result])
+        hot_window.observe_rows([row], [result])
+        
+        if result.deduplicated:
+            logger.info(request.url, g.correlation_id, 'Duplicate event acknowledged', {'event_id': result.event_id})
+        else:
+            logger.info(request.url, g.correlation_id, 'Event tracked successfully', {'event_id': result.event_id})
 
         return jsonify({
             'success': True,
-            'event_id': event.id,
-            'timestamp': event.timestamp.isoformat()
-        }), 201
+            'event_id': result.event_id,
+            'timestamp': result.timestamp.isoformat(),
+            'deduplicated': result.deduplicated
+        }), 200 if result.deduplicated else 201
         
+    except SpoolFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/analytics/events', methods=['POST'])
 @verify_token
+@rate_limited
 def track_events_batch():
     """Track multiple analytics events in a batch
     ---
@@ -234,17 +468,24 @@ def track_events_batch():
                 required:
                   - event_type
                 properties:
+                  event_uuid:
+                    type: string
+                    format: uuid
+                    example: "3f1c2a9e-6a8b-4b8e-9a53-0c2f7e1d4b11"
                   event_type:
                     type: string
+                    maxLength: 100
                     example: page_view
                   user_id:
                     type: integer
                     example: 123
                   session_id:
                     type: string
+                    maxLength: 255
                     example: "abc123def456"
                   page_path:
                     type: string
+                    maxLength: 500
                     example: "/dashboard"
                   metadata:
                     type: object
@@ -266,62 +507,135 @@ def track_events_batch():
               items:
                 type: integer
               example: [1, 2]
+            deduplicated:
+              type: array
+              description: event_uuids that were already stored and not inserted again
+              items:
+                type: string
+            errors:
+              type: array
+              description: >
+                Items that failed validation and were skipped; event_ids lists the
+                remaining items in order
+              items:
+                type: object
+                properties:
+                  index:
+                    type: integer
+                    example: 3
+                  error:
+                    type: string
+                    example: "Expected `int | null`, got `str` - at `$.user_id`"
+              example: []
+      202:
+        description: >
+          Events queued for the ingest worker (INGEST_MODE=queue), or spooled to disk while the
+          database is unavailable (spooled is true); event_uuids are returned instead of event_ids
       400:
-        description: Bad request - missing events array
+        description: Bad request - malformed body, missing events array, or no valid event in it
         schema:
           type: object
           properties:
             error:
               type: string
               example: "events array is required"
+      429:
+        description: Too many requests - a per-user, per-IP or global rate limit was hit; retry after the Retry-After seconds
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              example: "Rate limit exceeded"
+            limit:
+              type: string
+              example: user
+            retry_after:
+              type: integer
+              example: 1
+      503:
+        description: The database is unavailable and the local event spool is full
       500:
         description: Internal server error
     """
     try:
-        data = request.get_json()
-        
-        if not data or 'events' not in data:
-            return jsonify({'error': 'events array is required'}), 400
+        # Invalid items are reported by index; the rest of the batch is still stored
+        try:
+            events, errors = decode_batch(request.get_data(cache=False))
+        except PayloadError as e:
+            return jsonify({'error': str(e)}), 400
+        if errors and not events:
+            return jsonify({'error': 'No valid events in batch', 'errors': errors}), 400
         
         # Get user_id from JWT token if not provided in request
         default_user_id = None
         if hasattr(request, 'user') and request.user:
             default_user_id = request.user.get('userId')
         
-        events = []
-        for event_data in data['events']:
-            if 'event_type' not in event_data:
-                continue
-            
-            # Use user_id from event data, or from JWT token, or None
-            user_id = event_data.get('user_id') or default_user_id
-                
-            event = AnalyticsEvent(
-                event_type=event_data['event_type'],
-                user_id=user_id,
-                session_id=event_data.get('session_id'),
-                page_path=event_data.get('page_path'),
-                event_metadata=event_data.get('metadata', {}),
-                ip_address=request.remote_addr,
-                user_agent=request.headers.get('User-Agent')
-            )
-            events.append(event)
+        user_agent = request.headers.get('User-Agent')
+        # Use user_id from event data, or from JWT token, or None
+        rows = [
+            build_event_row(event, default_user_id, request.remote_addr, user_agent)
+            for _, event in events
+        ]
+        
+        if queue_enabled():
+            rows = publish_rows(rows)
+            publish_events(rows)
+            rate_detector.observe_rows(rows)
+            return jsonify({
+                'success': True,
+                'queued': True,
+                'count': len(rows),
+                'event_uuids': [row['event_uuid'] for row in rows],
+                'errors': errors
+            }), 202
         
-        db.session.add_all(events)
-        db.session.commit()
+        results, spooled = store_events(rows)
+        if spooled:
+            publish_events(spooled)
+            rate_detector.observe_rows(spooled)
+            return jsonify({
+                'success': True,
+                'spooled': True,
+                'count': len(spooled),
+                'event_uuids': [row['event_uuid'] for row in spooled],
+                'errors': errors
+            }), 202
+        
+        publish_events(rows, results)
+        rate_detector.observe_rows(rows, results)
+        hot_window.observe_rows(rows, results)
         
         return jsonify({
             'success': True,
-            'count': len(events),
-            'event_ids': [e.id for e in events]
+            'count': sum(1 for result in results if not result.deduplicated),
+            'event_ids': [result.event_id for result in results],
+            'deduplicated': [
+                str(row['event_uuid']) for row, result in zip(rows, results) if result.deduplicated
+            ],
+            'errors': errors
         }), 201
         
+    except SpoolFull as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def events_args():
+    """The projected fields and count_mode of an events query; raises ValueError"""
+    fields = parse_fields(request.args.get('fields'))
+    count_mode = request.args.get('count_mode', DEFAULT_COUNT_MODE)
+    if count_mode not in COUNT_MODES:
+        raise ValueError(f"count_mode must be one of {', '.join(COUNT_MODES)}")
+    return fields, count_mode
+
 @app.route('/api/analytics/events', methods=['GET'])
 @verify_token
+@read_only
+@compressed
+@conditional(validate=events_args)
 def get_events():
     """Get analytics events with optional filters
     ---
@@ -362,6 +676,23 @@ def get_events():
         description: Number of events to skip
         default: 0
         required: false
+      - in: query
+        name: fields
+        type: string
+        description: >
+          Comma separated list of fields to return (id, event_type, user_id, session_id,
+          page_path, metadata, ip_address, user_agent, timestamp) or * for all of them.
+          Defaults to every field except metadata and user_agent.
+        required: false
+      - in: query
+        name: count_mode
+        type: string
+        enum: [exact, capped, estimated, none]
+        description: >
+          How total is computed. exact counts every match; capped stops counting after
+          EVENTS_COUNT_CAP (10000) matches; estimated uses per-user rollups or the query
+          planner's estimate; none leaves total out. Defaults to capped.
+        required: false
     responses:
       200:
         description: List of analytics events
@@ -394,13 +725,23 @@ def get_events():
                     format: date-time
             total:
               type: integer
+              description: Number of matching events; null with count_mode=none
               example: 150
+            total_relation:
+              type: string
+              enum: [eq, gte, approx]
+              description: eq for an exact total, gte when more than total events match, approx for an estimate
+              example: eq
             limit:
               type: integer
               example: 100
             offset:
               type: integer
               example: 0
+      304:
+        description: Not modified - the If-None-Match ETag is still current
+      400:
+        description: Bad request - unknown field or count_mode requested
       500:
         description: Internal server error
     """
@@ -412,38 +753,89 @@ def get_events():
         end_date = request.args.get('end_date')
         limit = request.args.get('limit', default=100, type=int)
         offset = request.args.get('offset', default=0, type=int)
+
+        try:
+            fields, count_mode = events_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Build query
-        query = AnalyticsEvent.query
+        # Totals of recent ranges come from the in-memory window, so shards skip counting
+        hot_total = None
+        if count_mode != 'none':
+            hot_total = hot_window.count((user_id, event_type, parse_date(start_date), parse_date(end_date)))
         
-        if user_id:
-            query = query.filter(AnalyticsEvent.user_id == user_id)
-        if event_type:
-            query = query.filter(AnalyticsEvent.event_type == event_type)
-        if start_date:
-            query = query.filter(AnalyticsEvent.timestamp >= datetime.fromisoformat(start_date))
-        if end_date:
-            query = query.filter(AnalyticsEvent.timestamp <= datetime.fromisoformat(end_date))
+        # A user_id filter touches only that user's shard
+        shards = [shard_set.shard_for(user_id)] if user_id else shard_set.all()
+        scattered = len(shards) > 1
+        merge_fields = fields if not scattered or 'timestamp' in fields else fields + ('timestamp',)
         
-        # Order by timestamp descending
-        query = query.order_by(AnalyticsEvent.timestamp.desc())
+        def shard_page(session):
+            query = filter_events(session, user_id, event_type, start_date, end_date)
+            query = query.order_by(AnalyticsEvent.timestamp.desc())
+            # Any of a shard's first offset + limit rows may end up on the merged page
+            page = project(query, merge_fields)
+            page = page.limit(offset + limit) if scattered else page.limit(limit).offset(offset)
+            rows = rows_to_dicts(session, merge_fields, page.all())
+            
+            if len(rows) < (offset + limit if scattered else limit):
+                # The page ran past the last match, so the exact count is already known
+                if scattered or rows or not offset:
+                    return len(rows) + (0 if scattered else offset), True, rows
+                return capped_count(query, offset), True, rows
+            if hot_total is not None:
+                return None, True, rows
+            count = count_events(session, query, count_mode, user_id, event_type, bool(start_date or end_date))
+            exact = count_mode == 'exact' or (count_mode == 'capped' and count <= EVENTS_COUNT_CAP)
+            return count, exact, rows
         
-        # Pagination
-        total = query.count()
-        events = query.limit(limit).offset(offset).all()
+        pages = shard_set.broadcast(shard_page, shards)
+        events = merge_newest_first([rows for _, _, rows in pages.values()], offset if scattered else 0, limit)
+        if merge_fields is not fields:
+            for event in events:
+                del event['timestamp']
+        exact = all(exact for _, exact, _ in pages.values())
+        if hot_total is not None:
+            total = hot_total
+        else:
+            total = None if count_mode == 'none' and not exact else sum(count for count, _, _ in pages.values())
         
-        return jsonify({
-            'events': [event.to_dict() for event in events],
+        # Archived events are all older than the ones still in Postgres, so they continue the page
+        if cold_store.covers(parse_date(start_date)):
+            cold_filters = (user_id, event_type, parse_date(start_date), parse_date(end_date))
+            if len(events) < limit:
+                # A short page means every shard counted exactly
+                events += cold_store.events(cold_filters, fields, limit - len(events), max(0, offset - total))
+            # An estimate from the user_activity rollup already includes the user's archived events
+            rollup = not exact and rollup_applies(count_mode, user_id, bool(start_date or end_date))
+            if count_mode != 'none' and (exact or count_mode != 'capped') and not rollup:
+                total += cold_store.count(cold_filters)
+        
+        if count_mode == 'none':
+            total, relation = None, None
+        elif count_mode == 'capped' and not exact:
+            total, relation = EVENTS_COUNT_CAP, 'gte'
+        elif exact:
+            relation = 'eq'
+        else:
+            # Estimates can undershoot what this page already proves
+            total, relation = max(total, offset + len(events)), 'approx'
+        
+        return json_response({
+            'events': events,
             'total': total,
+            'total_relation': relation,
             'limit': limit,
             'offset': offset
-        }), 200
+        })
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/analytics/stats', methods=['GET'])
 @verify_token
+@read_only
+@compressed
+@conditional
 def get_stats():
     """Get analytics statistics
     ---
@@ -500,6 +892,8 @@ def get_stats():
                   type: string
                 end_date:
                   type: string
+      304:
+        description: Not modified - the If-None-Match ETag is still current
       500:
         description: Internal server error
     """
@@ -509,28 +903,33 @@ def get_stats():
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         
-        # Build query
-        query = AnalyticsEvent.query
-        
-        if user_id:
-            query = query.filter(AnalyticsEvent.user_id == user_id)
-        if event_type:
-            query = query.filter(AnalyticsEvent.event_type == event_type)
-        if start_date:
-            query = query.filter(AnalyticsEvent.timestamp >= datetime.fromisoformat(start_date))
-        if end_date:
-            query = query.filter(AnalyticsEvent.timestamp <= datetime.fromisoformat(end_date))
-        
-        total_events = query.count()
-        
-        # Get event type distribution
         from sqlalchemy import func
-        event_type_counts = db.session.query(
-            AnalyticsEvent.event_type,
-            func.count(AnalyticsEvent.id).label('count')
-        ).group_by(AnalyticsEvent.event_type).all()
         
-        event_type_distribution = {event_type: count for event_type, count in event_type_counts}
+        def shard_stats(session):
+            # Event type distribution of the filtered events; the total is its sum
+            event_type_counts = filter_events(session, user_id, event_type, start_date, end_date).with_entities(
+                AnalyticsEvent.event_type_id,
+                func.count(AnalyticsEvent.id).label('count')
+            ).group_by(AnalyticsEvent.event_type_id).all()
+            
+            names = event_types.values_for(session, [type_id for type_id, _ in event_type_counts])
+            return {names[type_id]: count for type_id, count in event_type_counts}
+        
+        # Recent ranges are counted in the in-memory window
+        filters = (user_id, event_type, parse_date(start_date), parse_date(end_date))
+        event_type_distribution = hot_window.event_type_counts(filters)
+        if event_type_distribution is None:
+            # Partial aggregates from each shard (only the user's shard for a user_id filter) are summed
+            shards = [shard_set.shard_for(user_id)] if user_id else shard_set.all()
+            event_type_distribution = {}
+            for distribution in shard_set.broadcast(shard_stats, shards).values():
+                for name, count in distribution.items():
+                    event_type_distribution[name] = event_type_distribution.get(name, 0) + count
+            
+            if cold_store.covers(parse_date(start_date)):
+                for name, count in cold_store.event_type_counts(filters).items():
+                    event_type_distribution[name] = event_type_distribution.get(name, 0) + count
+        total_events = sum(event_type_distribution.values())
         
         return jsonify({
             'total_events': total_events,
@@ -546,6 +945,682 @@ def get_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def aggregate_args():
+    """The dimensions, metrics and order of an aggregate query; raises ValueError"""
+    dimensions = parse_group_by(request.args.get('group_by'))
+    metrics = parse_metrics(request.args.get('metrics'))
+    return dimensions, metrics, parse_order_by(request.args.get('order_by'), dimensions, metrics)
+
+@app.route('/api/analytics/aggregate', methods=['GET'])
+@verify_token
+@read_only
+@compressed
+@conditional(validate=aggregate_args)
+def get_aggregate():
+    """Aggregate events grouped by any combination of dimensions
+    ---
+    tags:
+      - Analytics Events
+    parameters:
+      - in: query
+        name: group_by
+        type: string
+        description: >
+          Comma separated dimensions: event_type, page_path, user_id, session_id,
+          time:hour, time:day, time:week, time:month or metadata.<key>. Empty for one overall row.
+        required: false
+        example: "event_type,time:day"
+      - in: query
+        name: metrics
+        type: string
+        description: >
+          Comma separated metrics: count, count_distinct:user_id, count_distinct:session_id,
+          sum:<metadata key>, avg:<metadata key> (numeric metadata only)
+        default: count
+        required: false
+        example: "count,count_distinct:user_id,sum:amount"
+      - in: query
+        name: order_by
+        type: string
+        description: A dimension or metric name, prefixed with - for descending (default the first metric, descending)
+        required: false
+        example: "-count"
+      - in: query
+        name: limit
+        type: integer
+        default: 100
+        required: false
+      - in: query
+        name: user_id
+        type: integer
+        description: Filter by user ID
+        required: false
+      - in: query
+        name: event_type
+        type: string
+        description: Filter by event type
+        required: false
+      - in: query
+        name: start_date
+        type: string
+        format: date-time
+        description: Filter events from this date (ISO format)
+        required: false
+      - in: query
+        name: end_date
+        type: string
+        format: date-time
+        description: Filter events until this date (ISO format)
+        required: false
+    responses:
+      200:
+        description: One row per group, with the dimension values and metrics named as requested
+        schema:
+          type: object
+          properties:
+            group_by:
+              type: array
+              items:
+                type: string
+              example: ["event_type", "time:day"]
+            metrics:
+              type: array
+              items:
+                type: string
+              example: ["count", "count_distinct_user_id", "sum_amount"]
+            rows:
+              type: array
+              items:
+                type: object
+              example: [{"event_type": "purchase", "time:day": "2024-01-01T00:00:00", "count": 42, "count_distinct_user_id": 17, "sum_amount": 1260.5}]
+      304:
+        description: Not modified - the If-None-Match ETag is still current
+      400:
+        description: Bad request - unknown dimension, metric or order_by
+      500:
+        description: Internal server error
+    """
+    try:
+        user_id = request.args.get('user_id', type=int)
+        event_type = request.args.get('event_type')
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        limit = min(request.args.get('limit', 100, type=int), MAX_AGGREGATE_LIMIT)
+        
+        try:
+            dimensions, metrics, order = aggregate_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        filters = (user_id, event_type, parse_date(start_date), parse_date(end_date))
+        rows = hot_window.aggregate(filters, dimensions, metrics, order, limit)
+        if rows is None:
+            shards = [shard_set.shard_for(user_id)] if user_id else shard_set.all()
+            rows = aggregate(
+                shard_set, shards,
+                lambda session: filter_events(session, user_id, event_type, start_date, end_date),
+                dimensions, metrics, order, limit
+            )
+        
+        return json_response({
+            'group_by': [dimension.name for dimension in dimensions],
+            'metrics': [metric.name for metric in metrics],
+            'rows': rows
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def retention_args():
+    """The interval and cohort count of a retention query; raises ValueError"""
+    interval = request.args.get('interval', 'week')
+    cohorts = request.args.get('cohorts', 12, type=int)
+    if interval not in RETENTION_INTERVALS:
+        raise ValueError(f"interval must be one of {', '.join(RETENTION_INTERVALS)}")
+    if not 1 <= cohorts <= MAX_COHORTS:
+        raise ValueError(f'cohorts must be between 1 and {MAX_COHORTS}')
+    return interval, cohorts
+
+def retention_version():
+    """Events version and the open cohort period: the matrix shifts when a new period starts"""
+    interval, _ = retention_args()
+    return events_version(), period_start(datetime.utcnow(), interval)
+
+@app.route('/api/analytics/retention', methods=['GET'])
+@verify_token
+@read_only
+@compressed
+@conditional_on(retention_version, validate=retention_args)
+def get_retention():
+    """Get a cohort retention matrix
+    ---
+    tags:
+      - Analytics Events
+    parameters:
+      - in: query
+        name: cohort_event
+        type: string
+        description: Event that places a user in the cohort of its first occurrence (default any event)
+        required: false
+      - in: query
+        name: return_event
+        type: string
+        description: Event that counts as coming back (default any event)
+        required: false
+      - in: query
+        name: interval
+        type: string
+        enum: [day, week, month]
+        default: week
+        required: false
+      - in: query
+        name: cohorts
+        type: integer
+        description: Number of most recent cohorts
+        default: 12
+        required: false
+    responses:
+      200:
+        description: One row per cohort, oldest first; retained[k] counts users active k intervals after joining
+        schema:
+          type: object
+          properties:
+            interval:
+              type: string
+              example: week
+            cohort_event:
+              type: string
+            return_event:
+              type: string
+            cohorts:
+              type: array
+              items:
+                type: object
+                properties:
+                  cohort:
+                    type: string
+                    format: date-time
+                    example: "2024-01-01T00:00:00"
+                  size:
+                    type: integer
+                    example: 120
+                  retained:
+                    type: array
+                    items:
+                      type: integer
+                    example: [120, 54, 31]
+                  rates:
+                    type: array
+                    items:
+                      type: number
+                    example: [1.0, 0.45, 0.2583]
+      304:
+        description: Not modified - the If-None-Match ETag is still current
+      400:
+        description: Bad request - unknown interval or cohort count out of range
+      500:
+        description: Internal server error
+    """
+    try:
+        cohort_event = request.args.get('cohort_event')
+        return_event = request.args.get('return_event')
+        try:
+            interval, cohorts = retention_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({
+            'interval': interval,
+            'cohort_event': cohort_event,
+            'return_event': return_event,
+            'cohorts': retention_matrix(shard_set, cohort_event, return_event, interval, cohorts)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def daily_range():
+    """The first and last day of a daily summaries query; raises ValueError"""
+    try:
+        end = parse_day(request.args.get('to'), datetime.utcnow().date())
+        start = parse_day(request.args.get('from'), end - timedelta(days=29))
+    except ValueError:
+        raise ValueError('from and to must be dates (YYYY-MM-DD)')
+    if start > end:
+        raise ValueError('from must not be after to')
+    if (end - start).days >= MAX_DAILY_RANGE:
+        raise ValueError(f'At most {MAX_DAILY_RANGE} days can be requested')
+    return start, end
+
+def daily_version():
+    """Snapshot version and the resolved range, which ends today unless ``to`` is given"""
+    return daily_summaries.version(), daily_range()
+
+@app.route('/api/analytics/daily', methods=['GET'])
+@verify_token
+@read_only
+@compressed
+@conditional_on(daily_version, validate=daily_range)
+def get_daily():
+    """Get precomputed daily summaries
+    ---
+    tags:
+      - Analytics Events
+    parameters:
+      - in: query
+        name: from
+        type: string
+        format: date
+        description: First day (YYYY-MM-DD, UTC); defaults to 29 days before to
+        required: false
+      - in: query
+        name: to
+        type: string
+        format: date
+        description: Last day (YYYY-MM-DD, UTC); defaults to today
+        required: false
+    responses:
+      200:
+        description: One snapshot per day that has one, oldest first; days still open have complete false
+        schema:
+          type: object
+          properties:
+            from:
+              type: string
+              format: date
+            to:
+              type: string
+              format: date
+            days:
+              type: array
+              items:
+                type: object
+                properties:
+                  date:
+                    type: string
+                    format: date
+                  complete:
+                    type: boolean
+                  watermark:
+                    type: string
+                    format: date-time
+                    description: Events before this moment are included
+                  computed_at:
+                    type: string
+                    format: date-time
+                  event_count:
+                    type: integer
+                  event_type_counts:
+                    type: object
+                    additionalProperties:
+                      type: integer
+                  active_users:
+                    type: integer
+                  top_pages:
+                    type: array
+                    items:
+                      type: object
+                      properties:
+                        page_path:
+                          type: string
+                        count:
+                          type: integer
+                  conversions:
+                    type: object
+                    description: Per conversion event, the active users that did it and their share
+                    example: {"purchase": {"users": 12, "rate": 0.08}}
+      304:
+        description: Not modified - the If-None-Match ETag is still current
+      400:
+        description: Bad request - invalid date or range
+      500:
+        description: Internal server error
+    """
+    try:
+        try:
+            start, end = daily_range()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        return jsonify({
+            'from': start.isoformat(),
+            'to': end.isoformat(),
+            'days': daily_summaries.snapshots(start, end)
+        }), 200
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/stream/token', methods=['POST'])
+@verify_token
+def create_stream_token():
+    """Issue a short-lived token for opening the event stream from a browser
+    ---
+    tags:
+      - Analytics Events
+    responses:
+      200:
+        description: >
+          Token to pass as the token query parameter of /api/analytics/stream,
+          which EventSource cannot authenticate with a header. It opens only the
+          stream and expires after expires_in seconds (an open stream stays open).
+    """
+    return jsonify({'token': issue_stream_token(request.user), 'expires_in': STREAM_TOKEN_SECONDS}), 200
+
+@app.route('/api/analytics/stream', methods=['GET'])
+@verify_stream_token
+def stream_events():
+    """Live feed of newly tracked events (Server-Sent Events)
+    ---
+    tags:
+      - Analytics Events
+    produces:
+      - text/event-stream
+    parameters:
+      - in: query
+        name: token
+        type: string
+        description: Stream token from /api/analytics/stream/token, instead of the Authorization header
+        required: false
+      - in: query
+        name: event_type
+        type: string
+        description: Only stream these event types (comma separated)
+        required: false
+      - in: query
+        name: user_id
+        type: integer
+        description: Only stream events of this user
+        required: false
+      - in: header
+        name: Last-Event-ID
+        type: integer
+        description: Resume after this event id (sent automatically by EventSource on reconnect)
+        required: false
+    responses:
+      200:
+        description: >
+          text/event-stream of analytics_event messages whose data is the event as JSON.
+          A gap event signals that the client fell behind and some events were skipped.
+          The feed is per server process: it carries the events accepted by the
+          instance the client is connected to, and event ids are only valid there.
+    """
+    event_type = request.args.get('event_type')
+    event_types = set(event_type.split(',')) if event_type else None
+    user_id = request.args.get('user_id', type=int)
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is None:
+        last_event_id = request.args.get('last_event_id', type=int)
+
+    return Response(
+        sse_messages(event_ring, last_event_id, event_types, user_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/analytics/users/<int:user_id>/summary', methods=['GET'])
+@verify_token
+@read_only
+def get_user_summary(user_id):
+    """Get the activity profile of a user
+    ---
+    tags:
+      - Analytics Events
+    parameters:
+      - in: path
+        name: user_id
+        type: integer
+        required: true
+        description: ID of the user
+    responses:
+      200:
+        description: User activity profile
+        schema:
+          type: object
+          properties:
+            user_id:
+              type: integer
+              example: 123
+            first_seen:
+              type: string
+              format: date-time
+            last_seen:
+              type: string
+              format: date-time
+            event_count:
+              type: integer
+              example: 42
+            event_type_counts:
+              type: object
+              additionalProperties:
+                type: integer
+              example:
+                page_view: 30
+                payment_completed: 2
+            last_page_path:
+              type: string
+              example: "/dashboard"
+            session_count:
+              type: integer
+              example: 5
+      404:
+        description: No activity recorded for this user
+      500:
+        description: Internal server error
+    """
+    try:
+        def load_profile(session):
+            profile = session.get(UserActivity, user_id)
+            return profile.to_dict() if profile else None
+        
+        shard = shard_set.shard_for(user_id)
+        profile = shard_set.run({shard: load_profile})[shard]
+        if profile is None:
+            return jsonify({'error': f'No activity recorded for user {user_id}'}), 404
+        
+        return jsonify(profile), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/alerts', methods=['GET'])
+@verify_token
+def get_rate_alerts():
+    """Get recent event rate alerts (newest first)
+    ---
+    tags:
+      - Analytics Events
+    parameters:
+      - in: query
+        name: user_id
+        type: integer
+        description: Only alerts for this user
+        required: false
+      - in: query
+        name: limit
+        type: integer
+        description: Maximum number of alerts to return
+        required: false
+        default: 100
+    responses:
+      200:
+        description: Recent alerts and the active rate rules
+        schema:
+          type: object
+          properties:
+            alerts:
+              type: array
+              items:
+                type: object
+                properties:
+                  rule:
+                    type: string
+                    example: login_failed_rate
+                  event_type:
+                    type: string
+                    example: login_failed
+                  user_id:
+                    type: integer
+                  ip_address:
+                    type: string
+                  count:
+                    type: integer
+                    example: 5
+                  threshold:
+                    type: integer
+                    example: 5
+                  window_seconds:
+                    type: number
+                    example: 60
+                  triggered_at:
+                    type: string
+                    format: date-time
+            rules:
+              type: array
+              items:
+                type: object
+      500:
+        description: Internal server error
+    """
+    try:
+        user_id = request.args.get('user_id', type=int)
+        limit = min(request.args.get('limit', 100, type=int), 1000)
+
+        return jsonify({
+            'alerts': rate_detector.recent_alerts(user_id, limit),
+            'rules': [rule.to_dict() for rules in rate_detector.rules.values() for rule in rules]
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/debug/slow-queries', methods=['GET'])
+@verify_token
+def get_slow_queries():
+    """Get recently recorded slow SQL statements (newest first)
+    ---
+    tags:
+      - Debug
+    parameters:
+      - in: query
+        name: endpoint
+        type: string
+        description: Only statements run by this endpoint (e.g. get_events)
+        required: false
+      - in: query
+        name: limit
+        type: integer
+        description: Maximum number of entries to return
+        required: false
+        default: 50
+    responses:
+      200:
+        description: Slow statements with their sampled EXPLAIN (ANALYZE, BUFFERS) plans
+        schema:
+          type: object
+          properties:
+            threshold_ms:
+              type: number
+              example: 200
+            queries:
+              type: array
+              items:
+                type: object
+                properties:
+                  statement:
+                    type: string
+                  parameters:
+                    type: string
+                  duration_ms:
+                    type: number
+                    example: 812.4
+                  database:
+                    type: string
+                  endpoint:
+                    type: string
+                    example: get_events
+                  path:
+                    type: string
+                  correlation_id:
+                    type: string
+                  recorded_at:
+                    type: string
+                    format: date-time
+                  plan:
+                    type: string
+                    description: Captured plan, or null when this statement was not sampled
+      500:
+        description: Internal server error
+    """
+    try:
+        endpoint = request.args.get('endpoint')
+        limit = min(request.args.get('limit', 50, type=int), 500)
+
+        return jsonify({
+            'threshold_ms': SLOW_QUERY_MS,
+            'queries': slow_query_log.entries(endpoint, limit)
+        }), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/analytics/debug/spool', methods=['GET'])
+@verify_token
+def get_spool_metrics():
+    """Get the state of the on-disk ingest spool
+    ---
+    tags:
+      - Debug
+    responses:
+      200:
+        description: Spool size and age, replay counters and the database health seen by ingest
+        schema:
+          type: object
+          properties:
+            enabled:
+              type: boolean
+            directory:
+              type: string
+            segments:
+              type: integer
+              example: 2
+            bytes:
+              type: integer
+              example: 1048576
+            max_bytes:
+              type: integer
+            oldest_event_age_seconds:
+              type: number
+              description: Age of the oldest event waiting for replay, null when the spool is empty
+              example: 12.5
+            spooled_events:
+              type: integer
+            replayed_events:
+              type: integer
+            dropped_events:
+              type: integer
+              description: Spooled events the database rejected during replay
+            corrupt_segments:
+              type: integer
+            quarantined_segments:
+              type: integer
+              description: Segments set aside after repeated replay failures (renamed to *.quarantined)
+            database_healthy:
+              type: boolean
+            database_unhealthy_reason:
+              type: string
+            database_unhealthy_since:
+              type: string
+              format: date-time
+      500:
+        description: Internal server error
+    """
+    try:
+        return jsonify(spool.metrics()), 200
+
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/analytics/event/<int:event_id>', methods=['PUT'])
 @verify_token
 def update_event(event_id):
@@ -615,29 +1690,32 @@ def update_event(event_id):
         description: Internal server error
     """
     try:
-        event = AnalyticsEvent.query.get_or_404(event_id)
         data = request.get_json()
         
         if not data:
             return jsonify({'error': 'No data provided'}), 400
         
-        # Update fields if provided
-        if 'event_type' in data:
-            event.event_type = data['event_type']
-        if 'user_id' in data:
-            event.user_id = data['user_id']
-        if 'session_id' in data:
-            event.session_id = data['session_id']
-        if 'page_path' in data:
-            event.page_path = data['page_path']
-        if 'metadata' in data:
-            event.event_metadata = data['metadata']
+        def update(session):
+            event = session.get(AnalyticsEvent, event_id)
+            if event is None:
+                return None
+            apply_event_update(session, event, data)
+            session.commit()
+            return event.to_dict()
         
-        db.session.commit()
+        shard = shard_set.shard_for_event_id(event_id)
+        try:
+            event = shard_set.run({shard: update})[shard]
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if event is None:
+            return jsonify({'error': f'Event {event_id} not found'}), 404
+        hot_window.update([event])
+        daily_summaries.reopen([parse_date(event['timestamp'])])
         
         return jsonify({
             'success': True,
-            'event': event.to_dict()
+            'event': event
         }), 200
         
     except Exception as e:
@@ -713,38 +1791,49 @@ def update_events_batch():
         if not data or 'updates' not in data:
             return jsonify({'error': 'updates array is required'}), 400
         
-        updated_count = 0
-        updated_events = []
+        # Group the updates by the shard that owns each event id
+        updates = [update_data for update_data in data['updates'] if 'id' in update_data]
+        groups = {}
+        for update_data in updates:
+            groups.setdefault(shard_set.shard_for_event_id(update_data['id']), []).append(update_data)
         
-        for update_data in data['updates']:
-            if 'id' not in update_data:
-                continue
-            
-            event = AnalyticsEvent.query.get(update_data['id'])
-            if not event:
-                continue
-            
-            # Update fields if provided
-            if 'event_type' in update_data:
-                event.event_type = update_data['event_type']
-            if 'user_id' in update_data:
-                event.user_id = update_data['user_id']
-            if 'session_id' in update_data:
-                event.session_id = update_data['session_id']
-            if 'page_path' in update_data:
-                event.page_path = update_data['page_path']
-            if 'metadata' in update_data:
-                event.event_metadata = update_data['metadata']
-            
-            updated_events.append(event)
-            updated_count += 1
+        def updater(shard_updates):
+            def update(session):
+                ids = [update_data['id'] for update_data in shard_updates]
+                events = {
+                    event.id: event
+                    for event in session.query(AnalyticsEvent).filter(AnalyticsEvent.id.in_(ids))
+                }
+                updated = {}
+                for update_data in shard_updates:
+                    event = events.get(update_data['id'])
+                    if event is not None:
+                        apply_event_update(session, event, update_data)
+                        updated[event.id] = event
+                session.commit()
+                return {event_id: event.to_dict() for event_id, event in updated.items()}
+            return update
+        
+        try:
+            updated = {}
+            for shard_updated in shard_set.run({shard: updater(group) for shard, group in groups.items()}).values():
+                updated.update(shard_updated)
+        except Exception as e:
+            # Other shards may have committed before one failed
+            hot_window.invalidate()
+            if isinstance(e, ValueError):
+                return jsonify({'error': str(e)}), 400
+            raise
+        hot_window.update(list(updated.values()))
+        daily_summaries.reopen(parse_date(event['timestamp']) for event in updated.values())
         
-        db.session.commit()
+        # Keep the request order
+        updated_events = [updated[event_id] for event_id in dict.fromkeys(u['id'] for u in updates) if event_id in updated]
         
         return jsonify({
             'success': True,
-            'count': updated_count,
-            'events': [e.to_dict() for e in updated_events]
+            'count': len(updated_events),
+            'events': updated_events
         }), 200
         
     except Exception as e:
@@ -778,14 +1867,29 @@ def delete_event(event_id):
               example: "Event 1 deleted successfully"
       404:
         description: Event not found
+      409:
+        description: The event was moved to the archive, which is read-only
       500:
         description: Internal server error
     """
     try:
-        event = AnalyticsEvent.query.get_or_404(event_id)
+        def delete(session):
+            event = session.get(AnalyticsEvent, event_id)
+            if event is None:
+                return None
+            forget_events(session, [(event.user_id, event.event_type_id)])
+            session.delete(event)
+            session.commit()
+            return event.timestamp
         
-        db.session.delete(event)
-        db.session.commit()
+        shard = shard_set.shard_for_event_id(event_id)
+        timestamp = shard_set.run({shard: delete})[shard]
+        if timestamp is None:
+            if cold_store.covers(None) and cold_store.contains(event_id):
+                return jsonify({'error': f'Event {event_id} is archived and cannot be deleted'}), 409
+            return jsonify({'error': f'Event {event_id} not found'}), 404
+        hot_window.forget(event_ids=[event_id])
+        daily_summaries.reopen([timestamp])
         
         return jsonify({
             'success': True,
@@ -841,6 +1945,10 @@ def delete_events():
             deleted_count:
               type: integer
               example: 5
+      409:
+        description: >
+          The range starts before the archive cutoff; archived events are
+          read-only, so start_date must not be older than the cutoff
       500:
         description: Internal server error
     """
@@ -851,24 +1959,24 @@ def delete_events():
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         
-        # Build query
-        query = AnalyticsEvent.query
-        
-        if user_id:
-            query = query.filter(AnalyticsEvent.user_id == user_id)
-        if event_type:
-            query = query.filter(AnalyticsEvent.event_type == event_type)
-        if start_date:
-            query = query.filter(AnalyticsEvent.timestamp >= datetime.fromisoformat(start_date))
-        if end_date:
-            query = query.filter(AnalyticsEvent.timestamp <= datetime.fromisoformat(end_date))
+        # Archived events would survive the delete and still be counted, so refuse it whole
+        if cold_store.reaches(parse_date(start_date)):
+            return jsonify({
+                'error': f'Events before {cold_store.cutoff.isoformat()} are archived and cannot be deleted; '
+                         'pass a start_date at or after it'
+            }), 409
         
-        # Get count before deletion
-        count = query.count()
+        def delete(session):
+            query = filter_events(session, user_id, event_type, start_date, end_date)
+            timestamps = delete_matching(session, query)
+            session.commit()
+            return timestamps
         
-        # Delete all matching events
-        query.delete(synchronize_session=False)
-        db.session.commit()
+        shards = [shard_set.shard_for(user_id)] if user_id else shard_set.all()
+        deleted = [timestamp for timestamps in shard_set.broadcast(delete, shards).values() for timestamp in timestamps]
+        count = len(deleted)
+        hot_window.forget(filters=(user_id, event_type, parse_date(start_date), parse_date(end_date)))
+        daily_summaries.reopen(deleted)
         
         return jsonify({
             'success': True,
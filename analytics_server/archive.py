@@ -0,0 +1,243 @@
+"""Cold storage tier: Parquet archive of old events and cross-tier queries.
+
+Events older than ARCHIVE_AFTER_DAYS are moved out of Postgres into zstd
+compressed Parquet files under ARCHIVE_DIR, hive partitioned by
+``date=YYYY-MM-DD/event_type=<name>``. DuckDB reads them back in process,
+pruning partitions and pushing the remaining predicates into the Parquet
+row-group statistics.
+
+Run the archiver with ``python archive.py`` (e.g. from cron).
+"""
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import orjson
+
+# Imported on first use: they are optional and slow down startup
+duckdb = pa = pq = None
+
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '365'))
+ARCHIVE_CHUNK_SIZE = int(os.getenv('ARCHIVE_CHUNK_SIZE', '100000'))
+
+STATE_FILE = '_archive_state.json'
+
+# Stored Parquet columns; metadata is kept as JSON text
+ARCHIVE_COLUMNS = (
+    'id', 'event_uuid', 'event_type', 'user_id', 'session_id', 'page_path',
+    'metadata', 'ip_address', 'user_agent', 'timestamp'
+)
+
+
+def _import_cold_tier():
+    """Import duckdb and pyarrow; returns False when they are not installed"""
+    global duckdb, pa, pq
+    if duckdb is None:
+        try:
+            import duckdb as duckdb_module
+            import pyarrow as pyarrow_module
+            import pyarrow.parquet as parquet_module
+        except ImportError:  # the cold tier is optional
+            return False
+        duckdb, pa, pq = duckdb_module, pyarrow_module, parquet_module
+    return True
+
+
+class ColdStore:
+    """Read side of the Parquet archive"""
+
+    def __init__(self, root=ARCHIVE_DIR):
+        self.root = root
+        self._connection = None
+
+    @property
+    def cutoff(self):
+        """Everything strictly older than this lives in the archive (None if nothing was archived)"""
+        try:
+            with open(os.path.join(self.root, STATE_FILE)) as f:
+                return datetime.fromisoformat(json.load(f)['cutoff'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def reaches(self, start_date):
+        """Whether a range starting at ``start_date`` (None = unbounded) reaches back before the cutoff"""
+        cutoff = self.cutoff
+        return cutoff is not None and (start_date is None or start_date < cutoff)
+
+    def covers(self, start_date):
+        """Whether a query starting at ``start_date`` (None = unbounded) reaches into the archive"""
+        return self.reaches(start_date) and _import_cold_tier()
+
+    def _scan(self, filters):
+        source = (
+            f"read_parquet('{os.path.join(self.root, '**', '*.parquet')}', hive_partitioning = true, "
+            "hive_types = {'date': DATE, 'event_type': VARCHAR}, union_by_name = true)"
+        )
+        clauses, params = [], []
+        user_id, event_type, start_date, end_date = filters
+        if user_id:
+            clauses.append('user_id = ?')
+            params.append(user_id)
+        if event_type:
+            clauses.append('event_type = ?')
+            params.append(event_type)
+        if start_date:
+            # The partition column prunes whole directories, timestamp prunes row groups
+            clauses.append('"date" >= ? AND "timestamp" >= ?')
+            params.extend([start_date.date(), start_date])
+        if end_date:
+            clauses.append('"date" <= ? AND "timestamp" <= ?')
+            params.extend([end_date.date(), end_date])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        return f'{source}{where}', params
+
+    def _execute(self, sql, params):
+        if self._connection is None:
+            self._connection = duckdb.connect()
+        return self._connection.cursor().execute(sql, params)
+
+    def count(self, filters):
+        source, params = self._scan(filters)
+        return self._execute(f'SELECT count(*) FROM {source}', params).fetchone()[0]
+
+    def events(self, filters, fields, limit, offset):
+        """Matching events as dictionaries, newest first"""
+        source, params = self._scan(filters)
+        columns = ', '.join(f'"{name}"' for name in fields)
+        rows = self._execute(
+            f'SELECT {columns} FROM {source} ORDER BY "timestamp" DESC LIMIT ? OFFSET ?',
+            params + [limit, offset]
+        ).fetchall()
+        events = [dict(zip(fields, row)) for row in rows]
+        if 'metadata' in fields:
+            for event in events:
+                event['metadata'] = orjson.loads(event['metadata']) if event['metadata'] else {}
+        return events
+
+    def contains(self, event_id):
+        source, params = self._scan((None, None, None, None))
+        return self._execute(f'SELECT count(*) FROM {source} WHERE id = ?', params + [event_id]).fetchone()[0] > 0
+
+    def event_type_counts(self, filters=(None, None, None, None)):
+        source, params = self._scan(filters)
+        rows = self._execute(f'SELECT event_type, count(*) FROM {source} GROUP BY event_type', params)
+        return dict(rows.fetchall())
+
+
+cold_store = ColdStore()
+
+
+# --- Archiver ---------------------------------------------------------------
+
+def _archive_schema():
+    return pa.schema([
+        ('id', pa.int64()),
+        ('event_uuid', pa.string()),
+        ('event_type', pa.string()),
+        ('user_id', pa.int64()),
+        ('session_id', pa.string()),
+        ('page_path', pa.string()),
+        ('metadata', pa.string()),
+        ('ip_address', pa.string()),
+        ('user_agent', pa.string()),
+        ('timestamp', pa.timestamp('us')),
+        ('date', pa.string()),
+    ])
+
+
+def _write_state(root, cutoff):
+    path = os.path.join(root, STATE_FILE)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump({'cutoff': cutoff.isoformat()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}.tmp', path)
+
+
+def archive_events(session, older_than_days=ARCHIVE_AFTER_DAYS, root=ARCHIVE_DIR, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """Move events older than ``older_than_days`` (rounded down to midnight) into Parquet.
+
+    Works in chunks of ``chunk_size`` rows: each chunk is written to disk
+    before it is deleted from Postgres and committed, so a crash can at worst
+    leave a chunk in both tiers, never in neither. Returns the number of
+    archived events.
+    """
+    from sqlalchemy import delete, text
+    from models import AnalyticsEvent
+
+    if not _import_cold_tier():
+        raise RuntimeError('pyarrow and duckdb are required for archiving')
+
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).replace(hour=0, minute=0, second=0, microsecond=0)
+    previous = ColdStore(root).cutoff
+
+    select_chunk = text("""
+        SELECT e.id, e.event_uuid::text, t.value, e.user_id, e.session_id, p.value,
+               e.event_metadata::text, e.ip_address, u.value, e.timestamp
+        FROM analytics_events e
+        JOIN event_types t ON t.id = e.event_type_id
+        LEFT JOIN page_paths p ON p.id = e.page_path_id
+        LEFT JOIN user_agents u ON u.id = e.user_agent_id
+        WHERE e.timestamp < :cutoff
+        ORDER BY e.id
+        LIMIT :limit
+    """)
+
+    archived = 0
+    while True:
+        rows = session.execute(select_chunk, {'cutoff': cutoff, 'limit': chunk_size}).all()
+        if not rows:
+            break
+        if previous is None or cutoff > previous:
+            # Published before any row moves so that readers already consult the archive
+            os.makedirs(root, exist_ok=True)
+            _write_state(root, cutoff)
+            previous = cutoff
+
+        columns = {name: [row[i] for row in rows] for i, name in enumerate(ARCHIVE_COLUMNS)}
+        columns['date'] = [ts.strftime('%Y-%m-%d') for ts in columns['timestamp']]
+        pq.write_to_dataset(
+            pa.table(columns, schema=_archive_schema()),
+            root,
+            partition_cols=['date', 'event_type'],
+            compression='zstd',
+            basename_template=f'part-{rows[0][0]}-{uuid.uuid4().hex[:8]}-{{i}}.parquet',
+            existing_data_behavior='overwrite_or_ignore'
+        )
+
+        session.execute(
+            delete(AnalyticsEvent).where(AnalyticsEvent.id.in_(columns['id'])),
+            execution_options={'synchronize_session': False}
+        )
+        session.commit()
+        archived += len(rows)
+        print(f"Archived {archived} events older than {cutoff.isoformat()}")
+
+    return archived
+
+
+if __name__ == '__main__':
+    import argparse
+    from flask import Flask
+    from models import db
+
+    parser = argparse.ArgumentParser(description='Move old analytics events into the Parquet archive')
+    parser.add_argument('--older-than-days', type=int, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR)
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+        'DATABASE_URL', 'postgresql://analytics_user:analytics_pass@db:5432/analytics_db'
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    from shards import shard_set
+
+    with app.app_context():
+        # Shard by shard (db.session when unsharded); they share one archive and cutoff
+        for shard in shard_set.all():
+            shard_set.run({shard: lambda session: archive_events(session, args.older_than_days, args.archive_dir)})
@@ -3,10 +3,23 @@ from flask import request, jsonify
 import jwt
 import os
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta
 
 JWT_SECRET = os.getenv('JWT_SECRET', 'your-secret-key')
 AUTH_SERVICE_URL = os.getenv('AUTH_SERVICE_URL', 'http://auth-service:3001')
+STREAM_TOKEN_SECONDS = int(os.getenv('STREAM_TOKEN_SECONDS', '60'))
+
+# Scope claim of the tokens issued by issue_stream_token
+STREAM_TOKEN_SCOPE = 'analytics_stream'
+
+
+def _request_user(decoded):
+    return {
+        'userId': decoded.get('sub') or decoded.get('userId'),
+        'sub': decoded.get('sub'),
+        'name': decoded.get('name'),
+        'email': decoded.get('email')
+    }
 
 def verify_token(f):
     """
@@ -25,14 +38,11 @@ def verify_token(f):
         try:
             # Verify JWT locally using shared secret
             decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+            if decoded.get('scope') == STREAM_TOKEN_SCOPE:
+                return jsonify({'error': 'Invalid token', 'details': 'Stream tokens only open the event stream'}), 401
             
             # Attach user info to request
-            request.user = {
-                'userId': decoded.get('sub') or decoded.get('userId'),
-                'sub': decoded.get('sub'),
-                'name': decoded.get('name'),
-                'email': decoded.get('email')
-            }
+            request.user = _request_user(decoded)
             
             return f(*args, **kwargs)
         except jwt.ExpiredSignatureError:
@@ -44,6 +54,51 @@ def verify_token(f):
     
     return decorated_function
 
+def issue_stream_token(user):
+    """Short-lived token that only opens the live event stream.
+
+    Browsers' EventSource cannot send an Authorization header, so the stream
+    also accepts this token as the ``token`` query parameter. URLs end up in
+    access logs, hence the narrow scope and the short lifetime.
+    """
+    now = datetime.utcnow()
+    claims = {
+        'scope': STREAM_TOKEN_SCOPE,
+        'name': user.get('name'),
+        'email': user.get('email'),
+        'iat': now,
+        'exp': now + timedelta(seconds=STREAM_TOKEN_SECONDS)
+    }
+    if user.get('userId') is not None:
+        claims['sub'] = str(user['userId'])
+    return jwt.encode(claims, JWT_SECRET, algorithm='HS256')
+
+def verify_stream_token(f):
+    """
+    Decorator for the event stream: verify_token, or a stream token from
+    issue_stream_token in the ``token`` query parameter
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = request.args.get('token')
+        if not token:
+            return verify_token(f)(*args, **kwargs)
+        
+        try:
+            decoded = jwt.decode(token, JWT_SECRET, algorithms=['HS256'])
+        except jwt.ExpiredSignatureError:
+            return jsonify({'error': 'Token expired', 'details': 'Request a new stream token.'}), 401
+        except jwt.InvalidTokenError as e:
+            return jsonify({'error': 'Invalid token', 'details': f'Token verification failed: {str(e)}'}), 401
+        if decoded.get('scope') != STREAM_TOKEN_SCOPE:
+            # Long-lived tokens must not travel in URLs
+            return jsonify({'error': 'Invalid token', 'details': 'Only stream tokens are accepted as a query parameter'}), 401
+        
+        request.user = _request_user(decoded)
+        return f(*args, **kwargs)
+    
+    return decorated_function
+
 def verify_token_via_service(f):
     """
     Decorator to verify JWT token by calling auth-service
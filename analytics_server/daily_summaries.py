@@ -0,0 +1,310 @@
+"""Materialized daily KPI snapshots.
+
+A scheduler thread refreshes one row per UTC day in daily_summaries:
+event counts per type, active users, top pages and, for every event type
+in DAILY_CONVERSION_EVENTS, how many of the active users did it. The
+dashboards read these rows instead of scanning analytics_events.
+
+* A day that closed more than DAILY_CLOSE_DELAY_MINUTES ago is computed
+  once from all of its events and marked complete. The delay leaves room
+  for late (e.g. spooled) events. Writes that still land in a closed day
+  (spool and queue replays, deletes, updates) call ``reopen``, which clears
+  the complete flag; the next refresh rebuilds the day from scratch and
+  closes it again.
+* Open days (today, and yesterday during the delay) are refreshed every
+  DAILY_REFRESH_SECONDS. Only events since the row's watermark are scanned
+  and added to the counters kept in the row; a user counts as newly active
+  if they have no earlier event that day. The watermark trails the clock
+  by DAILY_REFRESH_LAG_SECONDS so that inserts still in flight are not
+  skipped. Anything that still slips past is corrected when the day closes.
+  The kept counters hold only the DAILY_STATE_PAGES busiest pages, the
+  rest is summed up as ``other_pages``, so the open day's top pages are
+  approximate until it closes.
+
+Every web process runs the scheduler, but a Postgres advisory lock lets
+only one of them refresh at a time. Snapshots are stored on the first
+shard; counts come from all shards and are added up (users never span
+shards). Like retention, only events still in Postgres are considered.
+"""
+import os
+import threading
+import time
+import zlib
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, null, select, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from dimensions import event_types, page_paths
+from models import AnalyticsEvent, DailySummary, db
+from replicas import primary_bind
+from shards import shard_set
+
+DAILY_SUMMARIES_ENABLED = os.getenv('DAILY_SUMMARIES_ENABLED', 'true').lower() == 'true'
+DAILY_REFRESH_SECONDS = float(os.getenv('DAILY_REFRESH_SECONDS', '300'))
+DAILY_REFRESH_LAG_SECONDS = float(os.getenv('DAILY_REFRESH_LAG_SECONDS', '60'))
+DAILY_CLOSE_DELAY_MINUTES = float(os.getenv('DAILY_CLOSE_DELAY_MINUTES', '60'))
+DAILY_BACKFILL_DAYS = int(os.getenv('DAILY_BACKFILL_DAYS', '30'))
+DAILY_TOP_PAGES = int(os.getenv('DAILY_TOP_PAGES', '10'))
+DAILY_STATE_PAGES = int(os.getenv('DAILY_STATE_PAGES', '1000'))
+DAILY_CONVERSION_EVENTS = [
+    name.strip() for name in os.getenv('DAILY_CONVERSION_EVENTS', 'purchase').split(',') if name.strip()
+]
+MAX_DAILY_RANGE = 366
+
+# pg_try_advisory_lock key shared by every process refreshing the snapshots
+REFRESH_LOCK_KEY = zlib.crc32(b'daily_summaries')
+
+COUNTS_SQL = """
+SELECT event_type_id, page_path_id, count(*)
+FROM analytics_events
+WHERE timestamp >= :start AND timestamp < :end
+GROUP BY event_type_id, page_path_id
+"""
+
+# Users active in [start, end); with ``earlier`` only those without an event between day_start and start
+NEW_USERS_SQL = """
+SELECT {group_column}, count(DISTINCT e.user_id)
+FROM analytics_events e
+WHERE e.user_id IS NOT NULL AND e.timestamp >= :start AND e.timestamp < :end {type_filter}
+{earlier}
+GROUP BY 1
+"""
+EARLIER_SQL = """AND NOT EXISTS (
+    SELECT 1 FROM analytics_events p
+    WHERE p.user_id = e.user_id AND p.timestamp >= :day_start AND p.timestamp < :start {type_match}
+)"""
+
+
+def _new_users(session, params, type_ids=None, earlier=False):
+    """``{event_type_id or None: users}`` first active in the window"""
+    sql = NEW_USERS_SQL.format(
+        group_column='e.event_type_id' if type_ids else 'NULL',
+        type_filter='AND e.event_type_id IN :type_ids' if type_ids else '',
+        earlier=EARLIER_SQL.format(type_match='AND p.event_type_id = e.event_type_id' if type_ids else '') if earlier else ''
+    )
+    if type_ids:
+        params = dict(params, type_ids=tuple(type_ids))
+    return dict(session.execute(text(sql), params).all())
+
+
+def _shard_counters(session, day_start, start, end):
+    """Counters of one shard's events in [start, end) that are new for the day"""
+    params = {'day_start': day_start, 'start': start, 'end': end}
+    earlier = start > day_start
+    rows = session.execute(text(COUNTS_SQL), params).all()
+    names = event_types.values_for(session, [type_id for type_id, _, _ in rows])
+    paths = page_paths.values_for(session, [path_id for _, path_id, _ in rows])
+
+    counters = {'event_type_counts': {}, 'page_counts': {}, 'active_users': 0, 'converted_users': {}}
+    for type_id, path_id, count in rows:
+        name = names[type_id]
+        counters['event_type_counts'][name] = counters['event_type_counts'].get(name, 0) + count
+        if path_id is not None:
+            counters['page_counts'][paths[path_id]] = counters['page_counts'].get(paths[path_id], 0) + count
+    if not rows:
+        return counters
+
+    counters['active_users'] = sum(_new_users(session, params, earlier=earlier).values())
+    type_ids = {event_types.id_for(session, name): name for name in DAILY_CONVERSION_EVENTS}
+    type_ids.pop(None, None)
+    if type_ids:
+        for type_id, users in _new_users(session, params, list(type_ids), earlier).items():
+            counters['converted_users'][type_ids[type_id]] = users
+    return counters
+
+
+def add_counters(total, counters):
+    total['active_users'] += counters['active_users']
+    total['other_pages'] = total.get('other_pages', 0) + counters.get('other_pages', 0)
+    for field in ('event_type_counts', 'page_counts', 'converted_users'):
+        for key, value in counters[field].items():
+            total[field][key] = total[field].get(key, 0) + value
+    return total
+
+
+def trim_pages(counters, keep=DAILY_STATE_PAGES):
+    """``counters`` with only the ``keep`` busiest pages; the views of the others move to other_pages"""
+    if len(counters['page_counts']) <= keep:
+        return counters
+    pages = sorted(counters['page_counts'].items(), key=lambda item: (-item[1], item[0]))
+    other_pages = counters.get('other_pages', 0) + sum(count for _, count in pages[keep:])
+    return dict(counters, page_counts=dict(pages[:keep]), other_pages=other_pages)
+
+
+def summarize(counters):
+    """The served snapshot from the full counters of a day"""
+    active_users = counters['active_users']
+    pages = sorted(counters['page_counts'].items(), key=lambda item: (-item[1], item[0]))
+    return {
+        'event_count': sum(counters['event_type_counts'].values()),
+        'event_type_counts': counters['event_type_counts'],
+        'active_users': active_users,
+        'top_pages': [{'page_path': path, 'count': count} for path, count in pages[:DAILY_TOP_PAGES]],
+        'conversions': {
+            name: {
+                'users': counters['converted_users'].get(name, 0),
+                'rate': round(counters['converted_users'].get(name, 0) / active_users, 4) if active_users else 0.0
+            }
+            for name in DAILY_CONVERSION_EVENTS
+        },
+    }
+
+
+class DailySummaries:
+    def _on_primary(self, task):
+        # Snapshots live on the first shard (the only database when unsharded)
+        return shard_set.run({0: task})[0]
+
+    def _counters(self, day_start, start, end):
+        total = {'event_type_counts': {}, 'page_counts': {}, 'active_users': 0, 'converted_users': {}}
+        for counters in shard_set.broadcast(lambda session: _shard_counters(session, day_start, start, end)).values():
+            add_counters(total, counters)
+        return total
+
+    def _first_open_day(self, today):
+        """Day after the newest complete snapshot, or the oldest event day within the backfill window"""
+        newest = self._on_primary(
+            lambda session: session.query(func.max(DailySummary.day)).filter(DailySummary.complete).scalar()
+        )
+        if newest is not None:
+            return newest + timedelta(days=1)
+        oldest = [
+            moment for moment in shard_set.broadcast(
+                lambda session: session.query(func.min(AnalyticsEvent.timestamp)).scalar()
+            ).values() if moment is not None
+        ]
+        first = min(oldest).date() if oldest else today
+        return max(first, today - timedelta(days=DAILY_BACKFILL_DAYS))
+
+    def _save(self, day, complete, watermark, counters):
+        values = {
+            'day': day,
+            'complete': complete,
+            'watermark': watermark,
+            'computed_at': datetime.utcnow(),
+            'summary': summarize(counters),
+            'state': null() if complete else trim_pages(counters),
+        }
+        statement = pg_insert(DailySummary).values(**values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[DailySummary.day],
+            set_={name: statement.excluded[name] for name in values if name != 'day'},
+            # Complete snapshots are only rewritten after ``reopen``
+            where=DailySummary.complete.is_(False)
+        )
+
+        def save(session):
+            session.execute(statement)
+            session.commit()
+        self._on_primary(save)
+
+    def refresh(self, now=None):
+        """Close finished days and bring open ones up to date; returns the days written"""
+        now = now or datetime.utcnow()
+        today = now.date()
+        close_delay = timedelta(minutes=DAILY_CLOSE_DELAY_MINUTES)
+        day = self._first_open_day(today)
+        partials = {
+            row.day: row for row in self._on_primary(
+                lambda session: session.query(DailySummary).filter(DailySummary.complete.is_(False)).all()
+            )
+        }
+
+        written = []
+        # Reopened days before the open ones are rebuilt from all of their events
+        for reopened in sorted(partial for partial in partials if partial < day):
+            reopened_start = datetime.combine(reopened, datetime.min.time())
+            reopened_end = reopened_start + timedelta(days=1)
+            self._save(reopened, True, reopened_end, self._counters(reopened_start, reopened_start, reopened_end))
+            written.append(reopened)
+
+        while day <= today:
+            day_start = datetime.combine(day, datetime.min.time())
+            day_end = day_start + timedelta(days=1)
+            if now >= day_end + close_delay:
+                self._save(day, True, day_end, self._counters(day_start, day_start, day_end))
+                written.append(day)
+            else:
+                partial = partials.get(day)
+                start = partial.watermark if partial is not None else day_start
+                end = min(now - timedelta(seconds=DAILY_REFRESH_LAG_SECONDS), day_end)
+                if end > start or partial is None:
+                    counters = self._counters(day_start, start, max(start, end))
+                    if partial is not None:
+                        counters = add_counters(counters, partial.state)
+                    self._save(day, False, max(start, end), counters)
+                    written.append(day)
+            day += timedelta(days=1)
+        return written
+
+    def reopen(self, moments, now=None):
+        """Have the next refresh rebuild the closed days containing ``moments`` (event timestamps)"""
+        closed_before = ((now or datetime.utcnow()) - timedelta(minutes=DAILY_CLOSE_DELAY_MINUTES)).date()
+        days = {moment.date() for moment in moments if moment is not None and moment.date() < closed_before}
+        if not days:
+            return
+
+        def reopen(session):
+            session.execute(
+                update(DailySummary).where(DailySummary.day.in_(days), DailySummary.complete)
+                .values(complete=False, state=null())
+            )
+            session.commit()
+        self._on_primary(reopen)
+
+    def observe_rows(self, rows, results):
+        """Spool listener: replayed events may belong to days that have closed since"""
+        self.reopen(result.timestamp for result in results)
+
+    def refresh_exclusive(self, now=None):
+        """``refresh`` unless another process holds the refresh lock; returns None then"""
+        engine = shard_set.engine(0) if shard_set.sharded else db.engine
+        with engine.connect() as connection:
+            # A session level lock: it outlives the transaction and is released if the process dies
+            if not connection.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': REFRESH_LOCK_KEY}).scalar():
+                return None
+            connection.commit()
+            try:
+                return self.refresh(now)
+            finally:
+                connection.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': REFRESH_LOCK_KEY})
+                connection.commit()
+
+    def version(self):
+        """Time of the newest snapshot write, read from the primary; the ETag version of the snapshots"""
+        return self._on_primary(lambda session: session.execute(
+            select(func.max(DailySummary.computed_at)), bind_arguments={'bind': primary_bind(session)}
+        ).scalar())
+
+    def snapshots(self, start, end):
+        """Snapshots of the days from ``start`` to ``end`` (inclusive) that exist, oldest first"""
+        return self._on_primary(lambda session: [
+            row.to_dict() for row in session.query(DailySummary).filter(
+                DailySummary.day >= start, DailySummary.day <= end
+            ).order_by(DailySummary.day)
+        ])
+
+    def start_scheduler(self, app):
+        """Refresh every DAILY_REFRESH_SECONDS on a daemon thread"""
+        def run():
+            with app.app_context():
+                while True:
+                    try:
+                        self.refresh_exclusive()
+                    except Exception as e:
+                        db.session.rollback()
+                        print(f"Daily summary refresh failed: {str(e).splitlines()[0]}")
+                    time.sleep(DAILY_REFRESH_SECONDS)
+
+        thread = threading.Thread(target=run, name='daily-summaries', daemon=True)
+        thread.start()
+        return thread
+
+
+def parse_day(value, default):
+    """A YYYY-MM-DD query value; raises ValueError"""
+    return date.fromisoformat(value) if value else default
+
+
+daily_summaries = DailySummaries()
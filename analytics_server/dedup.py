@@ -0,0 +1,59 @@
+"""In-memory Bloom filter used to skip duplicate checks for fresh event ids"""
+import hashlib
+import math
+import os
+import threading
+
+
+class RotatingBloomFilter:
+    """Two-generation Bloom filter with bounded memory.
+
+    New keys go into the active generation. Once it holds ``capacity`` keys
+    the older generation is dropped and a fresh one takes over, so membership
+    covers roughly the last ``capacity`` to ``2 * capacity`` keys.
+
+    A negative answer is definite: the key was not added within that window.
+    A positive answer may be a false positive (``error_rate``).
+    """
+
+    def __init__(self, capacity=1_000_000, error_rate=0.001):
+        self.capacity = capacity
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self._active = bytearray((self.num_bits + 7) // 8)
+        self._previous = bytearray(len(self._active))
+        self._active_count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    @staticmethod
+    def _test(bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    def add(self, key):
+        positions = self._positions(key)
+        with self._lock:
+            if self._active_count >= self.capacity:
+                self._previous = self._active
+                self._active = bytearray(len(self._previous))
+                self._active_count = 0
+            bits = self._active
+            for p in positions:
+                bits[p >> 3] |= 1 << (p & 7)
+            self._active_count += 1
+
+    def __contains__(self, key):
+        positions = self._positions(key)
+        return self._test(self._active, positions) or self._test(self._previous, positions)
+
+
+# Process wide filter of recently ingested event UUIDs
+seen_event_ids = RotatingBloomFilter(
+    capacity=int(os.getenv('DEDUP_BLOOM_CAPACITY', '1000000')),
+    error_rate=float(os.getenv('DEDUP_BLOOM_ERROR_RATE', '0.001'))
+)
@@ -0,0 +1,163 @@
+"""Sliding-window rate detectors for abuse signals.
+
+Each rule counts one event type per actor (user_id, or client IP for
+anonymous events) over a sliding window. Windows are split into a fixed
+number of buckets, so recording an event touches a constant amount of state.
+Counters for idle actors are evicted LRU-first once MAX_TRACKED_KEYS is
+reached.
+
+Rules come from the RATE_RULES environment variable, a JSON list such as
+``[{"event_type": "login_failed", "threshold": 5, "window_seconds": 60}]``.
+With RATE_ALERTS_PUBLISH=true alerts are also sent to the logs exchange as
+WARN entries. State and alerts are local to the process.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+BUCKETS_PER_WINDOW = 10
+MAX_TRACKED_KEYS = int(os.getenv('RATE_MAX_TRACKED_KEYS', '100000'))
+MAX_ALERTS = int(os.getenv('RATE_MAX_ALERTS', '1000'))
+RATE_ALERTS_PUBLISH = os.getenv('RATE_ALERTS_PUBLISH', 'false').lower() == 'true'
+
+DEFAULT_RULES = [
+    {'event_type': 'login_failed', 'threshold': 5, 'window_seconds': 60},
+    {'event_type': 'password_reset', 'threshold': 3, 'window_seconds': 3600},
+    {'event_type': 'payment_initiated', 'threshold': 20, 'window_seconds': 60},
+    {'event_type': 'payment_failed', 'threshold': 5, 'window_seconds': 300},
+]
+
+
+class SlidingWindowCounter:
+    """Bucketed count of events in the last ``window_seconds``"""
+    __slots__ = ('buckets', 'last_bucket', 'total', 'alerted_bucket')
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS_PER_WINDOW
+        self.last_bucket = None
+        self.total = 0
+        self.alerted_bucket = None
+
+    def add(self, bucket):
+        if self.last_bucket is None or bucket - self.last_bucket >= BUCKETS_PER_WINDOW:
+            self.buckets = [0] * BUCKETS_PER_WINDOW
+            self.total = 0
+        elif bucket > self.last_bucket:
+            # Expire the buckets that slid out of the window (at most BUCKETS_PER_WINDOW)
+            for expired in range(self.last_bucket + 1, bucket + 1):
+                slot = expired % BUCKETS_PER_WINDOW
+                self.total -= self.buckets[slot]
+                self.buckets[slot] = 0
+        if self.last_bucket is None or bucket > self.last_bucket:
+            self.last_bucket = bucket
+        self.buckets[bucket % BUCKETS_PER_WINDOW] += 1
+        self.total += 1
+        return self.total
+
+
+class RateRule:
+    def __init__(self, event_type, threshold, window_seconds, name=None):
+        self.event_type = event_type
+        self.threshold = int(threshold)
+        self.window_seconds = float(window_seconds)
+        self.name = name or f'{event_type}_rate'
+        self.bucket_seconds = self.window_seconds / BUCKETS_PER_WINDOW
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'event_type': self.event_type,
+            'threshold': self.threshold,
+            'window_seconds': self.window_seconds
+        }
+
+
+class RateDetector:
+    def __init__(self, rules, max_keys=MAX_TRACKED_KEYS, max_alerts=MAX_ALERTS):
+        self.rules = {}
+        for rule in rules:
+            self.rules.setdefault(rule.event_type, []).append(rule)
+        self.max_keys = max_keys
+        self._counters = OrderedDict()
+        self._alerts = deque(maxlen=max_alerts)
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def add_listener(self, callback):
+        """Call ``callback(alert)`` for every new alert"""
+        self._listeners.append(callback)
+
+    def observe(self, event_type, user_id=None, ip_address=None, now=None):
+        """Count one event; returns the alerts it triggered"""
+        rules = self.rules.get(event_type)
+        if not rules:
+            return []
+        actor = user_id if user_id is not None else f'ip:{ip_address}'
+        now = time.monotonic() if now is None else now
+
+        triggered = []
+        with self._lock:
+            for rule in rules:
+                key = (rule.name, actor)
+                counter = self._counters.get(key)
+                if counter is None:
+                    if len(self._counters) >= self.max_keys:
+                        self._counters.popitem(last=False)
+                    counter = self._counters[key] = SlidingWindowCounter()
+                else:
+                    self._counters.move_to_end(key)
+
+                bucket = int(now // rule.bucket_seconds)
+                count = counter.add(bucket)
+                # Alert once per window per actor
+                recently_alerted = (
+                    counter.alerted_bucket is not None
+                    and bucket - counter.alerted_bucket < BUCKETS_PER_WINDOW
+                )
+                if count >= rule.threshold and not recently_alerted:
+                    counter.alerted_bucket = bucket
+                    alert = {
+                        'rule': rule.name,
+                        'event_type': event_type,
+                        'user_id': user_id,
+                        'ip_address': ip_address,
+                        'count': count,
+                        'threshold': rule.threshold,
+                        'window_seconds': rule.window_seconds,
+                        'triggered_at': datetime.utcnow().isoformat()
+                    }
+                    self._alerts.append(alert)
+                    triggered.append(alert)
+
+        for alert in triggered:
+            for listener in self._listeners:
+                listener(alert)
+        return triggered
+
+    def observe_rows(self, rows, results=None):
+        """Count accepted ingest rows, skipping acknowledged duplicates"""
+        for index, row in enumerate(rows):
+            if results and results[index].deduplicated:
+                continue
+            self.observe(row['event_type'], row.get('user_id'), row.get('ip_address'))
+
+    def recent_alerts(self, user_id=None, limit=100):
+        """Up to ``limit`` alerts, newest first"""
+        if limit <= 0:
+            return []
+        with self._lock:
+            alerts = list(self._alerts)
+        if user_id is not None:
+            alerts = [alert for alert in alerts if alert['user_id'] == user_id]
+        return alerts[-limit:][::-1]
+
+
+def load_rules():
+    raw = os.getenv('RATE_RULES')
+    return [RateRule(**rule) for rule in (json.loads(raw) if raw else DEFAULT_RULES)]
+
+
+rate_detector = RateDetector(load_rules())
@@ -0,0 +1,177 @@
+"""Dictionary encoding for repetitive event columns.
+
+event_type, page_path and user_agent are stored once in small lookup tables
+and referenced from analytics_events by integer id. A bidirectional cache per
+table lets ingest resolve ids and query endpoints decode them without a round
+trip in the common case. Ids are only meaningful within one database, so each
+database (shard) the cache is used with gets its own mappings.
+"""
+import hashlib
+import os
+import threading
+
+from sqlalchemy import false, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db, AnalyticsEvent, EventType, PagePath, UserAgent
+
+CACHE_SIZE = int(os.getenv('DIMENSION_CACHE_SIZE', '100000'))
+
+
+class DimensionCache:
+    """Bidirectional value <-> id cache in front of one lookup table.
+
+    Unknown values are interned on a separate, immediately committed
+    connection so that a rolled back event transaction never leaves cached
+    ids pointing at rows that do not exist. When the cache outgrows
+    ``max_entries`` it is simply cleared and refilled on demand.
+    """
+
+    def __init__(self, model, hashed=False, max_entries=CACHE_SIZE):
+        self.model = model
+        self.hashed = hashed
+        self.max_entries = max_entries
+        # database url -> (value -> id, id -> value)
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+    def _key_filter(self, values):
+        if self.hashed:
+            return self.model.value_hash.in_([self._hash(value) for value in values])
+        return self.model.value.in_(values)
+
+    def _row(self, value):
+        if self.hashed:
+            return {'value': value, 'value_hash': self._hash(value)}
+        return {'value': value}
+
+    def _maps(self, session):
+        url = session.get_bind(self.model).url
+        maps = self._databases.get(url)
+        if maps is None:
+            with self._lock:
+                maps = self._databases.setdefault(url, ({}, {}))
+        return maps
+
+    def _remember(self, maps, pairs):
+        ids, values = maps
+        with self._lock:
+            if len(ids) + len(pairs) > self.max_entries:
+                ids.clear()
+                values.clear()
+            for value, value_id in pairs:
+                ids[value] = value_id
+                values[value_id] = value
+
+    def ids_for(self, session, values, create=True):
+        """Map values to ids; unknown values are interned unless ``create`` is False"""
+        session = session or db.session
+        maps = self._maps(session)
+        result = {}
+        missing = set()
+        for value in values:
+            if value is None or value in result:
+                continue
+            value_id = maps[0].get(value)
+            if value_id is None:
+                missing.add(value)
+            else:
+                result[value] = value_id
+        if not missing:
+            return result
+
+        missing = sorted(missing)
+        if create:
+            intern = pg_insert(self.model).on_conflict_do_nothing()
+            # Passing the insert routes interning to the primary even during read-only requests
+            with session.get_bind(clause=intern).begin() as connection:
+                # Sorted inserts keep concurrent interning from deadlocking
+                connection.execute(intern, [self._row(v) for v in missing])
+                fetched = connection.execute(
+                    select(self.model.value, self.model.id).where(self._key_filter(missing))
+                ).all()
+        else:
+            fetched = session.execute(
+                select(self.model.value, self.model.id).where(self._key_filter(missing))
+            ).all()
+
+        self._remember(maps, fetched)
+        result.update(fetched)
+        return result
+
+    def id_for(self, session, value, create=False):
+        if value is None:
+            return None
+        return self.ids_for(session, [value], create=create).get(value)
+
+    def values_for(self, session, ids):
+        """Map ids back to their values"""
+        session = session or db.session
+        maps = self._maps(session)
+        result = {}
+        missing = set()
+        for value_id in ids:
+            if value_id is None or value_id in result:
+                continue
+            value = maps[1].get(value_id)
+            if value is None:
+                missing.add(value_id)
+            else:
+                result[value_id] = value
+        if missing:
+            fetched = session.execute(
+                select(self.model.value, self.model.id).where(self.model.id.in_(missing))
+            ).all()
+            self._remember(maps, fetched)
+            result.update((value_id, value) for value, value_id in fetched)
+        return result
+
+    def value_for(self, session, value_id):
+        if value_id is None:
+            return None
+        return self.values_for(session, [value_id]).get(value_id)
+
+
+event_types = DimensionCache(EventType)
+page_paths = DimensionCache(PagePath)
+user_agents = DimensionCache(UserAgent, hashed=True)
+
+# Public (string) field -> (id column name, cache)
+ENCODED_FIELDS = {
+    'event_type': ('event_type_id', event_types),
+    'page_path': ('page_path_id', page_paths),
+    'user_agent': ('user_agent_id', user_agents),
+}
+
+
+def encode_rows(session, rows):
+    """Return copies of ingest rows with string dimensions replaced by ids"""
+    encoded = [dict(row) for row in rows]
+    for field, (id_column, cache) in ENCODED_FIELDS.items():
+        ids = cache.ids_for(session, [row.get(field) for row in rows])
+        for row in encoded:
+            row[id_column] = ids.get(row.pop(field, None))
+    return encoded
+
+
+def decode_dicts(session, dicts):
+    """Replace dimension ids with their string values in place (keys keep their public names)"""
+    if not dicts:
+        return dicts
+    for field, (_, cache) in ENCODED_FIELDS.items():
+        if field not in dicts[0]:
+            continue
+        values = cache.values_for(session, [item[field] for item in dicts])
+        for item in dicts:
+            item[field] = values.get(item[field])
+    return dicts
+
+
+def event_type_filter(session, value):
+    """WHERE clause for an event_type string; unknown types match nothing"""
+    value_id = event_types.id_for(session, value)
+    return AnalyticsEvent.event_type_id == value_id if value_id is not None else false()
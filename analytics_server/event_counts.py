@@ -0,0 +1,65 @@
+"""Totals for event listings, at the precision the caller is willing to pay for.
+
+``exact``      count(*) over every matching row.
+``capped``     count at most EVENTS_COUNT_CAP + 1 rows; beyond that the total
+               is reported as a lower bound ("10000+").
+``estimated``  the per-user rollup in user_activity when only user_id (and
+               event_type) filter, otherwise the planner's row estimate.
+               The rollup keeps counting archived events (deleted ones are
+               subtracted), so the archive must not be added on top of it.
+``none``       no total.
+
+Each helper takes an event query (as built by ``filter_events``) on one
+shard and returns a row count.
+"""
+import json
+import os
+
+from models import UserActivity
+
+COUNT_MODES = ('exact', 'capped', 'estimated', 'none')
+DEFAULT_COUNT_MODE = os.getenv('EVENTS_COUNT_MODE', 'capped')
+EVENTS_COUNT_CAP = int(os.getenv('EVENTS_COUNT_CAP', '10000'))
+
+
+def capped_count(query, cap):
+    """Matching rows, counting no further than ``cap``"""
+    return query.order_by(None).limit(cap).count()
+
+
+def planner_estimate(session, query):
+    """Row estimate of the query's plan, without running it"""
+    statement = query.order_by(None).statement
+    compiled = statement.compile(dialect=session.get_bind().dialect)
+    plan = session.connection().exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled.string}', compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def rollup_count(session, user_id, event_type):
+    """Events of one user (optionally of one type) according to user_activity"""
+    profile = session.get(UserActivity, user_id)
+    if profile is None:
+        return 0
+    if event_type:
+        return int(profile.event_type_counts.get(event_type, 0))
+    return profile.event_count
+
+
+def rollup_applies(mode, user_id, dated):
+    """Whether ``count_events`` answers from user_activity instead of the shard's rows"""
+    return mode == 'estimated' and bool(user_id) and not dated
+
+
+def count_events(session, query, mode, user_id=None, event_type=None, dated=False, cap=EVENTS_COUNT_CAP):
+    """Total for one shard in ``mode``; ``cap + 1`` in capped mode means "more than cap" """
+    if mode == 'exact':
+        return query.order_by(None).count()
+    if mode == 'capped':
+        return capped_count(query, cap + 1)
+    if mode == 'estimated':
+        if rollup_applies(mode, user_id, dated):
+            return rollup_count(session, user_id, event_type)
+        return planner_estimate(session, query)
+    return None
@@ -0,0 +1,361 @@
+"""In-memory columnar window over the most recent events.
+
+With HOT_WINDOW_ENABLED=true the process keeps the events of the last
+HOT_WINDOW_HOURS (at most HOT_WINDOW_CAPACITY of them) in a ring of NumPy
+arrays: id, timestamp in microseconds, and integer codes for event_type,
+user_id and page_path. The window is warmed from every shard at start-up
+and then fed by the tracking endpoints and the spool replayer after each
+insert. Counts, event type distributions and aggregates of queries whose
+start_date falls inside the window are computed with vectorized scans;
+everything else goes to the database as before.
+
+``since`` is the moment from which the window holds every event. It moves
+forward when the ring overwrites old entries. Deletes are applied to the
+window as well, and updated events are patched in place (updates never move
+a timestamp). Only when the window cannot tell what changed, e.g. after a
+batch update failed half way, is it reloaded in the background; queries go
+to the database until the reload has finished.
+
+The window only sees the writes of its own process, so enable it only for
+a single web process with INGEST_MODE=direct (it stays off in queue mode).
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from aggregates import order_rows
+from dimensions import event_types, page_paths
+from models import AnalyticsEvent, db
+
+HOT_WINDOW_ENABLED = os.getenv('HOT_WINDOW_ENABLED', 'false').lower() == 'true'
+HOT_WINDOW_HOURS = float(os.getenv('HOT_WINDOW_HOURS', '6'))
+HOT_WINDOW_CAPACITY = int(os.getenv('HOT_WINDOW_CAPACITY', '1000000'))
+WARM_RETRY_SECONDS = 5
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+HOUR_US = 3600 * 10 ** 6
+DAY_US = 24 * HOUR_US
+NO_USER = np.iinfo(np.int64).min
+
+# What the window can aggregate; other dimensions and metrics need the full rows
+WINDOW_DIMENSIONS = {'event_type', 'page_path', 'user_id', 'time:hour', 'time:day', 'time:week', 'time:month'}
+WINDOW_METRICS = {'count', 'count_distinct_user_id'}
+
+
+def to_micros(moment):
+    """Microseconds since the epoch of a naive UTC (or aware) datetime"""
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return (moment - EPOCH) // MICROSECOND
+
+
+def from_micros(value):
+    return EPOCH + timedelta(microseconds=int(value))
+
+
+def time_bucket(micros, unit):
+    """date_trunc(unit, timestamp) over an array of microsecond timestamps"""
+    if unit == 'hour':
+        return micros - micros % HOUR_US
+    if unit == 'day':
+        return micros - micros % DAY_US
+    if unit == 'week':
+        days = micros // DAY_US
+        # 1970-01-01 was a Thursday; weeks start on Monday, as in Postgres
+        return (days - (days + 3) % 7) * DAY_US
+    months = micros.astype('datetime64[us]').astype('datetime64[M]')
+    return months.astype('datetime64[us]').astype(np.int64)
+
+
+class Interner:
+    """Dense codes for string values, so the columns stay numeric"""
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+
+    def code(self, value):
+        if value is None:
+            return -1
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def value(self, code):
+        return None if code < 0 else self.values[code]
+
+
+class HotWindow:
+    def __init__(self, capacity=HOT_WINDOW_CAPACITY, hours=HOT_WINDOW_HOURS):
+        self.capacity = capacity
+        self.hours = hours
+        self._lock = threading.Lock()
+        self._app = None
+        self._warming = False
+        self._rewarm = False
+        self._pending = []
+        # None until warmed and while a reload is pending; the arrays are allocated on warm-up
+        self._since = None
+
+    def _reset(self):
+        self._ids = np.zeros(self.capacity, dtype=np.int64)
+        self._ts = np.zeros(self.capacity, dtype=np.int64)
+        self._types = np.zeros(self.capacity, dtype=np.int32)
+        self._users = np.full(self.capacity, NO_USER, dtype=np.int64)
+        self._pages = np.full(self.capacity, -1, dtype=np.int32)
+        self._used = np.zeros(self.capacity, dtype=bool)
+        self._next = 0
+        self._event_types = Interner()
+        self._page_paths = Interner()
+
+    # --- Filling ------------------------------------------------------------
+
+    def _columns(self, events):
+        """Column arrays from ``(id, timestamp, event_type, user_id, page_path)`` tuples"""
+        count = len(events)
+        return (
+            np.fromiter((event[0] for event in events), dtype=np.int64, count=count),
+            np.fromiter((to_micros(event[1]) for event in events), dtype=np.int64, count=count),
+            np.fromiter((self._event_types.code(event[2]) for event in events), dtype=np.int32, count=count),
+            np.fromiter((NO_USER if event[3] is None else event[3] for event in events), dtype=np.int64, count=count),
+            np.fromiter((self._page_paths.code(event[4]) for event in events), dtype=np.int32, count=count),
+        )
+
+    def _append(self, columns, since):
+        """Write columns into the ring; returns ``since`` moved past any evicted event. Lock held."""
+        ts = columns[1]
+        if len(ts) > self.capacity:
+            newest = np.argsort(ts, kind='stable')[-self.capacity:]
+            since = max(since, int(np.delete(ts, newest).max()) + 1)
+            columns = tuple(column[newest] for column in columns)
+        positions = (self._next + np.arange(len(columns[0]))) % self.capacity
+        evicted = positions[self._used[positions]]
+        if len(evicted):
+            since = max(since, int(self._ts[evicted].max()) + 1)
+        for array, column in zip((self._ids, self._ts, self._types, self._users, self._pages), columns):
+            array[positions] = column
+        self._used[positions] = True
+        self._next = int((self._next + len(positions)) % self.capacity)
+        return since
+
+    def observe_rows(self, rows, results):
+        """Add inserted ingest rows; acknowledged duplicates are skipped"""
+        if self._app is None:
+            return
+        events = [
+            (result.event_id, result.timestamp, row['event_type'], row.get('user_id'), row.get('page_path'))
+            for row, result in zip(rows, results) if not result.deduplicated
+        ]
+        if not events:
+            return
+        with self._lock:
+            if self._warming:
+                self._pending.extend(events)
+            elif self._since is not None:
+                self._since = self._append(self._columns(events), self._since)
+
+    def forget(self, event_ids=None, filters=None):
+        """Drop deleted events, given by id or by the filters of a bulk delete"""
+        with self._lock:
+            if self._warming:
+                # The running reload may already have read them
+                self._rewarm = True
+            elif self._since is not None:
+                if event_ids is not None:
+                    self._used &= ~np.isin(self._ids, np.asarray(event_ids, dtype=np.int64))
+                else:
+                    self._used &= ~self._matching(filters)
+
+    def update(self, events):
+        """Patch updated events, given as dictionaries with the fields of ``AnalyticsEvent.to_dict``"""
+        if not events:
+            return
+        with self._lock:
+            if self._warming:
+                # The running reload may have read the old values
+                self._rewarm = True
+            elif self._since is not None:
+                by_id = {event['id']: event for event in events}
+                ids = np.fromiter(by_id, dtype=np.int64, count=len(by_id))
+                # Events older than the window are not in it and need nothing
+                for position in np.flatnonzero(self._used & np.isin(self._ids, ids)).tolist():
+                    event = by_id[int(self._ids[position])]
+                    self._types[position] = self._event_types.code(event['event_type'])
+                    self._users[position] = NO_USER if event['user_id'] is None else event['user_id']
+                    self._pages[position] = self._page_paths.code(event['page_path'])
+
+    def invalidate(self):
+        """Reload after changes the window cannot follow, such as a partly applied batch update"""
+        if self._app is None:
+            return
+        with self._lock:
+            self._since = None
+            if self._warming:
+                self._rewarm = True
+                return
+            self._warming = True
+            self._pending = []
+        threading.Thread(target=self._warm_until_done, name='hot-window', daemon=True).start()
+
+    # --- Warming ------------------------------------------------------------
+
+    def start(self, app):
+        """Load the window from the database on a background thread"""
+        self._app = app
+        self.invalidate()
+
+    def _warm_until_done(self):
+        with self._app.app_context():
+            while True:
+                try:
+                    self._warm()
+                except Exception as e:
+                    db.session.rollback()
+                    print(f"Hot window warm-up failed, retrying in {WARM_RETRY_SECONDS}s: {str(e).splitlines()[0]}")
+                    time.sleep(WARM_RETRY_SECONDS)
+                    with self._lock:
+                        # Everything observed so far is committed, so the next load sees it
+                        self._pending = []
+                    continue
+                with self._lock:
+                    if not self._rewarm:
+                        self._warming = False
+                        return
+                    self._rewarm = False
+                    self._pending = []
+
+    def _warm(self):
+        from shards import shard_set
+
+        start = datetime.utcnow() - timedelta(hours=self.hours)
+
+        def load(session):
+            rows = session.query(
+                AnalyticsEvent.id, AnalyticsEvent.timestamp, AnalyticsEvent.event_type_id,
+                AnalyticsEvent.user_id, AnalyticsEvent.page_path_id
+            ).filter(AnalyticsEvent.timestamp >= start).order_by(
+                AnalyticsEvent.timestamp.desc()
+            ).limit(self.capacity).all()
+            names = event_types.values_for(session, [row[2] for row in rows])
+            paths = page_paths.values_for(session, [row[4] for row in rows])
+            return [(row[0], row[1], names[row[2]], row[3], paths.get(row[4])) for row in rows]
+
+        since = to_micros(start)
+        events = []
+        for shard_events in shard_set.broadcast(load).values():
+            if len(shard_events) == self.capacity:
+                # This shard has more; it is complete only from its oldest loaded event on
+                since = max(since, to_micros(shard_events[-1][1]) + 1)
+            events += shard_events
+
+        with self._lock:
+            self._reset()
+            if events:
+                since = self._append(self._columns(events), since)
+            if self._pending:
+                pending = self._columns(self._pending)
+                fresh = ~np.isin(pending[0], self._ids[self._used])
+                since = self._append(tuple(column[fresh] for column in pending), since)
+            self._pending = []
+            self._since = None if self._rewarm else since
+
+    # --- Queries ------------------------------------------------------------
+
+    def covers(self, start_date):
+        """Whether every event from ``start_date`` on is in the window"""
+        since = self._since
+        return since is not None and start_date is not None and to_micros(start_date) >= since
+
+    def _matching(self, filters):
+        """Positions of the events matching the shared query filters. Lock held."""
+        user_id, event_type, start_date, end_date = filters
+        mask = self._used.copy()
+        if start_date is not None:
+            mask &= self._ts >= to_micros(start_date)
+        if end_date is not None:
+            mask &= self._ts <= to_micros(end_date)
+        if user_id:
+            mask &= self._users == user_id
+        if event_type:
+            code = self._event_types.codes.get(event_type)
+            mask &= self._types == (-1 if code is None else code)
+        return mask
+
+    def _mask(self, filters):
+        """Matching positions, or None when the window does not cover the range. Lock held."""
+        return self._matching(filters) if self.covers(filters[2]) else None
+
+    def count(self, filters):
+        """Number of matching events, or None if the window cannot answer"""
+        with self._lock:
+            mask = self._mask(filters)
+            return None if mask is None else int(np.count_nonzero(mask))
+
+    def event_type_counts(self, filters):
+        """``{event_type: count}`` of matching events, or None if the window cannot answer"""
+        with self._lock:
+            mask = self._mask(filters)
+            if mask is None:
+                return None
+            counts = np.bincount(self._types[mask], minlength=len(self._event_types.values))
+            return {self._event_types.values[code]: int(count) for code, count in enumerate(counts) if count}
+
+    def aggregate(self, filters, dimensions, metrics, order, limit):
+        """Rows as aggregates.aggregate returns them, or None if the window cannot answer"""
+        if not {dimension.name for dimension in dimensions} <= WINDOW_DIMENSIONS:
+            return None
+        if not {metric.name for metric in metrics} <= WINDOW_METRICS:
+            return None
+
+        with self._lock:
+            mask = self._mask(filters)
+            if mask is None:
+                return None
+            users = self._users[mask]
+            columns = []
+            for dimension in dimensions:
+                if dimension.name == 'event_type':
+                    columns.append(self._types[mask].astype(np.int64))
+                elif dimension.name == 'page_path':
+                    columns.append(self._pages[mask].astype(np.int64))
+                elif dimension.name == 'user_id':
+                    columns.append(users)
+                else:
+                    columns.append(time_bucket(self._ts[mask], dimension.name[5:]))
+
+            if columns:
+                keys, groups = np.unique(np.stack(columns, axis=1), axis=0, return_inverse=True)
+                groups = groups.reshape(-1)
+            else:
+                # Without group_by there is exactly one row, even when nothing matched
+                keys, groups = np.zeros((1, 0), dtype=np.int64), np.zeros(len(users), dtype=np.int64)
+            values = {'count': np.bincount(groups, minlength=len(keys))}
+            if any(metric.name == 'count_distinct_user_id' for metric in metrics):
+                known = users != NO_USER
+                pairs = np.unique(np.stack([groups[known], users[known]], axis=1), axis=0)
+                values['count_distinct_user_id'] = np.bincount(pairs[:, 0], minlength=len(keys))
+
+            decoders = {
+                'event_type': self._event_types.value,
+                'page_path': self._page_paths.value,
+                'user_id': lambda value: None if value == NO_USER else value,
+            }
+            rows = []
+            for index, key in enumerate(keys.tolist()):
+                row = {}
+                for dimension, value in zip(dimensions, key):
+                    row[dimension.name] = decoders.get(dimension.name, from_micros)(value)
+                for metric in metrics:
+                    row[metric.name] = int(values[metric.name][index])
+                rows.append(row)
+
+        return order_rows(rows, dimensions, order, limit)
+
+
+hot_window = HotWindow()
@@ -0,0 +1,232 @@
+"""Conditional GET (ETag / If-None-Match), response compression and compressed request bodies"""
+import gzip
+import hashlib
+import io
+import itertools
+import os
+import zlib
+from functools import wraps
+
+from flask import jsonify, request, make_response
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import get_input_stream
+from sqlalchemy import event, select, text
+from sqlalchemy.orm import Session
+
+from models import AnalyticsEvent, data_version_seq, db
+from replicas import primary_bind
+from shards import shard_set
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', '5'))
+ZSTD_LEVEL = int(os.getenv('ZSTD_LEVEL', '3'))
+MAX_DECOMPRESSED_BODY = int(os.getenv('MAX_DECOMPRESSED_BODY', str(64 * 1024 * 1024)))
+
+# Server preference order
+SUPPORTED_ENCODINGS = ('zstd', 'gzip') if zstandard else ('gzip',)
+
+
+# --- Data version watermark -------------------------------------------------
+
+# Only event writes move the version; profiles change with them, and other tables have their own
+def _touches_events(objects):
+    return any(isinstance(obj, AnalyticsEvent) for obj in objects)
+
+
+@event.listens_for(Session, 'after_flush')
+def _mark_flush_changes(session, flush_context):
+    if _touches_events(itertools.chain(session.new, session.dirty, session.deleted)):
+        session.info['events_changed'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _mark_bulk_changes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if table is not None and table.name == AnalyticsEvent.__tablename__:
+            orm_execute_state.session.info['events_changed'] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_data_version(session):
+    # before_commit runs ahead of the final flush, so look at pending state too
+    pending = _touches_events(itertools.chain(session.new, session.dirty, session.deleted))
+    if session.info.pop('events_changed', False) or pending:
+        session.execute(select(data_version_seq.next_value()))
+
+
+@event.listens_for(Session, 'after_rollback')
+def _clear_changes(session):
+    session.info.pop('events_changed', None)
+
+
+def current_data_version(session):
+    """Read the data version without advancing it"""
+    # last_value only moves from the second nextval() on; is_called covers the first.
+    # Always asked of the primary: a lagging replica would validate stale representations.
+    return session.execute(
+        text(f'SELECT last_value + is_called::int FROM {data_version_seq.name}'),
+        bind_arguments={'bind': primary_bind(session)}
+    ).scalar()
+
+
+def events_version():
+    # Every shard has its own sequence; their sum still grows with any write
+    return sum(shard_set.broadcast(current_data_version).values())
+
+
+# --- Compression ------------------------------------------------------------
+
+def negotiate_encoding():
+    """Pick the best content coding the client accepts, or None for identity"""
+    return request.accept_encodings.best_match(SUPPORTED_ENCODINGS)
+
+
+def _encode(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def compressed(view):
+    """Compress successful responses above COMPRESSION_MIN_SIZE with gzip or zstd"""
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.vary.add('Accept-Encoding')
+
+        encoding = negotiate_encoding()
+        if (encoding is None or response.status_code != 200 or response.direct_passthrough
+                or response.is_streamed or 'Content-Encoding' in response.headers):
+            return response
+
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+
+        response.set_data(_encode(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        # A strong ETag identifies exact bytes, so each coding gets its own tag
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak=weak)
+        return response
+
+    return decorated_function
+
+
+# --- Conditional GET --------------------------------------------------------
+
+def _etag_for(version):
+    args = sorted(request.args.items(multi=True))
+    key = f'{request.path}|{args}|{version}'
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def conditional_on(data_version, validate=None):
+    """``conditional`` for an endpoint whose data changes with ``data_version()``"""
+    def decorator(view):
+        return _conditional(view, data_version, validate)
+    return decorator
+
+
+def conditional(view=None, *, validate=None):
+    """Answer If-None-Match hits with 304 before the view runs.
+
+    The ETag covers the path, the query parameters and the events data
+    version, so any committed event write invalidates every cached
+    representation. ``validate`` parses the query parameters first and
+    raises ValueError for a bad one, which is answered with a 400 before
+    the data version is looked up.
+    """
+    if view is None:
+        return lambda view: _conditional(view, events_version, validate)
+    return _conditional(view, events_version, validate)
+
+
+def _conditional(view, data_version, validate=None):
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        if validate is not None:
+            try:
+                validate()
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+
+        try:
+            etag = _etag_for(data_version())
+        except Exception:
+            # Without a version there is no ETag; the view reports the outage itself
+            db.session.rollback()
+            return view(*args, **kwargs)
+
+        encoding = negotiate_encoding()
+        candidates = (etag, f'{etag}-{encoding}') if encoding else (etag,)
+        for tag in candidates:
+            if request.if_none_match.contains(tag):
+                response = make_response('', 304)
+                response.set_etag(tag)
+                response.vary.add('Accept-Encoding')
+                return response
+
+        response = make_response(view(*args, **kwargs))
+        if response.status_code == 200:
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    return decorated_function
+
+
+# --- Compressed request bodies ----------------------------------------------
+
+def _inflate(body, encoding, limit):
+    """Decompress ``body``; returns None if it expands beyond ``limit`` bytes"""
+    if encoding == 'zstd':
+        data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body)).read(limit + 1)
+    else:
+        decompressor = zlib.decompressobj(wbits=31)
+        data = decompressor.decompress(body, limit + 1)
+        if len(data) <= limit and not decompressor.eof:
+            raise ValueError('truncated gzip stream')
+    return data if len(data) <= limit else None
+
+
+DECODE_ERRORS = (zlib.error, EOFError, ValueError) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class RequestDecompression:
+    """WSGI middleware inflating gzip (or zstd) encoded request bodies before Flask reads them"""
+
+    def __init__(self, wsgi_app, max_size=MAX_DECOMPRESSED_BODY):
+        self.wsgi_app = wsgi_app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('', 'identity'):
+            return self.wsgi_app(environ, start_response)
+
+        if encoding not in SUPPORTED_ENCODINGS:
+            response = Response(f'{{"error": "Unsupported Content-Encoding: {encoding}"}}', 415, mimetype='application/json')
+            return response(environ, start_response)
+        try:
+            data = _inflate(get_input_stream(environ).read(), encoding, self.max_size)
+        except DECODE_ERRORS:
+            response = Response(f'{{"error": "Malformed {encoding} body"}}', 400, mimetype='application/json')
+            return response(environ, start_response)
+        if data is None:
+            response = Response('{"error": "Decompressed body too large"}', 413, mimetype='application/json')
+            return response(environ, start_response)
+
+        environ['wsgi.input'] = io.BytesIO(data)
+        environ['CONTENT_LENGTH'] = str(len(data))
+        environ.pop('HTTP_CONTENT_ENCODING')
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        environ.pop('wsgi.input_terminated', None)
+        return self.wsgi_app(environ, start_response)
@@ -0,0 +1,99 @@
+"""Event ingestion shared by the single and batch tracking endpoints"""
+from collections import namedtuple
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import AnalyticsEvent
+from dedup import seen_event_ids
+from dimensions import encode_rows
+from profiles import update_profiles
+
+IngestResult = namedtuple('IngestResult', ['event_id', 'timestamp', 'deduplicated'])
+
+
+def build_event_row(event, default_user_id, ip_address, user_agent):
+    """Turn a decoded EventPayload into an insertable row dictionary"""
+    return {
+        'event_uuid': event.event_uuid,
+        'event_type': event.event_type,
+        'user_id': event.user_id or default_user_id,
+        'session_id': event.session_id,
+        'page_path': event.page_path,
+        'event_metadata': event.metadata,
+        'ip_address': ip_address,
+        'user_agent': user_agent
+    }
+
+
+def _lookup_existing(session, event_uuids):
+    rows = session.execute(
+        select(AnalyticsEvent.event_uuid, AnalyticsEvent.id, AnalyticsEvent.timestamp)
+        .where(AnalyticsEvent.event_uuid.in_(event_uuids))
+    )
+    return {event_uuid: (event_id, timestamp) for event_uuid, event_id, timestamp in rows}
+
+
+def insert_events(session, rows):
+    """Insert rows in bulk, acknowledging already stored event_uuids without inserting them.
+
+    Only ids the Bloom filter may have seen are looked up before the insert;
+    everything else goes straight to ``INSERT .. ON CONFLICT DO NOTHING`` and
+    the unique index catches what the filter could not know about (other
+    workers, older ids). Returns one IngestResult per row, in input order.
+    The caller commits.
+    """
+    results = [None] * len(rows)
+    db_rows = encode_rows(session, rows)
+    anonymous = []
+    keyed = {}
+    for index, row in enumerate(rows):
+        if row['event_uuid'] is None:
+            anonymous.append(index)
+        else:
+            keyed.setdefault(row['event_uuid'], []).append(index)
+
+    maybe_seen = [event_uuid for event_uuid in keyed if event_uuid.bytes in seen_event_ids]
+    existing = _lookup_existing(session, maybe_seen) if maybe_seen else {}
+
+    if anonymous:
+        inserted = session.execute(
+            insert(AnalyticsEvent).returning(
+                AnalyticsEvent.id, AnalyticsEvent.timestamp, sort_by_parameter_order=True
+            ),
+            [db_rows[index] for index in anonymous]
+        )
+        for index, (event_id, timestamp) in zip(anonymous, inserted):
+            results[index] = IngestResult(event_id, timestamp, False)
+
+    fresh = [event_uuid for event_uuid in keyed if event_uuid not in existing]
+    if fresh:
+        stmt = (
+            pg_insert(AnalyticsEvent)
+            .on_conflict_do_nothing(index_elements=[AnalyticsEvent.event_uuid])
+            .returning(AnalyticsEvent.event_uuid, AnalyticsEvent.id, AnalyticsEvent.timestamp)
+        )
+        created = {
+            event_uuid: (event_id, timestamp)
+            for event_uuid, event_id, timestamp in session.execute(stmt, [db_rows[keyed[u][0]] for u in fresh])
+        }
+        # Rows skipped by ON CONFLICT were committed by someone else in the meantime
+        raced = [event_uuid for event_uuid in fresh if event_uuid not in created]
+        if raced:
+            existing.update(_lookup_existing(session, raced))
+
+        for event_uuid, (event_id, timestamp) in created.items():
+            first, *repeats = keyed[event_uuid]
+            results[first] = IngestResult(event_id, timestamp, False)
+            for index in repeats:
+                results[index] = IngestResult(event_id, timestamp, True)
+            seen_event_ids.add(event_uuid.bytes)
+
+    for event_uuid, (event_id, timestamp) in existing.items():
+        for index in keyed[event_uuid]:
+            results[index] = IngestResult(event_id, timestamp, True)
+
+    stored = [index for index, result in enumerate(results) if not result.deduplicated]
+    update_profiles(session, [rows[index] for index in stored], [results[index].timestamp for index in stored])
+
+    return results
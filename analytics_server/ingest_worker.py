@@ -0,0 +1,118 @@
+"""Queue consumer that batch-inserts tracked events into Postgres.
+
+Run with ``python ingest_worker.py`` next to an analytics server started with
+INGEST_MODE=queue. Deliveries are acknowledged only after the batch that
+contains them has been committed, so a crash redelivers them; the event_uuid
+stamped at publish time makes the retry idempotent.
+"""
+import os
+import time
+import threading
+
+from sqlalchemy.exc import DataError, IntegrityError, SQLAlchemyError
+
+from daily_summaries import daily_summaries
+from event_queue import decode_message, get_transport
+from shards import shard_set
+
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', '5000'))
+INGEST_PREFETCH = int(os.getenv('INGEST_PREFETCH', '1000'))
+INGEST_MAX_WAIT = float(os.getenv('INGEST_MAX_WAIT', '0.5'))
+INGEST_RETRY_DELAY = float(os.getenv('INGEST_RETRY_DELAY', '2'))
+
+
+def _insert_individually(transport, session, batch):
+    """Fallback for a batch that failed deterministically: isolate and drop the bad messages"""
+    for tag, rows in batch:
+        try:
+            results = shard_set.insert(rows, session)
+            transport.ack_upto(tag)
+        except (DataError, IntegrityError) as e:
+            session.rollback()
+            print(f"Dropping event message that cannot be stored: {e}")
+            transport.reject(tag)
+        else:
+            daily_summaries.reopen(result.timestamp for result in results)
+
+
+def consume(transport, session, batch_size=INGEST_BATCH_SIZE, prefetch=INGEST_PREFETCH, max_wait=INGEST_MAX_WAIT):
+    """Insert queued events in batches of up to ``batch_size`` rows, forever.
+
+    A batch is flushed when it is full, when it holds ``prefetch``
+    deliveries (the broker sends no more until some are acked) or when no
+    delivery arrived for ``max_wait`` seconds.
+    """
+    batch, pending = [], 0
+
+    for tag, body in transport.deliveries(prefetch, max_wait):
+        if tag is not None:
+            try:
+                rows = decode_message(body)
+            except (ValueError, KeyError, TypeError) as e:
+                print(f"Dropping malformed event message: {e}")
+                transport.reject(tag)
+                continue
+            batch.append((tag, rows))
+            pending += len(rows)
+            if pending < batch_size and len(batch) < prefetch:
+                continue
+
+        if not batch:
+            continue
+
+        last_tag = batch[-1][0]
+        try:
+            results = shard_set.insert([row for _, rows in batch for row in rows], session)
+            transport.ack_upto(last_tag)
+        except (DataError, IntegrityError):
+            session.rollback()
+            _insert_individually(transport, session, batch)
+        except SQLAlchemyError as e:
+            # Database unavailable: hand everything back to the queue and wait
+            session.rollback()
+            print(f"Failed to insert {pending} queued events, requeueing: {e}")
+            transport.requeue_upto(last_tag)
+            time.sleep(INGEST_RETRY_DELAY)
+        else:
+            # Redelivered or long-queued events can belong to a day that has closed since
+            daily_summaries.reopen(result.timestamp for result in results)
+        batch, pending = [], 0
+
+
+def run_forever(transport, session):
+    while True:
+        try:
+            consume(transport, session)
+        except Exception as e:
+            # Hand back whatever the failed consumer still held before starting a new one
+            print(f"Ingest worker error, reconnecting: {e}")
+            session.rollback()
+            transport.recover()
+            time.sleep(INGEST_RETRY_DELAY)
+
+
+def start_local_consumer(app, db):
+    """Run the consumer on a daemon thread of the web process (INGEST_TRANSPORT=local)"""
+    def run():
+        with app.app_context():
+            run_forever(get_transport(), db.session)
+
+    thread = threading.Thread(target=run, name='ingest-consumer', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    from flask import Flask
+    from models import db
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv(
+        'DATABASE_URL', 'postgresql://analytics_user:analytics_pass@db:5432/analytics_db'
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+
+    print(f"Ingest worker consuming (batch size {INGEST_BATCH_SIZE}, prefetch {INGEST_PREFETCH})")
+    with app.app_context():
+        run_forever(get_transport(), db.session)
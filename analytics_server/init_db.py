@@ -3,9 +3,6 @@ import os
 import time
 import sys
 
-# Wait a bit for database to be ready
-time.sleep(3)
-
 # Import in the correct order
 from models import db
 from flask import Flask
@@ -23,17 +20,117 @@ db.init_app(app)
 
 # Import models after db is initialized
 from models import AnalyticsEvent
+from profiles import PROFILE_BACKFILL
+from shards import shard_set
+from sqlalchemy import inspect, text
+
+# create_all() never alters existing tables, so later columns are added here
+SCHEMA_UPGRADES = [
+    "ALTER TABLE analytics_events ADD COLUMN IF NOT EXISTS event_uuid UUID",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_analytics_events_event_uuid ON analytics_events (event_uuid)",
+]
+
+# Moves the pre dictionary encoding string columns into the lookup tables
+DIMENSION_MIGRATION = [
+    "ALTER TABLE analytics_events ADD COLUMN IF NOT EXISTS event_type_id SMALLINT REFERENCES event_types (id)",
+    "ALTER TABLE analytics_events ADD COLUMN IF NOT EXISTS page_path_id INTEGER REFERENCES page_paths (id)",
+    "ALTER TABLE analytics_events ADD COLUMN IF NOT EXISTS user_agent_id INTEGER REFERENCES user_agents (id)",
+    "INSERT INTO event_types (value) SELECT DISTINCT event_type FROM analytics_events ON CONFLICT DO NOTHING",
+    "INSERT INTO page_paths (value) SELECT DISTINCT page_path FROM analytics_events "
+    "WHERE page_path IS NOT NULL ON CONFLICT DO NOTHING",
+    "INSERT INTO user_agents (value_hash, value) SELECT DISTINCT md5(user_agent), user_agent FROM analytics_events "
+    "WHERE user_agent IS NOT NULL ON CONFLICT DO NOTHING",
+    "UPDATE analytics_events e SET event_type_id = t.id, page_path_id = p.id, user_agent_id = u.id "
+    "FROM analytics_events s "
+    "JOIN event_types t ON t.value = s.event_type "
+    "LEFT JOIN page_paths p ON p.value = s.page_path "
+    "LEFT JOIN user_agents u ON u.value_hash = md5(s.user_agent) "
+    "WHERE e.id = s.id",
+    "ALTER TABLE analytics_events ALTER COLUMN event_type_id SET NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_analytics_events_event_type_id ON analytics_events (event_type_id)",
+    "ALTER TABLE analytics_events DROP COLUMN event_type, DROP COLUMN page_path, DROP COLUMN user_agent",
+]
+
+# Need the dictionary encoded columns, so they run after DIMENSION_MIGRATION
+POST_MIGRATION_UPGRADES = [
+    "CREATE INDEX IF NOT EXISTS ix_analytics_events_type_time ON analytics_events (event_type_id, timestamp) "
+    "INCLUDE (user_id, session_id, page_path_id)",
+    "CREATE INDEX IF NOT EXISTS ix_analytics_events_user_time ON analytics_events (user_id, timestamp) "
+    "INCLUDE (event_type_id, session_id, page_path_id)",
+]
+
+def configure_shard_ids(connection, shard, shard_count):
+    """Make shard k hand out the event ids congruent to k + 1 modulo the shard count"""
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence('analytics_events', 'id')")).scalar()
+    current = connection.execute(text(
+        f"SELECT greatest((SELECT coalesce(max(id), 0) FROM analytics_events), "
+        f"(SELECT CASE WHEN is_called THEN last_value ELSE 0 END FROM {sequence}))"
+    )).scalar()
+    start = current + 1 + (shard - current) % shard_count
+    connection.execute(text(f"ALTER SEQUENCE {sequence} INCREMENT BY {shard_count} RESTART WITH {start}"))
+
+def create_schema(engine, shard=None):
+    profiles_existed = inspect(engine).has_table('user_activity')
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        for statement in SCHEMA_UPGRADES:
+            connection.execute(text(statement))
+
+        columns = {column['name'] for column in inspect(connection).get_columns('analytics_events')}
+        if 'event_type' in columns:
+            print("Migrating event_type, page_path and user_agent to lookup tables...")
+            for statement in DIMENSION_MIGRATION:
+                connection.execute(text(statement))
+
+        for statement in POST_MIGRATION_UPGRADES:
+            connection.execute(text(statement))
+
+        if not profiles_existed:
+            connection.execute(text(PROFILE_BACKFILL))
+
+        if shard is not None:
+            configure_shard_ids(connection, shard, len(shard_set))
+
+DB_READY_TIMEOUT = float(os.getenv('DB_READY_TIMEOUT', '60'))
+
+def database_engines():
+    if shard_set.sharded:
+        return [shard_set.engine(shard) for shard in shard_set.all()]
+    return [db.engine]
+
+def wait_for_databases(timeout=DB_READY_TIMEOUT):
+    """Poll every database until it accepts connections, instead of sleeping a fixed time"""
+    deadline = time.monotonic() + timeout
+    for engine in database_engines():
+        delay = 0.1
+        while True:
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text('SELECT 1'))
+                break
+            except Exception as e:
+                if time.monotonic() + delay > deadline:
+                    raise RuntimeError(f"Database {engine.url.database} not ready after {timeout:.0f}s: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+def create_all_schemas():
+    if shard_set.sharded:
+        for shard in shard_set.all():
+            create_schema(shard_set.engine(shard), shard)
+    else:
+        create_schema(db.engine)
 
 # Create tables
 try:
     with app.app_context():
-        db.create_all()
+        wait_for_databases()
+        create_all_schemas()
         print("Database tables created successfully!")
 except Exception as e:
     print(f"Error creating database tables: {e}")
-    # Retry once after a delay
-    time.sleep(5)
+    # Retry once, as soon as the databases answer again
     with app.app_context():
-        db.create_all()
+        wait_for_databases()
+        create_all_schemas()
         print("Database tables created successfully!")
-
@@ -1,22 +1,92 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import object_session
 from datetime import datetime
 import json
 
-db = SQLAlchemy()
+from replicas import RoutingSession
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+class EventType(db.Model):
+    """Interned event type names"""
+    __tablename__ = 'event_types'
+
+    id = db.Column(db.SmallInteger, primary_key=True)
+    value = db.Column(db.String(100), nullable=False, unique=True)
+
+
+class PagePath(db.Model):
+    """Interned page paths"""
+    __tablename__ = 'page_paths'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.String(500), nullable=False, unique=True)
+
+
+class UserAgent(db.Model):
+    """Interned user agent strings, unique on an md5 of the (unbounded) text"""
+    __tablename__ = 'user_agents'
+
+    id = db.Column(db.Integer, primary_key=True)
+    value_hash = db.Column(db.String(32), nullable=False, unique=True)
+    value = db.Column(db.Text, nullable=False)
+
+
+def _dimensions():
+    # Imported lazily: dimensions builds on the models defined here
+    import dimensions
+    return dimensions
+
 
 class AnalyticsEvent(db.Model):
     """Model for analytics events"""
     __tablename__ = 'analytics_events'
     
     id = db.Column(db.Integer, primary_key=True)
-    event_type = db.Column(db.String(100), nullable=False, index=True)
+    # Optional client supplied id that makes retried submissions idempotent
+    event_uuid = db.Column(db.Uuid, nullable=True, unique=True, index=True)
+    event_type_id = db.Column(db.SmallInteger, db.ForeignKey('event_types.id'), nullable=False, index=True)
     user_id = db.Column(db.Integer, nullable=True, index=True)
     session_id = db.Column(db.String(255), nullable=True, index=True)
-    page_path = db.Column(db.String(500), nullable=True)
+    page_path_id = db.Column(db.Integer, db.ForeignKey('page_paths.id'), nullable=True)
     event_metadata = db.Column(db.JSON, nullable=True, default={})
     ip_address = db.Column(db.String(45), nullable=True)
-    user_agent = db.Column(db.Text, nullable=True)
+    user_agent_id = db.Column(db.Integer, db.ForeignKey('user_agents.id'), nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+    # Covering indexes: aggregates filtered or grouped by type or user over a time range are index-only scans
+    __table_args__ = (
+        db.Index(
+            'ix_analytics_events_type_time', 'event_type_id', 'timestamp',
+            postgresql_include=['user_id', 'session_id', 'page_path_id']
+        ),
+        db.Index(
+            'ix_analytics_events_user_time', 'user_id', 'timestamp',
+            postgresql_include=['event_type_id', 'session_id', 'page_path_id']
+        ),
+    )
+
+    # String views of the dictionary encoded columns, resolved through the in-process cache
+    @property
+    def event_type(self):
+        return _dimensions().event_types.value_for(object_session(self), self.event_type_id)
+
+    @event_type.setter
+    def event_type(self, value):
+        self.event_type_id = _dimensions().event_types.id_for(object_session(self), value, create=True)
+
+    @property
+    def page_path(self):
+        return _dimensions().page_paths.value_for(object_session(self), self.page_path_id)
+
+    @page_path.setter
+    def page_path(self, value):
+        self.page_path_id = _dimensions().page_paths.id_for(object_session(self), value, create=True)
+
+    @property
+    def user_agent(self):
+        return _dimensions().user_agents.value_for(object_session(self), self.user_agent_id)
     
     def __repr__(self):
         return f'<AnalyticsEvent {self.id}: {self.event_type}>'
@@ -25,6 +95,7 @@ class AnalyticsEvent(db.Model):
         """Convert event to dictionary"""
         return {
             'id': self.id,
+            'event_uuid': self.event_uuid,
             'event_type': self.event_type,
             'user_id': self.user_id,
             'session_id': self.session_id,
@@ -34,3 +105,57 @@ class AnalyticsEvent(db.Model):
             'user_agent': self.user_agent,
             'timestamp': self.timestamp.isoformat()
         }
+
+
+class UserActivity(db.Model):
+    """Per-user activity profile, maintained incrementally at ingest time"""
+    __tablename__ = 'user_activity'
+
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    first_seen = db.Column(db.DateTime, nullable=False)
+    last_seen = db.Column(db.DateTime, nullable=False, index=True)
+    event_count = db.Column(db.BigInteger, nullable=False, default=0)
+    event_type_counts = db.Column(JSONB, nullable=False, default={})
+    last_page_path = db.Column(db.String(500), nullable=True)
+    last_session_id = db.Column(db.String(255), nullable=True)
+    session_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        """Convert profile to dictionary"""
+        return {
+            'user_id': self.user_id,
+            'first_seen': self.first_seen.isoformat(),
+            'last_seen': self.last_seen.isoformat(),
+            'event_count': self.event_count,
+            'event_type_counts': self.event_type_counts,
+            'last_page_path': self.last_page_path,
+            'session_count': self.session_count
+        }
+
+
+class DailySummary(db.Model):
+    """Per-day KPI snapshot built by daily_summaries.py; immutable once complete"""
+    __tablename__ = 'daily_summaries'
+
+    day = db.Column(db.Date, primary_key=True)
+    complete = db.Column(db.Boolean, nullable=False, default=False)
+    # Events before this moment are included
+    watermark = db.Column(db.DateTime, nullable=False)
+    computed_at = db.Column(db.DateTime, nullable=False)
+    summary = db.Column(JSONB, nullable=False)
+    # Full counters of a day that is still open, so refreshes only add the new events
+    state = db.Column(JSONB, nullable=True)
+
+    def to_dict(self):
+        """Convert snapshot to dictionary"""
+        return {
+            'date': self.day.isoformat(),
+            'complete': self.complete,
+            'watermark': self.watermark.isoformat(),
+            'computed_at': self.computed_at.isoformat(),
+            **self.summary
+        }
+
+
+# Bumped by every transaction that writes events; used as a cheap data version for ETags
+data_version_seq = db.Sequence('analytics_data_version_seq', metadata=db.metadata)
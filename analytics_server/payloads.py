@@ -0,0 +1,69 @@
+"""Typed decoding of tracking request bodies.
+
+Bodies are decoded by msgspec straight from bytes into structs whose field
+types and length limits mirror the database columns, so a wrong type or an
+oversized value is reported before anything is written. Batch bodies are
+decoded in two steps: the envelope first, with every item kept as raw JSON,
+then item by item, so one invalid event is reported with its index instead
+of failing the whole batch.
+"""
+import uuid
+from typing import Annotated, Any, Dict, List, Optional
+
+import msgspec
+
+# Column limits from models.py
+EventTypeName = Annotated[str, msgspec.Meta(min_length=1, max_length=100)]
+PagePathValue = Annotated[str, msgspec.Meta(max_length=500)]
+SessionIdValue = Annotated[str, msgspec.Meta(max_length=255)]
+UserIdValue = Annotated[int, msgspec.Meta(ge=-2 ** 31, le=2 ** 31 - 1)]
+
+
+class EventPayload(msgspec.Struct):
+    """One tracked event as sent by clients; unknown fields are ignored"""
+    event_type: EventTypeName
+    event_uuid: Optional[uuid.UUID] = None
+    user_id: Optional[UserIdValue] = None
+    session_id: Optional[SessionIdValue] = None
+    page_path: Optional[PagePathValue] = None
+    metadata: Optional[Dict[str, Any]] = {}
+
+
+class BatchPayload(msgspec.Struct):
+    events: List[msgspec.Raw]
+
+
+_event_decoder = msgspec.json.Decoder(EventPayload)
+_batch_decoder = msgspec.json.Decoder(BatchPayload)
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def decode_event(body):
+    """EventPayload from a request body; raises PayloadError"""
+    try:
+        return _event_decoder.decode(body)
+    except msgspec.DecodeError as e:
+        raise PayloadError(str(e))
+
+
+def decode_batch(body):
+    """``(events, errors)`` for a batch body: valid EventPayloads with their
+    item index, and ``{'index', 'error'}`` for every item that failed.
+
+    Raises PayloadError when the envelope itself is malformed.
+    """
+    try:
+        items = _batch_decoder.decode(body).events
+    except msgspec.DecodeError as e:
+        raise PayloadError(str(e))
+
+    events, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            events.append((index, _event_decoder.decode(item)))
+        except msgspec.DecodeError as e:
+            errors.append({'index': index, 'error': str(e)})
+    return events, errors
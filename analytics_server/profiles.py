@@ -0,0 +1,158 @@
+"""Incremental maintenance of the user_activity profiles"""
+import orjson
+from sqlalchemy import text
+
+from dimensions import event_types
+
+# One statement per ingest batch: the batch arrives as a single JSON parameter,
+# is expanded with jsonb_to_recordset and merged into existing profiles.
+_UPSERT = text("""
+WITH batch AS (
+    SELECT * FROM jsonb_to_recordset(CAST(:batch AS jsonb)) AS b(
+        user_id integer, first_seen timestamp, last_seen timestamp, event_count bigint,
+        event_type_counts jsonb, last_page_path varchar(500), first_session_id varchar(255),
+        last_session_id varchar(255), session_count integer
+    )
+)
+INSERT INTO user_activity AS a (
+    user_id, first_seen, last_seen, event_count, event_type_counts,
+    last_page_path, last_session_id, session_count
+)
+SELECT user_id, first_seen, last_seen, event_count, event_type_counts,
+       last_page_path, last_session_id, session_count
+FROM batch
+ORDER BY user_id
+ON CONFLICT (user_id) DO UPDATE SET
+    first_seen = LEAST(a.first_seen, EXCLUDED.first_seen),
+    last_seen = GREATEST(a.last_seen, EXCLUDED.last_seen),
+    event_count = a.event_count + EXCLUDED.event_count,
+    event_type_counts = (
+        SELECT jsonb_object_agg(key, total) FROM (
+            SELECT key, sum(value::bigint) AS total
+            FROM (
+                SELECT * FROM jsonb_each_text(a.event_type_counts)
+                UNION ALL
+                SELECT * FROM jsonb_each_text(EXCLUDED.event_type_counts)
+            ) AS counts
+            GROUP BY key
+        ) AS merged
+    ),
+    last_page_path = CASE WHEN EXCLUDED.last_seen >= a.last_seen
+        THEN COALESCE(EXCLUDED.last_page_path, a.last_page_path) ELSE a.last_page_path END,
+    last_session_id = CASE WHEN EXCLUDED.last_seen >= a.last_seen
+        THEN COALESCE(EXCLUDED.last_session_id, a.last_session_id) ELSE a.last_session_id END,
+    -- A batch that continues the session the profile ended on does not start a new one
+    session_count = a.session_count + EXCLUDED.session_count - (
+        -- IS NOT DISTINCT FROM: a profile without a session yet must not turn the count NULL
+        SELECT (b.first_session_id IS NOT NULL AND b.first_session_id IS NOT DISTINCT FROM a.last_session_id)::int
+        FROM batch b WHERE b.user_id = EXCLUDED.user_id
+    )
+""")
+
+
+# Takes deleted events back out of the counters; timestamps, last page and sessions are left as they were
+_FORGET = text("""
+WITH batch AS (
+    SELECT * FROM jsonb_to_recordset(CAST(:batch AS jsonb)) AS b(
+        user_id integer, event_count bigint, event_type_counts jsonb
+    )
+)
+UPDATE user_activity AS a SET
+    event_count = GREATEST(a.event_count - b.event_count, 0),
+    event_type_counts = COALESCE((
+        SELECT jsonb_object_agg(key, remaining) FROM (
+            SELECT key, value::bigint - COALESCE((b.event_type_counts ->> key)::bigint, 0) AS remaining
+            FROM jsonb_each_text(a.event_type_counts)
+        ) AS counts
+        WHERE remaining > 0
+    ), '{}'::jsonb)
+FROM batch b
+WHERE a.user_id = b.user_id
+""")
+
+
+# Seeds user_activity from existing events the first time the table is created
+PROFILE_BACKFILL = """
+INSERT INTO user_activity (
+    user_id, first_seen, last_seen, event_count, event_type_counts,
+    last_page_path, last_session_id, session_count
+)
+SELECT e.user_id, min(e.timestamp), max(e.timestamp), count(*),
+       (SELECT jsonb_object_agg(t.value, c.n) FROM (
+            SELECT event_type_id, count(*) AS n FROM analytics_events
+            WHERE user_id = e.user_id GROUP BY event_type_id
+        ) AS c JOIN event_types t ON t.id = c.event_type_id),
+       (SELECT p.value FROM analytics_events l JOIN page_paths p ON p.id = l.page_path_id
+        WHERE l.user_id = e.user_id ORDER BY l.timestamp DESC LIMIT 1),
+       (SELECT l.session_id FROM analytics_events l
+        WHERE l.user_id = e.user_id AND l.session_id IS NOT NULL ORDER BY l.timestamp DESC LIMIT 1),
+       -- Session switches in time order, the definition profiles.summarize continues at ingest
+       (SELECT count(*) FROM (
+            SELECT session_id, lag(session_id) OVER (ORDER BY l.timestamp, l.id) AS previous
+            FROM analytics_events l WHERE l.user_id = e.user_id AND l.session_id IS NOT NULL
+        ) AS s WHERE s.previous IS DISTINCT FROM s.session_id)
+FROM analytics_events e
+WHERE e.user_id IS NOT NULL
+GROUP BY e.user_id
+"""
+
+
+def summarize(rows, timestamps):
+    """Fold ingest rows into one profile delta per user_id.
+
+    Sessions are counted as changes of session_id along the user's events in
+    time order, which is what the upsert continues across batches.
+    """
+    by_user = {}
+    for row, timestamp in sorted(zip(rows, timestamps), key=lambda pair: pair[1]):
+        user_id = row.get('user_id')
+        if user_id is None:
+            continue
+        profile = by_user.get(user_id)
+        if profile is None:
+            profile = by_user[user_id] = {
+                'user_id': user_id,
+                'first_seen': timestamp,
+                'event_count': 0,
+                'event_type_counts': {},
+                'last_page_path': None,
+                'first_session_id': None,
+                'last_session_id': None,
+                'session_count': 0,
+            }
+        profile['last_seen'] = timestamp
+        profile['event_count'] += 1
+        counts = profile['event_type_counts']
+        counts[row['event_type']] = counts.get(row['event_type'], 0) + 1
+        if row.get('page_path'):
+            profile['last_page_path'] = row['page_path']
+        session_id = row.get('session_id')
+        if session_id:
+            if profile['first_session_id'] is None:
+                profile['first_session_id'] = session_id
+            if session_id != profile['last_session_id']:
+                profile['session_count'] += 1
+                profile['last_session_id'] = session_id
+    return list(by_user.values())
+
+
+def update_profiles(session, rows, timestamps):
+    """Merge newly stored events into user_activity within the caller's transaction"""
+    deltas = summarize(rows, timestamps)
+    if deltas:
+        session.execute(_UPSERT, {'batch': orjson.dumps(deltas).decode()})
+
+
+def forget_events(session, deleted):
+    """Subtract deleted events, as ``(user_id, event_type_id)`` pairs, within the caller's transaction"""
+    names = event_types.values_for(session, {type_id for user_id, type_id in deleted if user_id is not None})
+    by_user = {}
+    for user_id, type_id in deleted:
+        if user_id is None:
+            continue
+        delta = by_user.setdefault(user_id, {'user_id': user_id, 'event_count': 0, 'event_type_counts': {}})
+        delta['event_count'] += 1
+        counts = delta['event_type_counts']
+        counts[names[type_id]] = counts.get(names[type_id], 0) + 1
+    if by_user:
+        session.execute(_FORGET, {'batch': orjson.dumps(sorted(by_user.values(), key=lambda d: d['user_id'])).decode()})
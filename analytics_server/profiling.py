@@ -0,0 +1,208 @@
+"""Opt-in per-request profiling.
+
+Nothing here is active unless PROFILING_ENABLED=true; ``init_profiling``
+then returns without registering a single hook or engine listener, so a
+disabled profiler costs nothing.
+
+When enabled, every request counts the SQL statements it runs (including
+those run on shard threads) and reports the count in an X-SQL-Count
+response header. Requests that send the PROFILING_HEADER header, plus a
+random PROFILING_SAMPLE_RATE share of all requests, are also profiled:
+
+* a sampling profiler records the request thread's call stack every
+  PROFILING_INTERVAL_MS milliseconds (folded "a;b;c" stacks, ready for
+  flame graph tools), and
+* every statement is recorded with its literals and parameters normalized
+  away, so the same query issued once per item shows up as one line with
+  a high count.
+
+The report is written to PROFILING_DIR as ``<correlation id>.json``.
+"""
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILING_DIR = os.getenv('PROFILING_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiling'))
+PROFILING_HEADER = os.getenv('PROFILING_HEADER', 'X-Profile')
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_INTERVAL_MS = float(os.getenv('PROFILING_INTERVAL_MS', '5'))
+MAX_STACK_DEPTH = 64
+MAX_STATEMENTS = 200
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'%\([^)]+\)s|%s|\$\d+'), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)'), '(?, ...)'),
+    (re.compile(r'\s+'), ' '),
+]
+
+
+def normalize_statement(statement):
+    """Statement text with literals and bind parameters replaced by ``?``"""
+    for pattern, replacement in _LITERALS:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class RequestProfile:
+    """SQL statistics and stack samples of one request"""
+
+    def __init__(self, detailed):
+        self.detailed = detailed
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self.statements = {}
+        self.stacks = Counter()
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record_sql(self, statement, duration_ms):
+        # Statements may run on shard threads concurrently
+        with self._lock:
+            self.sql_count += 1
+            self.sql_ms += duration_ms
+            if self.detailed:
+                entry = self.statements.setdefault(normalize_statement(statement), [0, 0.0])
+                entry[0] += 1
+                entry[1] += duration_ms
+
+    def report(self, response):
+        statements = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            'correlation_id': g.get('correlation_id'),
+            'method': request.method,
+            'path': request.full_path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 2),
+            'recorded_at': datetime.utcnow().isoformat(),
+            'sql': {
+                'count': self.sql_count,
+                'total_ms': round(self.sql_ms, 2),
+                'statements': [
+                    {'statement': text, 'count': count, 'total_ms': round(total_ms, 2)}
+                    for text, (count, total_ms) in statements[:MAX_STATEMENTS]
+                ],
+            },
+            'profile': {
+                'interval_ms': PROFILING_INTERVAL_MS,
+                'samples': sum(self.stacks.values()),
+                'stacks': [f'{stack} {count}' for stack, count in self.stacks.most_common()],
+            },
+        }
+
+
+class StackSampler:
+    """One background thread sampling the stacks of every thread being profiled"""
+
+    def __init__(self, interval_ms=PROFILING_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self._threads = {}
+        self._lock = threading.Condition()
+        self._thread = None
+
+    def start(self, thread_id, stacks):
+        with self._lock:
+            self._threads[thread_id] = stacks
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+            self._lock.notify()
+
+    def stop(self, thread_id):
+        with self._lock:
+            self._threads.pop(thread_id, None)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._threads:
+                    self._lock.wait()
+                frames = sys._current_frames()
+                # Under the lock, so a stopped request's samples are final
+                for thread_id, stacks in self._threads.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        stacks[_fold(frame)] += 1
+                del frames
+            time.sleep(self.interval)
+
+
+def _fold(frame):
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+_sampler = StackSampler()
+
+
+def _profile_requested():
+    return PROFILING_HEADER in request.headers or random.random() < PROFILING_SAMPLE_RATE
+
+
+def write_report(report):
+    os.makedirs(PROFILING_DIR, exist_ok=True)
+    name = report['correlation_id'] or f'{time.time():.6f}'
+    path = os.path.join(PROFILING_DIR, f'{os.path.basename(name)}.json')
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def init_profiling(app):
+    """Register the profiling hooks when PROFILING_ENABLED; call after the correlation id hook"""
+    if not PROFILING_ENABLED:
+        return
+
+    @app.before_request
+    def start_profile():
+        g.request_profile = profile = RequestProfile(_profile_requested())
+        if profile.detailed:
+            g.profiled_thread = threading.get_ident()
+            _sampler.start(g.profiled_thread, profile.stacks)
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop('request_profile', None)
+        if profile is None:
+            return response
+        if profile.detailed:
+            _sampler.stop(g.pop('profiled_thread'))
+            try:
+                write_report(profile.report(response))
+            except OSError as e:
+                print(f"Could not write profile report: {e}")
+        response.headers['X-SQL-Count'] = str(profile.sql_count)
+        return response
+
+    @app.teardown_request
+    def stop_sampling(exc):
+        # after_request is skipped when the view raised
+        if 'profiled_thread' in g:
+            _sampler.stop(g.pop('profiled_thread'))
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info['profile_started'] = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def finish_statement(conn, cursor, statement, parameters, context, executemany):
+        profile = g.get('request_profile') if has_request_context() else None
+        if profile is not None:
+            profile.record_sql(statement, (time.perf_counter() - conn.info['profile_started']) * 1000)
@@ -0,0 +1,196 @@
+"""Token-bucket admission control for the ingest endpoints.
+
+Each request takes one token from up to three buckets: one per JWT user
+(RATE_LIMIT_USER), one per client IP (RATE_LIMIT_IP) and one shared by
+everyone (RATE_LIMIT_GLOBAL). A limit is written as ``rate/burst``, e.g.
+``50/200`` refills 50 tokens per second up to 200; an empty value disables
+that bucket. A request is admitted only if every bucket has a token,
+otherwise it is answered with 429 and a Retry-After header.
+
+The buckets live in a POSIX shared-memory table (RATE_LIMIT_SHM_NAME), so
+all worker processes on the host enforce the same limits; updates are
+serialized with an fcntl lock. Keys are hashed into RATE_LIMIT_SLOTS slots
+with short linear probing; buckets idle for RATE_LIMIT_IDLE_SECONDS are
+reused, so a full table forgets the quietest clients, never the active ones.
+"""
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from functools import wraps
+from multiprocessing import resource_tracker, shared_memory
+
+from flask import jsonify, request
+
+RATE_LIMIT_USER = os.getenv('RATE_LIMIT_USER', '50/200')
+RATE_LIMIT_IP = os.getenv('RATE_LIMIT_IP', '200/400')
+RATE_LIMIT_GLOBAL = os.getenv('RATE_LIMIT_GLOBAL', '')
+RATE_LIMIT_SHM_NAME = os.getenv('RATE_LIMIT_SHM_NAME', 'analytics_rate_limits')
+RATE_LIMIT_SLOTS = int(os.getenv('RATE_LIMIT_SLOTS', '65536'))
+RATE_LIMIT_IDLE_SECONDS = float(os.getenv('RATE_LIMIT_IDLE_SECONDS', '300'))
+PROBES = 8
+
+# key hash (0 = free), tokens, last update (CLOCK_MONOTONIC, shared by all processes on the host)
+SLOT = struct.Struct('<Qdd')
+
+
+class Limit:
+    def __init__(self, scope, rate, burst):
+        self.scope = scope
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def parse(cls, scope, value):
+        """``rate/burst`` (burst defaults to rate); None when the value is empty or zero"""
+        if not value or not value.strip():
+            return None
+        rate, _, burst = value.partition('/')
+        rate = float(rate)
+        if rate <= 0:
+            return None
+        return cls(scope, rate, float(burst) if burst else rate)
+
+
+def _key_hash(scope, key):
+    digest = hashlib.blake2b(f'{scope}:{key}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') or 1
+
+
+class BucketTable:
+    """Fixed-size table of token buckets in shared memory"""
+
+    def __init__(self, name=RATE_LIMIT_SHM_NAME, slots=RATE_LIMIT_SLOTS):
+        self._name = name
+        self._size = slots * SLOT.size
+        self._shm = None
+        self._buf = None
+        self._lock_file = None
+        self._thread_lock = threading.Lock()
+        self._pid = None
+
+    def _attach(self):
+        # Re-attach after fork so every worker holds its own lock file descriptor
+        if self._pid == os.getpid():
+            return
+        try:
+            shm = shared_memory.SharedMemory(self._name, create=True, size=self._size)
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(self._name)
+        # The table outlives any single worker; keep the resource tracker from unlinking it on exit
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        self._shm = shm
+        self._buf = shm.buf
+        self._slots = len(shm.buf) // SLOT.size
+        self._lock_file = open(os.path.join(tempfile.gettempdir(), f'{self._name}.lock'), 'a')
+        self._pid = os.getpid()
+
+    def acquire(self, checks, cost=1.0):
+        """Take ``cost`` tokens from every ``(key_hash, Limit)`` bucket, or none of them.
+
+        Returns 0 when admitted, otherwise the seconds until the emptiest bucket
+        has refilled enough, and the scope of that bucket.
+        """
+        with self._thread_lock:
+            self._attach()
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                now = time.monotonic()
+                buckets = []
+                wait, scope = 0.0, None
+                for key_hash, limit in checks:
+                    offset, tokens, updated = self._find(key_hash, limit, now, [bucket[0] for bucket in buckets])
+                    tokens = min(limit.burst, tokens + (now - updated) * limit.rate)
+                    if tokens < cost:
+                        needed = (cost - tokens) / limit.rate
+                        if needed > wait:
+                            wait, scope = needed, limit.scope
+                    buckets.append((offset, key_hash, tokens))
+                if wait:
+                    return wait, scope
+                for offset, key_hash, tokens in buckets:
+                    SLOT.pack_into(self._buf, offset, key_hash, tokens - cost, now)
+                return 0.0, None
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _find(self, key_hash, limit, now, taken=()):
+        """Slot of a bucket as (offset, tokens, updated); claims a free or idle slot for new keys.
+
+        ``taken`` are the slots already chosen for the other buckets of the
+        same acquire; those are not written until the end, so a free slot
+        among them is free only in appearance.
+        """
+        start = key_hash % self._slots
+        claim = None
+        for probe in range(PROBES):
+            offset = ((start + probe) % self._slots) * SLOT.size
+            stored, tokens, updated = SLOT.unpack_from(self._buf, offset)
+            if stored == key_hash:
+                return offset, tokens, updated
+            if offset in taken:
+                continue
+            if claim is None and (stored == 0 or now - updated > RATE_LIMIT_IDLE_SECONDS):
+                claim = offset
+        if claim is None:
+            # Every probed slot is busy: reuse the least recently used one
+            claim = min(
+                (offset for offset in (((start + probe) % self._slots) * SLOT.size for probe in range(PROBES))
+                 if offset not in taken),
+                key=lambda offset: SLOT.unpack_from(self._buf, offset)[2]
+            )
+        return claim, limit.burst, now
+
+
+class RateLimiter:
+    def __init__(self, table, user=None, ip=None, overall=None):
+        self.table = table
+        self.user = user
+        self.ip = ip
+        self.overall = overall
+
+    @property
+    def enabled(self):
+        return any((self.user, self.ip, self.overall))
+
+    def check(self, user_id, ip):
+        """(seconds to wait, scope) for a request; (0, None) when it is admitted"""
+        checks = []
+        if self.user and user_id is not None:
+            checks.append((_key_hash('user', user_id), self.user))
+        if self.ip and ip:
+            checks.append((_key_hash('ip', ip), self.ip))
+        if self.overall:
+            checks.append((_key_hash('global', ''), self.overall))
+        if not checks:
+            return 0.0, None
+        return self.table.acquire(checks)
+
+
+rate_limiter = RateLimiter(
+    BucketTable(),
+    user=Limit.parse('user', RATE_LIMIT_USER),
+    ip=Limit.parse('ip', RATE_LIMIT_IP),
+    overall=Limit.parse('global', RATE_LIMIT_GLOBAL),
+)
+
+
+def rate_limited(f):
+    """Answer 429 with Retry-After when the caller is over its limits; use after verify_token"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if rate_limiter.enabled:
+            user = getattr(request, 'user', None) or {}
+            wait, scope = rate_limiter.check(user.get('userId'), request.remote_addr)
+            if wait:
+                retry_after = max(1, math.ceil(wait))
+                response = jsonify({'error': 'Rate limit exceeded', 'limit': scope, 'retry_after': retry_after})
+                response.headers['Retry-After'] = str(retry_after)
+                return response, 429
+        return f(*args, **kwargs)
+
+    return decorated_function
@@ -0,0 +1,166 @@
+"""Read/write splitting across the primary database and optional read replicas.
+
+Set DATABASE_REPLICA_URLS (comma separated) to send the queries of endpoints
+decorated with ``read_only`` to replicas, round-robin. Everything else, and
+any statement that writes, uses the primary (DATABASE_URL).
+
+A replica is only used while its replication lag is below
+REPLICA_MAX_LAG_SECONDS; lag is measured at most every
+REPLICA_LAG_CHECK_SECONDS per replica. Clients that committed a write within
+READ_YOUR_WRITES_SECONDS keep reading from the primary so they always see
+their own writes.
+
+Only the Flask-SQLAlchemy session is routed. With ANALYTICS_SHARD_URLS set,
+shard tasks run on their own sessions bound to the shard URLs, so every
+query reads from the shard primaries and ``read_only`` has no effect.
+"""
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import scoped_session
+
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_MAX_LAG_SECONDS = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_LAG_CHECK_SECONDS = float(os.getenv('REPLICA_LAG_CHECK_SECONDS', '2'))
+# A replica may be up to max lag behind, measured up to one check interval ago
+READ_YOUR_WRITES_SECONDS = float(
+    os.getenv('READ_YOUR_WRITES_SECONDS', str(REPLICA_MAX_LAG_SECONDS + REPLICA_LAG_CHECK_SECONDS))
+)
+MAX_TRACKED_WRITERS = 100000
+
+# Zero while the replica has replayed everything it received, otherwise the age of the last replayed commit
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url, pool_pre_ping=True, connect_args={'connect_timeout': 2})
+        self.lag = None
+        self.checked_at = None
+        self._lock = threading.Lock()
+
+    def usable(self):
+        """Whether the replica is reachable and within the lag budget (re-measured when stale)"""
+        now = time.monotonic()
+        if self.checked_at is None or now - self.checked_at >= REPLICA_LAG_CHECK_SECONDS:
+            # One request measures, concurrent ones use the previous reading
+            if self._lock.acquire(blocking=False):
+                try:
+                    self.lag = self._measure_lag()
+                    self.checked_at = time.monotonic()
+                finally:
+                    self._lock.release()
+        return self.lag is not None and self.lag <= REPLICA_MAX_LAG_SECONDS
+
+    def _measure_lag(self):
+        try:
+            with self.engine.connect() as connection:
+                return float(connection.execute(LAG_QUERY).scalar())
+        except Exception as e:
+            print(f"Replica {self.engine.url.host} unavailable: {str(e)}")
+            return None
+
+
+class ReplicaSet:
+    def __init__(self, urls):
+        self.replicas = [Replica(url) for url in urls]
+        self._next = itertools.count()
+        self._writers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def choose(self):
+        """Next usable replica engine in round-robin order, or None to use the primary"""
+        start = next(self._next)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.usable():
+                return replica.engine
+        return None
+
+    def remember_writer(self, client):
+        with self._lock:
+            self._writers[client] = time.monotonic() + READ_YOUR_WRITES_SECONDS
+            self._writers.move_to_end(client)
+            if len(self._writers) > MAX_TRACKED_WRITERS:
+                self._writers.popitem(last=False)
+
+    def wrote_recently(self, client):
+        with self._lock:
+            until = self._writers.get(client)
+            if until is None:
+                return False
+            if until < time.monotonic():
+                del self._writers[client]
+                return False
+            return True
+
+
+replica_set = ReplicaSet(DATABASE_REPLICA_URLS)
+
+
+def _client_key():
+    user = getattr(request, 'user', None)
+    user_id = user.get('userId') if user else None
+    return user_id if user_id is not None else f'ip:{request.remote_addr}'
+
+
+def read_only(view):
+    """Allow the endpoint's queries to be served by a read replica"""
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        if replica_set and not replica_set.wrote_recently(_client_key()):
+            g.read_replica = True
+        return view(*args, **kwargs)
+
+    return decorated_function
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends reads of ``read_only`` requests to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or not (has_request_context() and g.get('read_replica')):
+            return primary
+
+        if self._flushing or getattr(clause, 'is_dml', False):
+            # A write inside a read-only request pins the rest of it to the primary
+            self.info['wrote'] = True
+        if self.info.get('wrote'):
+            return primary
+
+        # Stay on one replica for the whole request so reads are mutually consistent
+        if 'replica' not in self.info:
+            self.info['replica'] = replica_set.choose()
+        return self.info['replica'] or primary
+
+
+def primary_bind(session):
+    """The engine ``session`` writes to, even inside a ``read_only`` request"""
+    if isinstance(session, scoped_session):
+        session = session()
+    if isinstance(session, RoutingSession):
+        return Session.get_bind(session)
+    return session.get_bind()
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _remember_writer(session):
+    if replica_set and has_request_context() and not g.get('read_replica'):
+        replica_set.remember_writer(_client_key())
@@ -0,0 +1,161 @@
+"""Cohort retention: users first seen in period W that come back in period W+k.
+
+The matrix is computed by one set-based statement per shard (users never span
+shards, so per-shard counts simply add up). Cells of closed periods cannot
+change any more, so they are cached; later calls only query the open period,
+restricted to the users active in it. The cache is dropped when a new period
+starts or after RETENTION_CACHE_SECONDS, which also picks up late corrections.
+
+Only events still in Postgres are considered, not the Parquet archive.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from dimensions import event_types
+
+RETENTION_CACHE_SECONDS = float(os.getenv('RETENTION_CACHE_SECONDS', '3600'))
+RETENTION_INTERVALS = ('day', 'week', 'month')
+MAX_COHORTS = 104
+
+RETENTION_SQL = """
+WITH firsts AS (
+    SELECT user_id, date_trunc('{interval}', min(timestamp)) AS cohort
+    FROM analytics_events
+    WHERE user_id IS NOT NULL {cohort_filter} {active_filter}
+    GROUP BY user_id
+    HAVING min(timestamp) >= :lower
+),
+activity AS (
+    SELECT DISTINCT user_id, date_trunc('{interval}', timestamp) AS period
+    FROM analytics_events
+    WHERE user_id IS NOT NULL AND timestamp >= :activity_from {return_filter}
+)
+SELECT f.cohort, a.period, count(*)
+FROM firsts f JOIN activity a ON a.user_id = f.user_id AND a.period >= f.cohort
+GROUP BY f.cohort, a.period
+UNION ALL
+SELECT cohort, NULL, count(*) FROM firsts WHERE cohort >= :sizes_from GROUP BY cohort
+"""
+
+
+def period_start(moment, interval):
+    """Python equivalent of Postgres date_trunc for the supported intervals"""
+    day = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def previous_periods(current, interval, count):
+    """``count`` period starts ending with ``current``, oldest first"""
+    periods = [current]
+    while len(periods) < count:
+        if interval == 'month':
+            periods.append(period_start(periods[-1] - timedelta(days=1), 'month'))
+        else:
+            periods.append(periods[-1] - timedelta(days=7 if interval == 'week' else 1))
+    return periods[::-1]
+
+
+def _shard_counts(session, interval, cohort_event, return_event, lower, activity_from, sizes_from, only_active_since=None):
+    """(cohort, period or None for the cohort size) -> users, for one shard"""
+    params = {'lower': lower, 'activity_from': activity_from, 'sizes_from': sizes_from}
+    filters = {'cohort_filter': '', 'return_filter': '', 'active_filter': ''}
+    type_ids = []
+    for name, value in (('cohort', cohort_event), ('return', return_event)):
+        if value is None:
+            continue
+        type_id = event_types.id_for(session, value)
+        if type_id is None:
+            # Never seen on this shard
+            if name == 'cohort':
+                return {}
+            type_id = -1
+        params[f'{name}_type'] = type_id
+        filters[f'{name}_filter'] = f'AND event_type_id = :{name}_type'
+        type_ids.append(type_id)
+
+    if only_active_since is not None:
+        # Incremental pass: only users that did something relevant in the open period
+        either = 'AND event_type_id IN :active_types' if len(type_ids) == 2 else ''
+        filters['active_filter'] = (
+            'AND user_id IN (SELECT user_id FROM analytics_events '
+            f'WHERE user_id IS NOT NULL AND timestamp >= :active_since {either})'
+        )
+        params['active_since'] = only_active_since
+        if either:
+            params['active_types'] = tuple(type_ids)
+
+    sql = text(RETENTION_SQL.format(interval=interval, **filters))
+    return {(cohort, period): users for cohort, period, users in session.execute(sql, params)}
+
+
+class RetentionCache:
+    """Closed-period cells per (cohort_event, return_event, interval)"""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, current):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry['current'] != current or time.monotonic() - entry['computed_at'] > RETENTION_CACHE_SECONDS:
+            return None
+        return entry
+
+    def put(self, key, current, lower, counts):
+        closed = {cell: users for cell, users in counts.items() if cell[0] < current and (cell[1] is None or cell[1] < current)}
+        with self._lock:
+            self._entries[key] = {'current': current, 'lower': lower, 'counts': closed, 'computed_at': time.monotonic()}
+
+
+retention_cache = RetentionCache()
+
+
+def _sum_counts(partials):
+    total = {}
+    for counts in partials:
+        for cell, users in counts.items():
+            total[cell] = total.get(cell, 0) + users
+    return total
+
+
+def retention_matrix(shard_set, cohort_event=None, return_event=None, interval='week', cohorts=12, now=None):
+    """Retention rows for the last ``cohorts`` periods, oldest cohort first"""
+    current = period_start(now or datetime.utcnow(), interval)
+    periods = previous_periods(current, interval, cohorts)
+    lower = periods[0]
+    key = (cohort_event, return_event, interval)
+
+    cached = retention_cache.get(key, current)
+    if cached is not None and cached['lower'] <= lower:
+        # Closed cells are known; only the open period (and the newest cohort's size) is queried
+        fresh = _sum_counts(shard_set.broadcast(
+            lambda session: _shard_counts(session, interval, cohort_event, return_event, lower, current, current, current)
+        ).values())
+        counts = {**cached['counts'], **fresh}
+    else:
+        counts = _sum_counts(shard_set.broadcast(
+            lambda session: _shard_counts(session, interval, cohort_event, return_event, lower, lower, lower)
+        ).values())
+        retention_cache.put(key, current, lower, counts)
+
+    index = {period: position for position, period in enumerate(periods)}
+    rows = []
+    for cohort in periods:
+        size = counts.get((cohort, None), 0)
+        returned = [counts.get((cohort, period), 0) for period in periods[index[cohort]:]]
+        rows.append({
+            'cohort': cohort.isoformat(),
+            'size': size,
+            'retained': returned,
+            'rates': [round(users / size, 4) if size else 0.0 for users in returned],
+        })
+    return rows
@@ -0,0 +1,58 @@
+"""Lean column projection and fast JSON serialization for event listings"""
+import orjson
+from flask import Response
+
+from models import AnalyticsEvent
+from dimensions import decode_dicts
+
+# Public field name -> mapped column (dictionary encoded fields select their id)
+EVENT_FIELDS = {
+    'id': AnalyticsEvent.id,
+    'event_uuid': AnalyticsEvent.event_uuid,
+    'event_type': AnalyticsEvent.event_type_id,
+    'user_id': AnalyticsEvent.user_id,
+    'session_id': AnalyticsEvent.session_id,
+    'page_path': AnalyticsEvent.page_path_id,
+    'metadata': AnalyticsEvent.event_metadata,
+    'ip_address': AnalyticsEvent.ip_address,
+    'user_agent': AnalyticsEvent.user_agent_id,
+    'timestamp': AnalyticsEvent.timestamp,
+}
+
+# metadata (JSON) and user_agent (Text) are only returned when asked for
+DEFAULT_EVENT_FIELDS = (
+    'id', 'event_uuid', 'event_type', 'user_id', 'session_id', 'page_path', 'ip_address', 'timestamp'
+)
+
+
+def parse_fields(raw):
+    """Parse a comma separated ``fields`` parameter into a tuple of field names.
+
+    Empty means the default projection, ``*`` means every field.
+    Raises ValueError on unknown names.
+    """
+    if not raw:
+        return DEFAULT_EVENT_FIELDS
+    if raw.strip() == '*':
+        return tuple(EVENT_FIELDS)
+
+    names = tuple(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    unknown = [name for name in names if name not in EVENT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown field(s): {', '.join(unknown)}")
+    return names or DEFAULT_EVENT_FIELDS
+
+
+def project(query, names):
+    """Restrict an event query to plain column tuples (no ORM instances)"""
+    return query.with_entities(*(EVENT_FIELDS[name] for name in names))
+
+
+def rows_to_dicts(session, names, rows):
+    """Zip projected row tuples back into field dictionaries with decoded dimensions"""
+    return decode_dicts(session, [dict(zip(names, row)) for row in rows])
+
+
+def json_response(payload, status=200):
+    """Serialize with orjson (datetimes are emitted as ISO 8601 natively)"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
@@ -0,0 +1,147 @@
+"""Hash sharding of event storage across several Postgres databases.
+
+Set ANALYTICS_SHARD_URLS to two or more comma separated database URLs to
+spread analytics_events (and the per-user tables) over them by a stable hash
+of user_id; anonymous events are placed by session_id. Every shard carries
+the full schema with its own lookup tables. init_db.py gives shard k the
+event ids k+1, k+1+n, k+1+2n, ... so ids stay unique and name their shard.
+
+Work is expressed as tasks taking a session. ``run`` executes them on the
+given shards in parallel, each on its own short-lived session. With fewer
+than two URLs there is a single shard, served by the Flask-SQLAlchemy
+session on DATABASE_URL, and tasks run inline.
+
+Sharding is meant for fresh databases; existing rows are not redistributed.
+"""
+import contextvars
+import heapq
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from models import db
+from ingest import insert_events
+
+ANALYTICS_SHARD_URLS = [url.strip() for url in os.getenv('ANALYTICS_SHARD_URLS', '').split(',') if url.strip()]
+# Pool threads per shard; the pool is shared by all request threads, so size it for their concurrency
+SHARD_THREADS_PER_SHARD = int(os.getenv('SHARD_THREADS_PER_SHARD', '16'))
+
+
+class ShardSet:
+    def __init__(self, urls):
+        self.urls = urls if len(urls) > 1 else []
+        self._engines = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def sharded(self):
+        return bool(self.urls)
+
+    def __len__(self):
+        return len(self.urls) or 1
+
+    def all(self):
+        return list(range(len(self)))
+
+    def shard_for(self, user_id, session_id=None):
+        """Shard holding a user's events (crc32, so stable across processes)"""
+        if not self.sharded:
+            return 0
+        key = user_id if user_id is not None else session_id
+        return zlib.crc32(str(key).encode()) % len(self)
+
+    def shard_for_event_id(self, event_id):
+        return (event_id - 1) % len(self)
+
+    def engine(self, shard):
+        with self._lock:
+            engine = self._engines.get(shard)
+            if engine is None:
+                engine = self._engines[shard] = create_engine(self.urls[shard], pool_pre_ping=True)
+            return engine
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=len(self) * SHARD_THREADS_PER_SHARD, thread_name_prefix='shard'
+                )
+            return self._executor
+
+    def _run_on(self, shard, task):
+        with Session(self.engine(shard)) as session:
+            return task(session)
+
+    def run(self, tasks):
+        """Run ``{shard: task(session)}`` concurrently; returns ``{shard: result}``.
+
+        Tasks commit their own writes. The first failing task's exception is
+        re-raised after all tasks finished.
+        """
+        if not self.sharded or not tasks:
+            return {shard: task(db.session) for shard, task in tasks.items()}
+        (own_shard, own_task), *others = tasks.items()
+        # Each task gets a copy of the caller's context so the request (endpoint, correlation id) stays visible
+        futures = {
+            shard: self._pool().submit(contextvars.copy_context().run, self._run_on, shard, task)
+            for shard, task in others
+        }
+        # The calling thread runs one task itself: a single-shard call never waits for the pool
+        try:
+            own_result = self._run_on(own_shard, own_task)
+        finally:
+            wait(futures.values())
+        results = {shard: future.result() for shard, future in futures.items()}
+        results[own_shard] = own_result
+        return results
+
+    def broadcast(self, task, shards=None):
+        return self.run({shard: task for shard in (self.all() if shards is None else shards)})
+
+    def insert(self, rows, session=None):
+        """Insert and commit ingest rows on their shards; IngestResults in input order.
+
+        ``session`` is used in the unsharded layout (defaults to db.session).
+        Shards commit independently, so a failure can leave the batch
+        partially stored; retries are safe for rows that carry an event_uuid.
+        """
+        if not self.sharded:
+            session = session or db.session
+            results = insert_events(session, rows)
+            session.commit()
+            return results
+
+        groups = {}
+        for index, row in enumerate(rows):
+            groups.setdefault(self.shard_for(row.get('user_id'), row.get('session_id')), []).append(index)
+
+        def writer(indexes):
+            def task(shard_session):
+                results = insert_events(shard_session, [rows[index] for index in indexes])
+                shard_session.commit()
+                return results
+            return task
+
+        written = self.run({shard: writer(indexes) for shard, indexes in groups.items()})
+        results = [None] * len(rows)
+        for shard, indexes in groups.items():
+            for index, result in zip(indexes, written[shard]):
+                results[index] = result
+        return results
+
+
+def merge_newest_first(pages, offset, limit):
+    """Merge per-shard event lists (each newest first) and cut one page out of the result"""
+    if len(pages) == 1:
+        return pages[0][offset:offset + limit]
+    merged = heapq.merge(*pages, key=lambda event: event['timestamp'], reverse=True)
+    return list(islice(merged, offset, offset + limit))
+
+
+shard_set = ShardSet(ANALYTICS_SHARD_URLS)
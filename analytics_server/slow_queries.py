@@ -0,0 +1,138 @@
+"""Slow-query log with sampled EXPLAIN capture.
+
+Every statement executed through a SQLAlchemy engine is timed. Statements
+slower than SLOW_QUERY_MS are recorded together with the endpoint and
+correlation id of the request that ran them. For a sample of slow SELECTs
+(SLOW_QUERY_EXPLAIN_SAMPLE, at most one per SLOW_QUERY_EXPLAIN_INTERVAL
+seconds) the plan is captured with ``EXPLAIN (ANALYZE, BUFFERS)`` on a
+background thread, so the slow request is not delayed further. The plan runs
+on a raw DBAPI connection, which bypasses these hooks and cannot recurse, in
+a read-only transaction that is rolled back. SELECTs with side effects that
+survive a rollback or outlive the transaction (sequence calls, advisory
+locks, row locks) are never re-run.
+
+Entries are kept in a bounded, process-local buffer.
+"""
+import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
+SLOW_QUERY_EXPLAIN_SAMPLE = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE', '0.2'))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.getenv('SLOW_QUERY_EXPLAIN_INTERVAL', '10'))
+SLOW_QUERY_LOG_SIZE = int(os.getenv('SLOW_QUERY_LOG_SIZE', '200'))
+EXPLAIN_TIMEOUT_MS = 30000
+MAX_STATEMENT_LENGTH = 5000
+
+# nextval()/setval() are not undone by a rollback and session advisory locks outlive it
+VOLATILE_STATEMENT = re.compile(
+    r'\b(?:nextval|setval|pg_\w*lock\w*)\s*\(|\bFOR\s+(?:NO\s+KEY\s+|KEY\s+)?(?:UPDATE|SHARE)\b',
+    re.IGNORECASE
+)
+
+
+class SlowQueryLog:
+    def __init__(self, size=SLOW_QUERY_LOG_SIZE):
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._last_explain = 0.0
+        self._explains = queue.Queue(maxsize=10)
+        self._worker = None
+
+    def record(self, engine, statement, parameters, duration_ms, executemany):
+        entry = {
+            'statement': statement[:MAX_STATEMENT_LENGTH],
+            'parameters': None if executemany else repr(parameters)[:1000],
+            'duration_ms': round(duration_ms, 2),
+            'database': engine.url.database,
+            'endpoint': request.endpoint if has_request_context() else None,
+            'path': request.path if has_request_context() else None,
+            'correlation_id': g.get('correlation_id') if has_request_context() else None,
+            'recorded_at': datetime.utcnow().isoformat(),
+            'plan': None,
+        }
+        with self._lock:
+            self._entries.append(entry)
+            explain = self._should_explain(engine, statement, executemany)
+        if explain:
+            try:
+                self._explains.put_nowait((engine, statement, parameters, entry))
+                self._ensure_worker()
+            except queue.Full:
+                pass
+
+    def _should_explain(self, engine, statement, executemany):
+        if executemany or engine.dialect.name != 'postgresql':
+            return False
+        # Only plain reads: EXPLAIN ANALYZE executes the statement again
+        if statement.lstrip().split(None, 1)[0].upper() != 'SELECT' or VOLATILE_STATEMENT.search(statement):
+            return False
+        now = time.monotonic()
+        if now - self._last_explain < SLOW_QUERY_EXPLAIN_INTERVAL or random.random() >= SLOW_QUERY_EXPLAIN_SAMPLE:
+            return False
+        self._last_explain = now
+        return True
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._explain_forever, name='slow-query-explain', daemon=True)
+                self._worker.start()
+
+    def _explain_forever(self):
+        while True:
+            engine, statement, parameters, entry = self._explains.get()
+            try:
+                plan = explain(engine, statement, parameters)
+            except Exception as e:
+                plan = f'EXPLAIN failed: {e}'
+            with self._lock:
+                entry['plan'] = plan
+
+    def entries(self, endpoint=None, limit=50):
+        """Recorded statements, newest first"""
+        if limit <= 0:
+            return []
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries]
+        if endpoint:
+            entries = [entry for entry in entries if entry['endpoint'] == endpoint]
+        return entries[-limit:][::-1]
+
+
+def explain(engine, statement, parameters):
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        # The connection is not in autocommit mode: these run in one transaction, rolled back below
+        cursor.execute('SET TRANSACTION READ ONLY')
+        cursor.execute(f'SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}')
+        cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {statement}', parameters)
+        return '\n'.join(row[0] for row in cursor.fetchall())
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+slow_query_log = SlowQueryLog()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    duration_ms = (time.perf_counter() - conn.info['query_started']) * 1000
+    if duration_ms >= SLOW_QUERY_MS:
+        slow_query_log.record(conn.engine, statement, parameters, duration_ms, executemany)
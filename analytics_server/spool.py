@@ -0,0 +1,443 @@
+"""Durable local spool for tracked events while Postgres is unavailable.
+
+When an insert fails because the database cannot be reached (or inserts get
+slower than SPOOL_SLOW_INSERT_MS), the tracking endpoints stop trying the
+database and append events here instead, answering 202. A replayer thread
+probes the database and, once it answers again, moves the spooled events
+into it in large batches, oldest first.
+
+The spool is a directory of append-only segment files of up to
+SPOOL_SEGMENT_BYTES. Every record is ``<length><crc32><payload>`` with the
+payload in the event queue's message format, so a torn write at the end of
+a segment is detected and skipped. Appends are made durable with fsync;
+concurrent appends share one fsync (group commit). Events get an event_uuid
+before they are spooled, so replaying a segment again after a crash cannot
+store them twice. A fully replayed segment is deleted.
+
+Each process claims its own subdirectory (w0, w1, ...) with an fcntl lock,
+so workers never share a segment and a restarted worker picks up the
+segments its predecessor left behind. Appends beyond SPOOL_MAX_BYTES are
+refused. SPOOL_DIR has to outlive the container: the image points it at
+/var/lib/analytics/spool, which docker-compose mounts as a volume.
+
+A segment whose replay fails SPOOL_MAX_REPLAY_FAILURES times for reasons
+other than the database being unreachable is renamed to ``*.quarantined``
+and left for an operator, so it cannot hold back the segments after it.
+"""
+import fcntl
+import itertools
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import DataError, IntegrityError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from event_queue import decode_message, encode_message, prepare_rows
+from models import db
+from shards import shard_set
+
+SPOOL_ENABLED = os.getenv('SPOOL_ENABLED', 'true').lower() == 'true'
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool'))
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', str(1024 * 1024 * 1024)))
+SPOOL_SLOW_INSERT_MS = float(os.getenv('SPOOL_SLOW_INSERT_MS', '2000'))
+SPOOL_REPLAY_INTERVAL = float(os.getenv('SPOOL_REPLAY_INTERVAL', '1'))
+SPOOL_REPLAY_BATCH = int(os.getenv('SPOOL_REPLAY_BATCH', '5000'))
+SPOOL_MAX_REPLAY_FAILURES = int(os.getenv('SPOOL_MAX_REPLAY_FAILURES', '5'))
+
+# Payload length and crc32 of the payload
+RECORD_HEADER = struct.Struct('<II')
+SEGMENT_SUFFIX = '.seg'
+QUARANTINE_SUFFIX = '.quarantined'
+
+# Errors that may mean the database is unreachable; database_unavailable() decides
+UNAVAILABLE_ERRORS = (OperationalError, InterfaceError, PoolTimeoutError)
+# Server shutting down, starting up or out of connection slots (class 08, connection exceptions, too)
+UNAVAILABLE_SQLSTATES = {'57P01', '57P02', '57P03', '53300'}
+
+
+class SpoolFull(Exception):
+    pass
+
+
+def database_unavailable(error):
+    """Whether the database could not take the write, as opposed to rejecting the statement.
+
+    Statement timeouts, deadlocks, a full disk and the like are
+    OperationalErrors too, but spooling would not help with them.
+    """
+    if isinstance(error, PoolTimeoutError):
+        return True
+    if not isinstance(error, (OperationalError, InterfaceError)):
+        return False
+    if error.connection_invalidated:
+        return True
+    # Errors raised before the server answered (refused, reset, closed) carry no SQLSTATE
+    code = getattr(error.orig, 'pgcode', None)
+    return code is None or code.startswith('08') or code in UNAVAILABLE_SQLSTATES
+
+
+class DatabaseHealth:
+    """Whether ingest should try Postgres or go straight to the spool"""
+
+    def __init__(self):
+        self.healthy = True
+        self.reason = None
+        self.since = None
+        self._lock = threading.Lock()
+
+    def failed(self, reason):
+        with self._lock:
+            if self.healthy:
+                self.healthy, self.reason, self.since = False, reason, datetime.utcnow()
+
+    def observe_insert(self, duration_ms):
+        if duration_ms > SPOOL_SLOW_INSERT_MS:
+            self.failed(f'insert took {duration_ms:.0f}ms')
+
+    def recovered(self):
+        with self._lock:
+            self.healthy, self.reason, self.since = True, None, None
+
+
+def _segment_number(name):
+    return int(name[:-len(SEGMENT_SUFFIX)])
+
+
+def read_segment(path):
+    """Row lists of a segment's intact records, and whether the whole file was intact"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    records, position = [], 0
+    while position + RECORD_HEADER.size <= len(data):
+        length, checksum = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        try:
+            records.append(decode_message(payload))
+        except (ValueError, KeyError, TypeError):
+            break
+        position = start + length
+    return records, position == len(data)
+
+
+class Spool:
+    def __init__(self, root=SPOOL_DIR, segment_bytes=SPOOL_SEGMENT_BYTES, max_bytes=SPOOL_MAX_BYTES):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.health = DatabaseHealth()
+        self.directory = None
+        self.spooled_events = 0
+        self.replayed_events = 0
+        self.dropped_events = 0
+        self.corrupt_segments = 0
+        self.quarantined_segments = 0
+
+        self._dir_lock = None
+        self._fd = None
+        self._segment = None
+        self._segment_size = 0
+        self._next_segment = 0
+        self._bytes = 0
+        self._appended = 0
+        self._durable = 0
+        self._syncing = False
+        self._cond = threading.Condition()
+        self._replayer = None
+        self._listeners = []
+        self._replay_failures = {}
+
+    # --- Segment files ------------------------------------------------------
+
+    def _claim_directory(self):
+        """Lock the first free per-process subdirectory and take over its segments"""
+        for index in itertools.count():
+            directory = os.path.join(self.root, f'w{index}')
+            os.makedirs(directory, exist_ok=True)
+            lock = open(os.path.join(directory, '.lock'), 'a')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            self._dir_lock, self.directory = lock, directory
+            names = self._segment_names()
+            self._next_segment = _segment_number(names[-1]) + 1 if names else 0
+            self._bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+            return
+
+    def _segment_names(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(SEGMENT_SUFFIX))
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f'{self._next_segment:012d}{SEGMENT_SUFFIX}')
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # Make the new directory entry durable too
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._segment, self._segment_size = path, 0
+        self._next_segment += 1
+
+    def _close_segment(self):
+        """Called with the lock held and no fsync in flight"""
+        os.fsync(self._fd)
+        os.close(self._fd)
+        self._durable = self._appended
+        self._fd, self._segment, self._segment_size = None, None, 0
+
+    def seal(self):
+        """Close the segment being written so the replayer can take it; False if there was none"""
+        with self._cond:
+            while self._syncing:
+                self._cond.wait()
+            if self._fd is None:
+                return False
+            self._close_segment()
+            return True
+
+    # --- Appending ----------------------------------------------------------
+
+    def append(self, rows):
+        """Durably spool ingest rows; returns them with event_uuid and timestamp filled in"""
+        rows = prepare_rows(rows)
+        payload = encode_message(rows)
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+        with self._cond:
+            if self.directory is None:
+                self._claim_directory()
+            if self._bytes + len(record) > self.max_bytes:
+                raise SpoolFull(f'Event spool is full ({self._bytes} bytes)')
+            if self._fd is None:
+                self._open_segment()
+            os.write(self._fd, record)
+            self._segment_size += len(record)
+            self._bytes += len(record)
+            self._appended += 1
+            ticket = self._appended
+
+            # Group commit: one writer fsyncs on behalf of everyone who wrote before it started
+            while self._durable < ticket:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                self._syncing = True
+                target, fd = self._appended, self._fd
+                self._cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                    self._cond.notify_all()
+                self._durable = max(self._durable, target)
+
+            if self._segment_size >= self.segment_bytes and not self._syncing:
+                self._close_segment()
+            self.spooled_events += len(rows)
+        return rows
+
+    # --- Replay -------------------------------------------------------------
+
+    def _sealed_segments(self):
+        with self._cond:
+            if self.directory is None:
+                return []
+            return [
+                os.path.join(self.directory, name) for name in self._segment_names()
+                if os.path.join(self.directory, name) != self._segment
+            ]
+
+    def add_listener(self, callback):
+        """Call ``callback(rows, results)`` for every batch of replayed rows"""
+        self._listeners.append(callback)
+
+    def _stored(self, rows, results):
+        for listener in self._listeners:
+            listener(rows, results)
+
+    def _insert_records(self, session, records):
+        """Insert in batches; a batch the database rejects is retried record by record"""
+        batch = []
+        for rows in records + [None]:
+            if rows is not None:
+                batch.append(rows)
+                if sum(len(rows) for rows in batch) < SPOOL_REPLAY_BATCH:
+                    continue
+            if not batch:
+                continue
+            try:
+                combined = [row for rows in batch for row in rows]
+                self._stored(combined, shard_set.insert(combined, session))
+            except (DataError, IntegrityError):
+                session.rollback()
+                for rows in batch:
+                    try:
+                        self._stored(rows, shard_set.insert(rows, session))
+                    except (DataError, IntegrityError) as e:
+                        session.rollback()
+                        print(f"Dropping spooled events that cannot be stored: {e}")
+                        self.dropped_events += len(rows)
+            batch = []
+
+    def _quarantine(self, path, error):
+        size = os.path.getsize(path)
+        os.rename(path, path + QUARANTINE_SUFFIX)
+        print(f"Quarantined spool segment {path} after {SPOOL_MAX_REPLAY_FAILURES} failed replays: {error}")
+        with self._cond:
+            self._bytes -= size
+            self.quarantined_segments += 1
+
+    def replay(self, session):
+        """Move spooled events into the database, oldest segment first"""
+        for sealed in (False, True):
+            if sealed and not self.seal():
+                break
+            for path in self._sealed_segments():
+                records, intact = read_segment(path)
+                if not intact and path not in self._replay_failures:
+                    print(f"Spool segment {path} ends in a damaged record; replaying the intact part")
+                    self.corrupt_segments += 1
+                try:
+                    self._insert_records(session, records)
+                except Exception as e:
+                    if isinstance(e, UNAVAILABLE_ERRORS) and database_unavailable(e):
+                        raise
+                    session.rollback()
+                    failures = self._replay_failures[path] = self._replay_failures.get(path, 0) + 1
+                    if failures < SPOOL_MAX_REPLAY_FAILURES:
+                        raise
+                    del self._replay_failures[path]
+                    self._quarantine(path, e)
+                    continue
+                self._replay_failures.pop(path, None)
+                size = os.path.getsize(path)
+                os.remove(path)
+                with self._cond:
+                    self._bytes -= size
+                    self.replayed_events += sum(len(rows) for rows in records)
+
+    def _probe(self, session):
+        def ping(shard_session):
+            shard_session.execute(text('SELECT 1'))
+            shard_session.rollback()
+        shard_set.broadcast(ping)
+
+    def replay_forever(self, session):
+        while True:
+            time.sleep(SPOOL_REPLAY_INTERVAL)
+            try:
+                if not self.health.healthy:
+                    self._probe(session)
+                self.replay(session)
+                self.health.recovered()
+            except UNAVAILABLE_ERRORS as e:
+                session.rollback()
+                if database_unavailable(e):
+                    self.health.failed(str(e).splitlines()[0])
+                else:
+                    print(f"Spool replay failed: {e}")
+            except Exception as e:
+                session.rollback()
+                print(f"Spool replay failed: {e}")
+
+    def start_replayer(self, app, db):
+        """Claim this process's directory (and what an earlier run left in it) and start replaying"""
+        with self._cond:
+            if self._replayer is not None:
+                return self._replayer
+            if self.directory is None:
+                self._claim_directory()
+
+            def run():
+                with app.app_context():
+                    self.replay_forever(db.session)
+
+            self._replayer = threading.Thread(target=run, name='spool-replayer', daemon=True)
+            self._replayer.start()
+            return self._replayer
+
+    # --- Metrics ------------------------------------------------------------
+
+    def _oldest_event_time(self):
+        for path in self._sealed_segments() + ([self._segment] if self._segment else []):
+            try:
+                with open(path, 'rb') as f:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        continue
+                    length, _ = RECORD_HEADER.unpack(header)
+                    rows = decode_message(f.read(length))
+            except FileNotFoundError:
+                # Replayed (or quarantined) since the listing; the next segment is the oldest now
+                continue
+            except (ValueError, KeyError, TypeError):
+                continue
+            if rows:
+                return rows[0]['timestamp']
+        return None
+
+    def metrics(self):
+        oldest = self._oldest_event_time()
+        with self._cond:
+            segments = len(self._segment_names()) if self.directory else 0
+            return {
+                'enabled': SPOOL_ENABLED,
+                'directory': self.directory,
+                'segments': segments,
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'oldest_event_age_seconds': (
+                    round((datetime.utcnow() - oldest).total_seconds(), 3) if oldest else None
+                ),
+                'spooled_events': self.spooled_events,
+                'replayed_events': self.replayed_events,
+                'dropped_events': self.dropped_events,
+                'corrupt_segments': self.corrupt_segments,
+                'quarantined_segments': self.quarantined_segments,
+                'database_healthy': self.health.healthy,
+                'database_unhealthy_reason': self.health.reason,
+                'database_unhealthy_since': self.health.since.isoformat() if self.health.since else None,
+            }
+
+
+spool = Spool()
+
+
+def store_events(rows):
+    """Insert ingest rows, or spool them while the database is unavailable.
+
+    Returns ``(results, None)`` after an insert and ``(None, rows)`` when the
+    rows were spooled instead. Errors that are not about availability are
+    raised as before.
+    """
+    if SPOOL_ENABLED and not spool.health.healthy:
+        return None, spool.append(rows)
+    if SPOOL_ENABLED and shard_set.sharded:
+        # Shards commit separately; ids let a spooled retry skip the part that did get stored
+        for row in rows:
+            if row['event_uuid'] is None:
+                row['event_uuid'] = uuid.uuid4()
+    started = time.perf_counter()
+    try:
+        results = shard_set.insert(rows)
+    except UNAVAILABLE_ERRORS as e:
+        if not SPOOL_ENABLED or not database_unavailable(e):
+            raise
+        db.session.rollback()
+        spool.health.failed(str(e).splitlines()[0])
+        return None, spool.append(rows)
+    spool.health.observe_insert((time.perf_counter() - started) * 1000)
+    return results, None
@@ -0,0 +1,118 @@
+"""Live event feed: an in-memory ring buffer served as Server-Sent Events.
+
+The ingest path appends accepted events to a fixed-size ring. Each SSE client
+keeps only a cursor into it, so memory stays bounded by the ring no matter how
+many clients are connected or how slow they read. A client that falls further
+behind than the ring reaches gets a ``gap`` event and continues from the
+oldest retained event.
+
+The ring is per process. With several workers or replicas behind a load
+balancer a client sees only the events accepted by the process it is
+connected to, and sequence numbers (the SSE ``id``) are local to it; run a
+single process, or route stream clients and tracking traffic together, when
+a complete feed matters. With INGEST_MODE=queue events are appended by the
+process that accepted the request, not by the ingest worker.
+"""
+import os
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+import orjson
+
+STREAM_BUFFER_SIZE = int(os.getenv('STREAM_BUFFER_SIZE', '10000'))
+STREAM_HEARTBEAT_SECONDS = float(os.getenv('STREAM_HEARTBEAT_SECONDS', '15'))
+STREAM_MAX_BATCH = 500
+
+
+class EventRing:
+    """Fixed-capacity ring of (seq, event_type, user_id, payload) entries"""
+
+    def __init__(self, capacity=STREAM_BUFFER_SIZE):
+        self._entries = deque(maxlen=capacity)
+        self._last_seq = 0
+        self._changed = threading.Condition()
+
+    @property
+    def last_seq(self):
+        return self._last_seq
+
+    def append(self, events):
+        """Add event dictionaries; never waits on readers beyond a short lock"""
+        encoded = [(event.get('event_type'), event.get('user_id'), orjson.dumps(event)) for event in events]
+        if not encoded:
+            return
+        with self._changed:
+            for event_type, user_id, payload in encoded:
+                self._last_seq += 1
+                self._entries.append((self._last_seq, event_type, user_id, payload))
+            self._changed.notify_all()
+
+    def read_after(self, seq, timeout):
+        """Entries newer than ``seq`` (waiting up to ``timeout`` for some) and whether any were lost"""
+        with self._changed:
+            if self._last_seq <= seq:
+                self._changed.wait(timeout)
+            if not self._entries or self._last_seq <= seq:
+                return [], False
+            first_seq = self._entries[0][0]
+            start = max(0, seq + 1 - first_seq)
+            return list(islice(self._entries, start, start + STREAM_MAX_BATCH)), seq + 1 < first_seq
+
+
+event_ring = EventRing()
+
+
+def publish_events(rows, results=None):
+    """Append stored (or queued) ingest rows to the live feed, skipping duplicates"""
+    events = []
+    for index, row in enumerate(rows):
+        result = results[index] if results else None
+        if result is not None and result.deduplicated:
+            continue
+        timestamp = result.timestamp if result is not None else row.get('timestamp')
+        events.append({
+            'id': result.event_id if result is not None else None,
+            'event_uuid': row.get('event_uuid'),
+            'event_type': row['event_type'],
+            'user_id': row.get('user_id'),
+            'session_id': row.get('session_id'),
+            'page_path': row.get('page_path'),
+            'metadata': row.get('event_metadata'),
+            'timestamp': timestamp,
+        })
+    event_ring.append(events)
+
+
+def sse_messages(ring, last_event_id=None, event_types=None, user_id=None):
+    """Generate the text/event-stream body for one client"""
+    # An id from before a restart or from another process cannot be resumed; go live
+    cursor = last_event_id if last_event_id is not None and last_event_id <= ring.last_seq else ring.last_seq
+
+    yield 'retry: 2000\n\n'
+    last_write = time.monotonic()
+    while True:
+        entries, lost = ring.read_after(cursor, STREAM_HEARTBEAT_SECONDS)
+        if lost:
+            yield 'event: gap\ndata: {}\n\n'
+        if not entries:
+            yield ': keepalive\n\n'
+            last_write = time.monotonic()
+            continue
+
+        chunk = []
+        for seq, event_type, event_user_id, payload in entries:
+            if event_types and event_type not in event_types:
+                continue
+            if user_id is not None and event_user_id != user_id:
+                continue
+            chunk.append(f'id: {seq}\nevent: analytics_event\ndata: {payload.decode()}\n\n')
+        cursor = entries[-1][0]
+        if chunk:
+            yield ''.join(chunk)
+            last_write = time.monotonic()
+        elif time.monotonic() - last_write > STREAM_HEARTBEAT_SECONDS:
+            # Keep filtered-out clients' connections from idling out
+            yield ': keepalive\n\n'
+            last_write = time.monotonic()
@@ -0,0 +1,70 @@
+"""Shared fixtures.
+
+Tests that need Postgres use TEST_DATABASE_URL and are skipped without it;
+the database is emptied before each of them.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+
+
+@pytest.fixture(scope='session')
+def database_app():
+    if not TEST_DATABASE_URL:
+        pytest.skip('TEST_DATABASE_URL is not set')
+    from flask import Flask
+    from models import db
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = TEST_DATABASE_URL
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.fixture
+def session(database_app):
+    from sqlalchemy import text
+    from dimensions import event_types, page_paths, user_agents
+    from models import db
+
+    with database_app.app_context():
+        tables = ', '.join(table.name for table in db.metadata.sorted_tables)
+        db.session.execute(text(f'TRUNCATE {tables} RESTART IDENTITY CASCADE'))
+        db.session.commit()
+        # Cached lookup ids would point at truncated rows
+        for cache in (event_types, page_paths, user_agents):
+            cache._databases.clear()
+        yield db.session
+        db.session.rollback()
+
+
+@pytest.fixture(scope='session')
+def api(database_app):
+    """Test client of the real app on the test database, without its background workers"""
+    import daily_summaries
+    import spool
+
+    os.environ['DATABASE_URL'] = TEST_DATABASE_URL
+    os.environ['SWAGGER_ENABLED'] = 'false'
+    # app.py starts these threads on import when enabled
+    spool.SPOOL_ENABLED = False
+    daily_summaries.DAILY_SUMMARIES_ENABLED = False
+    from app import app
+
+    return app.test_client()
+
+
+@pytest.fixture
+def auth():
+    import jwt
+    from auth_middleware import JWT_SECRET
+
+    return {'Authorization': f"Bearer {jwt.encode({'sub': '1'}, JWT_SECRET, algorithm='HS256')}"}
@@ -0,0 +1,25 @@
+"""Event rows for tests that store events"""
+from datetime import datetime, timedelta
+
+from ingest import insert_events
+
+START = datetime(2026, 1, 1, 12, 0)
+
+
+def make_row(user_id, session_id=None, minute=0, event_type='view', page_path=None):
+    return {
+        'event_uuid': None,
+        'event_type': event_type,
+        'user_id': user_id,
+        'session_id': session_id,
+        'page_path': page_path,
+        'event_metadata': {},
+        'ip_address': None,
+        'user_agent': None,
+        'timestamp': START + timedelta(minutes=minute),
+    }
+
+
+def store(session, rows):
+    insert_events(session, rows)
+    session.commit()
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from archive import archive_events, cold_store
+from helpers import make_row, store
+from models import AnalyticsEvent
+
+
+@pytest.fixture
+def archived(session, tmp_path, monkeypatch):
+    """One event of user 1 moved to an archive under tmp_path, one left in Postgres; returns their ids"""
+    now = datetime.utcnow()
+    old, recent = make_row(1), make_row(1)
+    old['timestamp'], recent['timestamp'] = now - timedelta(days=400), now - timedelta(days=1)
+    store(session, [old, recent])
+    old_id, recent_id = (event.id for event in session.query(AnalyticsEvent).order_by(AnalyticsEvent.timestamp))
+
+    assert archive_events(session, older_than_days=30, root=str(tmp_path)) == 1
+    monkeypatch.setattr(cold_store, 'root', str(tmp_path))
+    return old_id, recent_id
+
+
+def test_deletes_reaching_before_the_archive_cutoff_are_refused(session, api, auth, archived):
+    old_id, recent_id = archived
+
+    response = api.delete('/api/analytics/events?user_id=1', headers=auth)
+    assert response.status_code == 409
+    assert session.query(AnalyticsEvent).count() == 1
+
+    response = api.delete(f'/api/analytics/event/{old_id}', headers=auth)
+    assert response.status_code == 409
+
+    cutoff = cold_store.cutoff.isoformat()
+    response = api.delete(f'/api/analytics/events?user_id=1&start_date={cutoff}', headers=auth)
+    assert response.status_code == 200
+    assert response.get_json()['deleted_count'] == 1
+    assert api.delete(f'/api/analytics/event/{recent_id}', headers=auth).status_code == 404
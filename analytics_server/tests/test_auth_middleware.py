@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+from flask import Flask, jsonify, request
+
+from auth_middleware import JWT_SECRET, issue_stream_token, verify_stream_token, verify_token
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+
+    @app.route('/stream')
+    @verify_stream_token
+    def stream():
+        return jsonify(request.user)
+
+    @app.route('/api')
+    @verify_token
+    def api():
+        return jsonify(request.user)
+
+    return app.test_client()
+
+
+def bearer(token):
+    return {'Authorization': f'Bearer {token}'}
+
+
+def test_stream_token_opens_only_the_stream(client):
+    token = issue_stream_token({'userId': 7, 'name': 'x'})
+    response = client.get(f'/stream?token={token}')
+    assert response.status_code == 200
+    assert response.json['userId'] == '7'
+    assert client.get('/api', headers=bearer(token)).status_code == 401
+
+
+def test_stream_accepts_header_but_not_api_token_in_url(client):
+    token = jwt.encode({'sub': '7'}, JWT_SECRET, algorithm='HS256')
+    assert client.get('/stream', headers=bearer(token)).status_code == 200
+    assert client.get(f'/stream?token={token}').status_code == 401
+    assert client.get('/stream').status_code == 401
+
+
+def test_expired_stream_token(client):
+    past = datetime.utcnow() - timedelta(minutes=5)
+    token = jwt.encode({'scope': 'analytics_stream', 'exp': past}, JWT_SECRET, algorithm='HS256')
+    assert client.get(f'/stream?token={token}').json['error'] == 'Token expired'
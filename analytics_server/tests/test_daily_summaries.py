@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from sqlalchemy import delete
+
+from daily_summaries import daily_summaries, trim_pages
+from helpers import START, make_row, store
+from models import AnalyticsEvent, DailySummary
+
+NOW = START + timedelta(days=2)
+
+
+def snapshot(session, day):
+    session.expire_all()
+    return session.get(DailySummary, day)
+
+
+def test_writes_to_a_closed_day_rebuild_its_snapshot(session):
+    store(session, [make_row(1, page_path='/a'), make_row(2, page_path='/b', event_type='purchase')])
+    daily_summaries.refresh(NOW)
+    day = START.date()
+    assert snapshot(session, day).complete
+    assert snapshot(session, day).summary['event_count'] == 2
+
+    # A replayed event and a delete, both after the day was closed
+    store(session, [make_row(3, page_path='/a')])
+    session.execute(delete(AnalyticsEvent).where(AnalyticsEvent.user_id == 2))
+    session.commit()
+    daily_summaries.reopen([START, None], NOW)
+    assert not snapshot(session, day).complete
+
+    assert day in daily_summaries.refresh(NOW)
+    rebuilt = snapshot(session, day)
+    assert rebuilt.complete
+    assert rebuilt.summary['event_type_counts'] == {'view': 2}
+    assert rebuilt.summary['top_pages'] == [{'page_path': '/a', 'count': 2}]
+
+
+def test_open_days_reopen_nothing(session):
+    store(session, [make_row(1)])
+    daily_summaries.refresh(START)
+    daily_summaries.reopen([START], START)
+    assert not snapshot(session, START.date()).complete
+    assert snapshot(session, START.date()).state is not None
+
+
+def test_trim_pages_keeps_the_busiest_pages():
+    counters = {'page_counts': {'/a': 5, '/b': 1, '/c': 3}, 'other_pages': 2}
+    assert trim_pages(counters, keep=2) == {'page_counts': {'/a': 5, '/c': 3}, 'other_pages': 3}
+    assert trim_pages(counters, keep=3) is counters
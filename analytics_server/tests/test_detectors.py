@@ -0,0 +1,12 @@
+from detectors import RateDetector, RateRule
+
+
+def test_recent_alerts_respects_the_limit():
+    detector = RateDetector([RateRule('login_failed', threshold=1, window_seconds=60)])
+    for user_id in range(3):
+        detector.observe('login_failed', user_id=user_id, now=0)
+
+    assert [alert['user_id'] for alert in detector.recent_alerts(limit=2)] == [2, 1]
+    assert detector.recent_alerts(limit=0) == []
+    assert detector.recent_alerts(limit=-1) == []
+    assert len(detector.recent_alerts(limit=10)) == 3
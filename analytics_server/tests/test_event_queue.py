@@ -0,0 +1,21 @@
+from event_queue import LocalTransport
+
+
+def test_recover_requeues_unacked_deliveries():
+    transport = LocalTransport()
+    for body in (b'a', b'b', b'c'):
+        transport.publish(body)
+
+    deliveries = transport.deliveries(prefetch=2, inactivity_timeout=0.01)
+    (first, _), (second, _) = next(deliveries), next(deliveries)
+    transport.ack_upto(first)
+    # The consumer dies holding the second delivery
+    transport.recover()
+
+    bodies = []
+    for tag, body in transport.deliveries(prefetch=10, inactivity_timeout=0.01):
+        if tag is None:
+            break
+        bodies.append(body)
+        transport.ack_upto(tag)
+    assert sorted(bodies) == [b'b', b'c']
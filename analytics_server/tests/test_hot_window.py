@@ -0,0 +1,101 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from aggregates import aggregate, parse_group_by, parse_metrics, parse_order_by
+from dimensions import event_type_filter
+from helpers import make_row, store
+from hot_window import HotWindow
+from models import AnalyticsEvent
+from shards import shard_set
+
+NOW = datetime.utcnow()
+
+
+def sql_query(session, filters):
+    user_id, event_type, start_date, end_date = filters
+    query = session.query(AnalyticsEvent)
+    if user_id:
+        query = query.filter(AnalyticsEvent.user_id == user_id)
+    if event_type:
+        query = query.filter(event_type_filter(session, event_type))
+    if start_date:
+        query = query.filter(AnalyticsEvent.timestamp >= start_date)
+    if end_date:
+        query = query.filter(AnalyticsEvent.timestamp <= end_date)
+    return query
+
+
+def sql_aggregate(group_by, metrics, order_by, limit, filters):
+    dimensions, metrics = parse_group_by(group_by), parse_metrics(metrics)
+    order = parse_order_by(order_by, dimensions, metrics)
+    rows = aggregate(shard_set, shard_set.all(), lambda session: sql_query(session, filters), dimensions, metrics, order, limit)
+    return dimensions, metrics, order, rows
+
+
+@pytest.fixture
+def window(session):
+    random.seed(7)
+    rows = []
+    for _ in range(300):
+        row = make_row(
+            random.choice([None, 1, 2, 3, 4]),
+            event_type=random.choice(['view', 'click', 'buy']),
+            page_path=random.choice([None, '/a', '/b'])
+        )
+        row['timestamp'] = NOW - timedelta(minutes=random.randrange(0, 5 * 60))
+        rows.append(row)
+    store(session, rows)
+
+    window = HotWindow(capacity=1000, hours=6)
+    window._warm()
+    return window
+
+
+FILTERS = [
+    (None, None, NOW - timedelta(hours=5), None),
+    (2, None, NOW - timedelta(hours=5), None),
+    (None, 'buy', NOW - timedelta(hours=3), NOW - timedelta(hours=1)),
+    (None, 'unknown', NOW - timedelta(hours=5), None),
+]
+
+
+@pytest.mark.parametrize('filters', FILTERS)
+def test_counts_match_sql(session, window, filters):
+    query = sql_query(session, filters)
+    assert window.count(filters) == query.count()
+
+    expected = {}
+    for event in query:
+        expected[event.event_type] = expected.get(event.event_type, 0) + 1
+    assert window.event_type_counts(filters) == expected
+
+
+@pytest.mark.parametrize('group_by', ['', 'event_type', 'page_path,user_id', 'time:hour,event_type', 'time:day', 'time:week', 'time:month'])
+@pytest.mark.parametrize('order_by', [None, '-count'])
+def test_aggregates_match_sql(session, window, group_by, order_by):
+    for filters in FILTERS:
+        dimensions, metrics, order, expected = sql_aggregate(group_by, 'count,count_distinct:user_id', order_by, 1000, filters)
+        assert window.aggregate(filters, dimensions, metrics, order, 1000) == expected
+
+
+def test_uncovered_ranges_go_to_the_database(window):
+    assert window.count((None, None, NOW - timedelta(hours=7), None)) is None
+    assert window.count((None, None, None, None)) is None
+
+
+def test_updates_and_deletes_are_applied_in_place(session, window):
+    events = session.query(AnalyticsEvent).order_by(AnalyticsEvent.id).limit(3).all()
+    events[0].event_type, events[0].user_id, events[0].page_path = 'renamed', 9, '/z'
+    events[1].user_id = None
+    session.commit()
+    window.update([event.to_dict() for event in events[:2]])
+    session.delete(events[2])
+    session.commit()
+    window.forget(event_ids=[events[2].id])
+
+    filters = (None, None, NOW - timedelta(hours=5), None)
+    assert window._since is not None
+    dimensions, metrics, order, expected = sql_aggregate('user_id,event_type,page_path', 'count', None, 1000, filters)
+    assert window.aggregate(filters, dimensions, metrics, order, 1000) == expected
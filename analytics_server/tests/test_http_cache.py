@@ -0,0 +1,76 @@
+import sys
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask, jsonify, request
+from sqlalchemy import text
+
+from helpers import make_row
+from http_cache import conditional, current_data_version
+from ingest import insert_events
+from models import DailySummary, UserActivity, db
+
+
+def test_only_event_writes_bump_the_data_version(session):
+    version = current_data_version(session)
+    now = datetime.utcnow()
+    session.add(DailySummary(day=now.date(), watermark=now, computed_at=now, summary={}))
+    session.add(UserActivity(user_id=1, first_seen=now, last_seen=now, event_type_counts={}))
+    session.commit()
+    assert current_data_version(session) == version
+
+    insert_events(session, [make_row(2)])
+    session.commit()
+    assert current_data_version(session) == version + 1
+
+    session.query(DailySummary).delete()
+    session.commit()
+    assert current_data_version(session) == version + 1
+
+
+def unreachable_database_app():
+    app = Flask(__name__)
+    # Nothing listens on port 1: every query fails with OperationalError
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://analytics@127.0.0.1:1/analytics'
+    db.init_app(app)
+
+    def validate():
+        if request.args.get('mode', 'exact') != 'exact':
+            raise ValueError('mode must be exact')
+
+    @app.route('/items')
+    @conditional(validate=validate)
+    def items():
+        try:
+            return jsonify({'total': db.session.execute(text('SELECT 1')).scalar()}), 200
+        except Exception as e:
+            return jsonify({'error': type(e).__name__}), 500
+
+    return app
+
+
+def test_bad_parameters_are_rejected_before_the_version_lookup():
+    response = unreachable_database_app().test_client().get('/items?mode=bogus')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'mode must be exact'}
+
+
+def test_a_failed_version_lookup_falls_through_to_the_view():
+    response = unreachable_database_app().test_client().get('/items', headers={'If-None-Match': '"stale"'})
+    assert response.status_code == 500
+    assert response.get_json() == {'error': 'OperationalError'}
+    assert 'ETag' not in response.headers
+
+
+class Tomorrow(datetime):
+    @classmethod
+    def utcnow(cls):
+        return datetime.utcnow() + timedelta(days=1)
+
+
+@pytest.mark.parametrize('path', ['/api/analytics/daily', '/api/analytics/retention?interval=day'])
+def test_etags_of_date_relative_endpoints_change_with_the_date(session, api, auth, monkeypatch, path):
+    today = api.get(path, headers=auth)
+    assert today.status_code == 200
+    monkeypatch.setattr(sys.modules['app'], 'datetime', Tomorrow)
+    assert api.get(path, headers=auth).headers['ETag'] != today.headers['ETag']
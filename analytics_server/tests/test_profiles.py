@@ -0,0 +1,78 @@
+from sqlalchemy import delete, text
+
+from helpers import START, make_row, store
+from models import AnalyticsEvent, UserActivity
+from profiles import PROFILE_BACKFILL, forget_events, summarize
+
+
+def test_summarize_counts_session_switches():
+    rows = [make_row(1, 's1', 0), make_row(1, None, 1), make_row(1, 's1', 2), make_row(1, 's2', 3), make_row(1, 's1', 4)]
+    profile, = summarize(rows, [row['timestamp'] for row in rows])
+    assert profile['session_count'] == 3
+    assert (profile['first_session_id'], profile['last_session_id']) == ('s1', 's1')
+
+
+def test_session_batch_after_profile_without_session(session):
+    store(session, [make_row(1, None, 0)])
+    assert session.get(UserActivity, 1).session_count == 0
+
+    store(session, [make_row(1, 's1', 1), make_row(1, 's1', 2), make_row(1, 's2', 3)])
+    session.expire_all()
+    profile = session.get(UserActivity, 1)
+    assert profile.session_count == 2
+    assert profile.last_session_id == 's2'
+    assert profile.event_count == 4
+
+    # Continuing the session the profile ended on is not a new session
+    store(session, [make_row(1, 's2', 4), make_row(1, 's3', 5)])
+    session.expire_all()
+    assert session.get(UserActivity, 1).session_count == 3
+
+
+def test_backfill_matches_incremental_profiles(session):
+    batches = [
+        [make_row(1, None, 0, page_path='/a'), make_row(2, 'x', 0)],
+        [make_row(1, 's1', 1), make_row(1, 's2', 2, event_type='click'), make_row(2, 'x', 1)],
+        [make_row(1, 's2', 3), make_row(1, 's1', 4, page_path='/b'), make_row(2, 'y', 2), make_row(2, None, 3)],
+    ]
+    for rows in batches:
+        store(session, rows)
+
+    columns = 'user_id, first_seen, last_seen, event_count, event_type_counts, last_page_path, last_session_id, session_count'
+    incremental = session.execute(text(f'SELECT {columns} FROM user_activity ORDER BY user_id')).all()
+    session.execute(text('DELETE FROM user_activity'))
+    session.execute(text(PROFILE_BACKFILL))
+    backfilled = session.execute(text(f'SELECT {columns} FROM user_activity ORDER BY user_id')).all()
+    session.rollback()
+
+    assert backfilled == incremental
+    assert [row.session_count for row in incremental] == [3, 2]
+
+
+def test_forget_events_takes_deleted_events_out_of_the_counters(session):
+    store(session, [make_row(1, event_type=name) for name in ('view', 'view', 'click', 'click')] + [make_row(None)])
+    deleted = session.execute(
+        delete(AnalyticsEvent).where(AnalyticsEvent.id.in_([1, 2, 3, 5]))
+        .returning(AnalyticsEvent.user_id, AnalyticsEvent.event_type_id)
+    ).all()
+    forget_events(session, deleted)
+    session.commit()
+
+    profile = session.get(UserActivity, 1)
+    assert profile.event_count == 1
+    assert profile.event_type_counts == {'click': 1}
+
+
+def test_updates_move_events_between_profiles(session, api, auth):
+    store(session, [make_row(1, 's1', 0), make_row(1, 's1', 1, event_type='click'), make_row(2, 's2', 2)])
+
+    response = api.put('/api/analytics/event/1', json={'user_id': 2, 'event_type': 'click'}, headers=auth)
+    assert response.status_code == 200
+    response = api.put('/api/analytics/events', json={'updates': [{'id': 2, 'event_type': 'buy'}]}, headers=auth)
+    assert response.status_code == 200
+
+    session.expire_all()
+    old, new = session.get(UserActivity, 1), session.get(UserActivity, 2)
+    assert (old.event_count, old.event_type_counts) == (1, {'buy': 1})
+    assert (new.event_count, new.event_type_counts) == (2, {'view': 1, 'click': 1})
+    assert new.first_seen == START
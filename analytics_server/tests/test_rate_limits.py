@@ -0,0 +1,82 @@
+import uuid
+from multiprocessing import resource_tracker
+
+import pytest
+
+import rate_limits
+from rate_limits import SLOT, BucketTable, Limit
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limits.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def table():
+    table = BucketTable(name=f'test_rate_limits_{uuid.uuid4().hex[:8]}', slots=8)
+    yield table
+    if table._shm is not None:
+        table._shm.close()
+        # BucketTable hands the segment over from the resource tracker; unlink() expects it registered
+        resource_tracker.register(table._shm._name, 'shared_memory')
+        table._shm.unlink()
+
+
+def stored_keys(table):
+    return [SLOT.unpack_from(table._buf, slot * SLOT.size)[0] for slot in range(table._slots)]
+
+
+def test_burst_then_refill(table, clock):
+    limit = Limit('user', rate=2, burst=3)
+    assert [table.acquire([(1, limit)])[0] for _ in range(3)] == [0, 0, 0]
+    assert table.acquire([(1, limit)]) == (0.5, 'user')
+
+    clock.now += 0.5
+    assert table.acquire([(1, limit)]) == (0, None)
+    # Refills stop at the burst
+    clock.now += 60
+    assert [table.acquire([(1, limit)])[0] for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_denied_request_takes_no_tokens(table, clock):
+    plenty, scarce = Limit('ip', rate=1, burst=10), Limit('global', rate=1, burst=1)
+    assert table.acquire([(1, plenty), (2, scarce)]) == (0, None)
+    assert table.acquire([(1, plenty), (2, scarce)]) == (1.0, 'global')
+    assert table.acquire([(1, Limit('ip', rate=1, burst=10))], cost=9) == (0, None)
+
+
+def test_new_keys_in_one_acquire_get_separate_slots(table, clock):
+    limit = Limit('user', rate=1, burst=2)
+    # 1 and 9 share their first slot in an 8 slot table
+    table.acquire([(1, limit), (9, limit)])
+    assert sorted(key for key in stored_keys(table) if key) == [1, 9]
+    assert table.acquire([(1, limit)]) == (0, None)
+    assert table.acquire([(1, limit)]) == (1.0, 'user')
+
+
+def test_idle_and_least_recently_used_buckets_are_reused(table, clock, monkeypatch):
+    monkeypatch.setattr(rate_limits, 'PROBES', 2)
+    limit = Limit('user', rate=1, burst=1)
+    table.acquire([(1, limit)])
+    clock.now += 1
+    table.acquire([(9, limit)])
+    clock.now += 1
+    # Both probed slots are busy: the least recently used bucket (key 1) is evicted
+    assert table.acquire([(17, limit)]) == (0, None)
+    assert 1 not in stored_keys(table) and 9 in stored_keys(table)
+
+    # Once idle, the first probed slot is free to take
+    clock.now += rate_limits.RATE_LIMIT_IDLE_SECONDS + 1
+    table.acquire([(25, limit)])
+    assert 17 not in stored_keys(table) and 25 in stored_keys(table)
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from helpers import make_row, store
+from retention import retention_cache, retention_matrix
+from shards import shard_set
+
+NOW = datetime(2026, 3, 18, 12, 0)
+
+
+def at(user_id, days_ago, event_type='view'):
+    return dict(make_row(user_id, event_type=event_type), timestamp=NOW - timedelta(days=days_ago))
+
+
+def fresh_matrix(**kwargs):
+    retention_cache._entries.clear()
+    return retention_matrix(shard_set, now=NOW, cohorts=6, **kwargs)
+
+
+@pytest.mark.parametrize('events', [{}, {'cohort_event': 'signup', 'return_event': 'view'}])
+def test_cached_closed_cells_merge_with_the_open_period(session, events):
+    store(session, [
+        at(1, 30, 'signup'), at(1, 23), at(1, 2),
+        at(2, 16, 'signup'), at(2, 9), at(3, 9, 'signup'),
+        at(4, 1, 'signup'),
+    ])
+    fresh_matrix(**events)
+
+    # New activity in the open week: returning users, a new user and an older user's first return
+    store(session, [at(3, 0), at(1, 0), at(5, 0, 'signup'), at(5, 0), at(2, 0)])
+    key = (events.get('cohort_event'), events.get('return_event'), 'week')
+    assert retention_cache.get(key, datetime(2026, 3, 16)) is not None
+    cached = retention_matrix(shard_set, now=NOW, cohorts=6, **events)
+    assert cached == fresh_matrix(**events)
+    # Users 4 and 5 start in the open week
+    assert cached[-1]['size'] == 2
+    assert sum(row['retained'][-1] for row in cached) > 0
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import pytest
+
+from http_cache import current_data_version
+from models import data_version_seq, db
+from slow_queries import VOLATILE_STATEMENT, SlowQueryLog, explain
+
+
+@pytest.mark.parametrize('statement', [
+    f"SELECT nextval('{data_version_seq.name}')",
+    'SELECT pg_try_advisory_lock(42)',
+    'SELECT id FROM analytics_events WHERE id = 1 FOR UPDATE',
+    'SELECT id FROM analytics_events FOR NO KEY UPDATE SKIP LOCKED',
+])
+def test_volatile_selects_are_not_explained(statement):
+    assert VOLATILE_STATEMENT.search(statement)
+
+
+def test_plain_selects_are_explained():
+    assert not VOLATILE_STATEMENT.search('SELECT user_id, count(*) FROM analytics_events GROUP BY user_id')
+
+
+def test_explain_runs_read_only(session):
+    version = current_data_version(session)
+    with pytest.raises(Exception, match='read-only transaction'):
+        explain(db.engine, f"SELECT nextval('{data_version_seq.name}')", {})
+    assert current_data_version(session) == version
+    assert 'Seq Scan' in explain(db.engine, 'SELECT * FROM analytics_events', {})
+
+
+
+def test_entries_respect_the_limit():
+    log = SlowQueryLog()
+    engine = SimpleNamespace(url=SimpleNamespace(database='analytics'), dialect=SimpleNamespace(name='sqlite'))
+    for number in range(3):
+        log.record(engine, f'SELECT {number}', (), 500.0, False)
+
+    assert [entry['statement'] for entry in log.entries(limit=2)] == ['SELECT 2', 'SELECT 1']
+    assert log.entries(limit=0) == []
+    assert log.entries(limit=-1) == []
@@ -0,0 +1,114 @@
+import os
+
+import psycopg2
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import spool as spool_module
+from helpers import make_row
+from models import AnalyticsEvent
+from spool import RECORD_HEADER, Spool, database_unavailable, read_segment
+
+
+def spooled_rows(count, event_type='spooled'):
+    return [dict(make_row(1, event_type=event_type), event_uuid=None, timestamp=None) for _ in range(count)]
+
+
+def segments(spool):
+    return sorted(name for name in os.listdir(spool.directory) if not name.startswith('.'))
+
+
+def test_append_writes_checksummed_records(tmp_path):
+    spool = Spool(root=str(tmp_path))
+    spool.append(spooled_rows(2))
+    spool.append(spooled_rows(1))
+    spool.seal()
+
+    path = os.path.join(spool.directory, segments(spool)[0])
+    records, intact = read_segment(path)
+    assert intact
+    assert [len(rows) for rows in records] == [2, 1]
+    assert all(row['event_uuid'] is not None for rows in records for row in rows)
+    assert spool.metrics()['bytes'] == os.path.getsize(path)
+
+
+def test_torn_tail_keeps_the_intact_records(tmp_path):
+    spool = Spool(root=str(tmp_path))
+    spool.append(spooled_rows(1))
+    spool.append(spooled_rows(1))
+    spool.seal()
+    path = os.path.join(spool.directory, segments(spool)[0])
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    records, intact = read_segment(path)
+    assert len(records) == 1 and not intact
+
+    # A flipped payload byte fails the checksum
+    with open(path, 'r+b') as f:
+        f.seek(RECORD_HEADER.size)
+        first = f.read(1)
+        f.seek(RECORD_HEADER.size)
+        f.write(bytes([first[0] ^ 0xff]))
+    assert read_segment(path) == ([], False)
+
+
+def test_segments_roll_over_and_restart_resumes(tmp_path):
+    spool = Spool(root=str(tmp_path), segment_bytes=1)
+    spool.append(spooled_rows(1))
+    spool.append(spooled_rows(1))
+    assert len(segments(spool)) == 2
+    spool._dir_lock.close()
+
+    restarted = Spool(root=str(tmp_path))
+    restarted._claim_directory()
+    assert restarted.directory == spool.directory
+    assert restarted.metrics()['bytes'] == spool.metrics()['bytes']
+
+
+def test_replay_stores_events_once_and_deletes_segments(session, tmp_path):
+    spool = Spool(root=str(tmp_path))
+    spool.append(spooled_rows(3))
+    spool.append(spooled_rows(2))
+
+    spool.replay(session)
+    assert session.query(AnalyticsEvent).count() == 5
+    assert segments(spool) == []
+    assert spool.metrics()['replayed_events'] == 5
+
+
+def test_segment_failing_repeatedly_is_quarantined(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(spool_module, 'SPOOL_MAX_REPLAY_FAILURES', 2)
+    spool = Spool(root=str(tmp_path))
+    spool.append(spooled_rows(1))
+    spool.seal()
+
+    def broken(session, records):
+        raise RuntimeError('listener failed')
+    monkeypatch.setattr(spool, '_insert_records', broken)
+    with pytest.raises(RuntimeError):
+        spool.replay(session)
+    spool.replay(session)
+
+    name, = segments(spool)
+    assert name.endswith('.quarantined')
+    assert spool.metrics()['quarantined_segments'] == 1
+    assert spool.metrics()['bytes'] == 0
+
+
+def operational_error(pgcode):
+    orig = psycopg2.OperationalError('boom')
+    if pgcode:
+        # psycopg2 exposes pgcode read-only; a subclass stands in for a server error
+        orig = type('ServerError', (psycopg2.OperationalError,), {'pgcode': pgcode})('boom')
+    return OperationalError('INSERT', {}, orig)
+
+
+def test_only_connection_failures_count_as_unavailable():
+    assert database_unavailable(operational_error(None))
+    assert database_unavailable(operational_error('08006'))
+    assert database_unavailable(operational_error('57P01'))
+    # Statement timeout and deadlock
+    assert not database_unavailable(operational_error('57014'))
+    assert not database_unavailable(operational_error('40P01'))
+    assert not database_unavailable(ValueError())
@@ -14,6 +14,17 @@ function getSessionId(): string {
   return sessionId;
 }
 
+function newEventId(): string {
+  if (typeof crypto !== "undefined" && "randomUUID" in crypto) {
+    return crypto.randomUUID();
+  }
+  // RFC 4122 version 4 fallback for older browsers
+  return "xxxxxxxx-xxxx-4xxx-yxxx-xxxxxxxxxxxx".replace(/[xy]/g, (c) => {
+    const r = (Math.random() * 16) | 0;
+    return (c === "x" ? r : (r & 0x3) | 0x8).toString(16);
+  });
+}
+
 export async function trackEvent(
   eventType: string,
   data: {
@@ -35,6 +46,8 @@ export async function trackEvent(
     const userId = data.userId || user?.id;
 
     await analyticsApi.trackEvent({
+      // Generated once per event so any retry of this call is deduplicated server side
+      event_uuid: newEventId(),
       event_type: eventType,
       user_id: userId,
       session_id: getSessionId(),
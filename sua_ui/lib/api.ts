@@ -235,6 +235,7 @@ export const analyticsApi = {
    * Track an event
    */
   async trackEvent(data: {
+    event_uuid?: string;
     event_type: string;
     user_id?: number;
     session_id?: string;
@@ -245,6 +246,7 @@ export const analyticsApi = {
       success: boolean;
       event_id: number;
       timestamp: string;
+      deduplicated: boolean;
     }>(`${ANALYTICS_SERVICE_URL}/api/analytics/event`, {
       method: "POST",
       body: JSON.stringify(data),
@@ -261,6 +263,7 @@ export const analyticsApi = {
     end_date?: string;
     limit?: number;
     offset?: number;
+    fields?: string;
   }) {
     const queryParams = new URLSearchParams();
     if (params) {